@@ -0,0 +1,15 @@
+package gnue.forms.components.table;
+
+import javax.swing.table.TableModel;
+
+/**
+ * table model which loads rows on demand
+ */
+public interface LazyTableModel extends TableModel {
+
+	/**
+	 * returns true if value is available without loading the row
+	 */
+	public boolean isCellLoaded(int row, int col);
+
+}
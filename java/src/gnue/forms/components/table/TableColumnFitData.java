@@ -59,6 +59,10 @@ public class TableColumnFitData extends MouseAdapter {
 
 		TableCellRenderer renderer = table.getDefaultRenderer(model.getColumnClass(col));
 		for (int row = 0; row < table.getRowCount(); row++) {
+			// do not force loading of all rows
+			if (model instanceof LazyTableModel && !((LazyTableModel)model).isCellLoaded(row, col)) {
+				continue;
+			}
 			int cellWidth = renderer.getTableCellRendererComponent(
 				table, 
 				model.getValueAt(row, col), 
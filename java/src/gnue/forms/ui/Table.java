@@ -32,7 +32,7 @@ public class Table extends Widget implements ListSelectionListener, MouseListene
 	public Table(Desktop desktop, Integer id, String label, String selectionMode) {
 		super(desktop, id, label);
 
-		table = new TableComponent(new TableDoc());
+		table = new TableComponent(new TableDoc(this));
 
 		table.addMouseListener(this);
 		table.addKeyListener(this);
@@ -148,13 +148,15 @@ public class Table extends Widget implements ListSelectionListener, MouseListene
 	
 	
 	/**
-	 * data is JSONArray of JSONArrays of String or Boolean for flag data
+	 * rows is window of rowCount rows starting at firstRow
+	 * rows is JSONArray of JSONArrays of String or Boolean for flag data
 	 * columns is JSONArray of JSONObject similar to uiSetColumns, used to update columns
+	 * other rows are requested with onRequestRows when displayed
 	 */
-	public void uiSetData(JSONArray data, JSONArray columns) {
+	public void uiSetDataWindow(Integer generation, Integer rowCount, Integer firstRow, JSONArray rows, JSONArray columns) {
 		stopListenSelection();
 		try {
-			getModel().setData(data, columns);
+			getModel().setDataWindow(generation, rowCount, firstRow, rows, columns);
 		}
 		finally {
 			startListenSelection();
@@ -195,10 +197,18 @@ public class Table extends Widget implements ListSelectionListener, MouseListene
 	}
 	
 
+	public void uiSetRows(Integer generation, Integer firstRow, JSONArray rows) {
+		getModel().setRows(generation, firstRow, rows);
+	}
+
 	public void uiSetRowData(Integer row, JSONArray rowData) {
 		getModel().setRowData(row, rowData);
 	}
 
+	void requestRows(int generation, int firstRow, int count) {
+		callAfter("onRequestRows", generation, firstRow, count);
+	}
+
 	public void uiAdd(Widget widget) {
 		entries.add((Entry)widget);
 		getModel().addColumnClass(((Entry)widget).getColumnClass());
@@ -622,7 +632,7 @@ public class Table extends Widget implements ListSelectionListener, MouseListene
 			}
 		}
 
-		// if state was not set columns are autosized in uiSetData
+		// if state was not set columns are autosized in uiSetDataWindow
 		stateSet = true;
 	}
 
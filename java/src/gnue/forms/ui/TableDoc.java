@@ -12,9 +12,17 @@ import org.json.*;
 import java.util.List;
 import java.util.ArrayList;
 import java.util.Iterator;
+import java.util.Set;
+import java.util.HashSet;
 import javax.swing.*;
+import gnue.forms.components.table.LazyTableModel;
 
-public class TableDoc extends AbstractTableModel {
+public class TableDoc extends AbstractTableModel implements LazyTableModel {
+
+	/**
+	 * rows requested from server at once when a missing row is displayed
+	 */
+	private final static int BLOCK_SIZE = 100;
 
 	//private final static String[] COLUMN_ORDER_SUFFIX = new String[]{" \u25b2", "", " \u25bc"};
 	private final static String[] COLUMN_ORDER_PREFIX = new String[]{"\u2191 ", "", "\u2193 "};
@@ -22,9 +30,14 @@ public class TableDoc extends AbstractTableModel {
 	JSONObject[] columns;
 	String[] flags;
 	List<Class> columnClasses = new ArrayList<Class>();
+	// rows not transferred yet are null
 	List<Object[]> data = new ArrayList<Object[]>();
+	Set<Integer> requestedBlocks = new HashSet<Integer>();
+	int generation;
+	Table owner;
 
-	public TableDoc() {
+	public TableDoc(Table owner) {
+		this.owner = owner;
 	}
 
 	public void setColumns(JSONArray flags, JSONArray columns) {
@@ -39,12 +52,19 @@ public class TableDoc extends AbstractTableModel {
 		fireTableStructureChanged();
 	}
 	
-	public void setData(JSONArray data, JSONArray columns) {
-		//System.out.printf(">>> setData %s\n", data.length());
+	/**
+	 * generation identifies the server resultset, rows of other generations are ignored
+	 * rows is window of rowCount rows starting at firstRow
+	 */
+	public void setDataWindow(Integer generation, Integer rowCount, Integer firstRow, JSONArray rows, JSONArray columns) {
+		//System.out.printf(">>> setDataWindow %s, %s, %s\n", rowCount, firstRow, rows.length());
+		this.generation = generation;
 		this.data.clear();
-		for (int i=0; i<data.length(); i++) {
-			this.data.add(JSONUtils.jsonArrayToObjectArray(data.getJSONArray(i)));
+		this.requestedBlocks.clear();
+		for (int i=0; i<rowCount; i++) {
+			this.data.add(null);
 		}
+		storeRows(firstRow, rows);
 		// update columns
 		for (int i=0; i<columns.length(); i++) {
 			JSONObject column = columns.getJSONObject(i);
@@ -56,10 +76,40 @@ public class TableDoc extends AbstractTableModel {
 		fireTableDataChanged();
 	}
 
+	public void setRows(Integer generation, Integer firstRow, JSONArray rows) {
+		//System.out.printf(">>> setRows %s, %s\n", firstRow, rows.length());
+		if (generation == this.generation && rows.length() > 0) {
+			storeRows(firstRow, rows);
+			fireTableRowsUpdated(firstRow, firstRow + rows.length() - 1);
+		}
+	}
+
 	public void setRowData(Integer row, JSONArray rowData) {
 		//System.out.printf(">>> setRowData %s\n", row);
-		this.data.set(row, JSONUtils.jsonArrayToObjectArray(rowData));
-		fireTableRowsUpdated(row, row);
+		if (row < this.data.size()) {
+			this.data.set(row, JSONUtils.jsonArrayToObjectArray(rowData));
+			fireTableRowsUpdated(row, row);
+		}
+	}
+
+	private void storeRows(int firstRow, JSONArray rows) {
+		for (int i=0; i<rows.length() && firstRow+i < this.data.size(); i++) {
+			this.data.set(firstRow + i, JSONUtils.jsonArrayToObjectArray(rows.getJSONArray(i)));
+		}
+	}
+
+	/**
+	 * ask server for the block containing row, the block is requested only once per generation
+	 */
+	private void requestRows(int row) {
+		int block = row / BLOCK_SIZE;
+		if (requestedBlocks.add(block)) {
+			owner.requestRows(generation, block * BLOCK_SIZE, BLOCK_SIZE);
+		}
+	}
+
+	public boolean isCellLoaded(int row, int col) {
+		return col == 0 || data.get(row) != null;
 	}
 
 	//////////////////////////////////////////////////////
@@ -121,7 +171,12 @@ public class TableDoc extends AbstractTableModel {
 		}
 		else {
 			col--;
-			Object value = data.get(row)[col];
+			Object[] rowData = data.get(row);
+			if (rowData == null) {
+				requestRows(row);
+				return null;
+			}
+			Object value = rowData[col];
 			//System.out.printf(">>> getValueAt %s, %s: %s\n", row, col, value);
 			return value;
 		}
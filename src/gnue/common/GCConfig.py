@@ -56,4 +56,13 @@ ConfigOptions = (
 		+ '<![CDATA[ .. ]]> blocks, instead of encoding with &lt; etc.',
 		'Typecast'   : GTypecast.boolean,
 		'Default'    : True },
+
+	{ 'Name'       : 'CompiledTriggers',
+		'Type'       : 'Setting',
+		'Comment'    : 'If set to true, then python triggers are compiled once '
+		+ 'into functions, instead of running generated code on every call.',
+		'Description': 'If set to true, then python triggers are compiled once '
+		+ 'into functions, instead of running generated code on every call.',
+		'Typecast'   : GTypecast.boolean,
+		'Default'    : True },
 )
@@ -216,6 +216,30 @@ class GCondition (GObjects.GObj):
 		return True
 
 
+	# ---------------------------------------------------------------------------
+	# Compile a condition tree into a python function
+	# ---------------------------------------------------------------------------
+
+	def compile (self):
+		"""
+		Compile the condition tree into a python function taking the lookup
+		dictionary and returning True or False, like L{evaluate}.
+
+		The tree is validated once. Constants are folded and LIKE patterns
+		compiled at this time, so evaluating the function is a single call per
+		lookup. Changes to the tree after this call are not reflected by the
+		function, values of parameters are read on every call.
+
+		@return: function (lookup) -> True or False
+
+		@raise ArgumentCountError: if the number of child elements somewhere in the
+		  tree is incorrect.
+		"""
+
+		self.validate ()
+		return _Compiler ().compile (self)
+
+
 	# ---------------------------------------------------------------------------
 	# Validate an element of a condition tree
 	# ---------------------------------------------------------------------------
@@ -1068,9 +1092,7 @@ class GClike (GBinaryConditionElement):
 		if self.values [0] is None:
 			return False
 
-		strpat = "^%s" % self.values [1]
-		strpat = strpat.replace ('?', '.').replace ('%', '.*')
-		pattern = re.compile (strpat)
+		pattern = re.compile (_likePattern (self.values [1]))
 		return pattern.match (self.values [0]) is not None
 
 
@@ -1090,9 +1112,7 @@ class GCnotlike (GBinaryConditionElement):
 
 	def evaluate (self, lookup):
 		GBinaryConditionElement.evaluate (self, lookup)
-		strpat = "^%s" % self.values [1]
-		strpat = strpat.replace ('?', '.').replace ('%', '.*')
-		pattern = re.compile (strpat)
+		pattern = re.compile (_likePattern (self.values [1]))
 		return pattern.match (self.values [0]) is None
 
 
@@ -1439,6 +1459,295 @@ def getXMLelements (updates = {}):
 	return xmlElements
 
 
+# =============================================================================
+# Compiler for condition trees
+# =============================================================================
+
+class _Compiler:
+	"""
+	Translates a condition tree into the source of a single python function.
+	Elements without a translation are evaluated by their own evaluate method.
+	"""
+
+	# Types compared without unification if both operands are of the same type
+	__PLAIN = (unicode, int, long, float, bool, datetime.date, datetime.time,
+		datetime.datetime)
+
+	# Elements evaluated at compile time if all their arguments are constant
+	__FOLDABLE = ('GCCondition', 'GCand', 'GCor', 'GCnot', 'GCeq', 'GCne',
+		'GCgt', 'GCge', 'GClt', 'GCle', 'GClike', 'GCnotlike', 'GCbetween',
+		'GCnotbetween', 'GCnull', 'GCnotnull', 'GCupper', 'GClower', 'GCmul',
+		'GCdiv', 'GCnegate')
+
+	# Python operators of relational elements
+	__OPERATORS = {
+		'GCeq': '==', 'GCne': '!=',
+		'GCgt': '>',  'GCge': '>=',
+		'GClt': '<',  'GCle': '<='}
+
+	# ---------------------------------------------------------------------------
+	# Constructor
+	# ---------------------------------------------------------------------------
+
+	def __init__ (self):
+
+		self.__namespace = {
+			'MissingFieldError': MissingFieldError,
+			'_compare'         : _compare,
+			'_like'            : _like,
+			'_between'         : _between}
+
+
+	# ---------------------------------------------------------------------------
+	# Compile a tree
+	# ---------------------------------------------------------------------------
+
+	def compile (self, condition):
+
+		source = "def evaluate (lookup):\n" \
+			"\ttry:\n" \
+			"\t\treturn True if %s else False\n" \
+			"\texcept KeyError, e:\n" \
+			"\t\traise MissingFieldError, (e.args [0])\n" \
+			% self.__logic (condition, ' and ', 'True')
+
+		exec source in self.__namespace
+		function = self.__namespace ['evaluate']
+		function.source = source
+		return function
+
+
+	# ---------------------------------------------------------------------------
+	# Name for an object in the namespace of the function
+	# ---------------------------------------------------------------------------
+
+	def __bind (self, value):
+
+		name = '_v%d' % len (self.__namespace)
+		self.__namespace [name] = value
+		return name
+
+
+	# ---------------------------------------------------------------------------
+	# Translate an element into a python expression
+	# ---------------------------------------------------------------------------
+
+	def __expression (self, element):
+
+		kind = element._type
+
+		# fold subtrees built from constants only
+		if kind != 'GCCConst' and self.__isConstant (element):
+			try:
+				return self.__bind (element.evaluate ({}))
+			except Exception:
+				# raise the error on evaluation, like evaluate does
+				pass
+
+		if kind in ('GCCondition', 'GCand'):
+			return self.__logic (element, ' and ', 'True')
+
+		elif kind == 'GCor':
+			return self.__logic (element, ' or ', 'False')
+
+		elif kind == 'GCnot':
+			return '(not %s)' % self.__expression (element._children [0])
+
+		elif kind in self.__OPERATORS:
+			return self.__relation (element, self.__OPERATORS [kind])
+
+		elif kind in ('GClike', 'GCnotlike'):
+			return self.__like (element, kind == 'GCnotlike')
+
+		elif kind in ('GCbetween', 'GCnotbetween'):
+			result = self.__between (element)
+			if kind == 'GCnotbetween':
+				result = '(not %s)' % result
+			return result
+
+		elif kind == 'GCnull':
+			return '(%s is None)' % self.__expression (element._children [0])
+
+		elif kind == 'GCnotnull':
+			return '(%s is not None)' % self.__expression (element._children [0])
+
+		elif kind == 'GCupper':
+			return '%s.upper ()' % self.__expression (element._children [0])
+
+		elif kind == 'GClower':
+			return '%s.lower ()' % self.__expression (element._children [0])
+
+		elif kind == 'GCCField':
+			return 'lookup [%s]' % self.__bind (element.name)
+
+		elif kind == 'GCCConst':
+			return self.__bind (self.__constant (element))
+
+		elif kind == 'GCCParam':
+			return '%s ()' % self.__bind (element.getValue)
+
+		else:
+			return '%s (lookup)' % self.__bind (element.evaluate)
+
+	# ---------------------------------------------------------------------------
+
+	def __logic (self, element, operator, empty):
+
+		if not element._children:
+			return empty
+		return '(%s)' % operator.join ([self.__expression (child)
+			for child in element._children])
+
+	# ---------------------------------------------------------------------------
+
+	def __relation (self, element, operator):
+
+		(left, right) = element._children
+		a = self.__expression (left)
+		b = self.__expression (right)
+
+		# field compared with a constant: same types need no unification
+		plain = self.__plainConstant (right)
+		if plain is not None and isinstance (left, GCField):
+			return '(%s %s %s if type (%s) is %s else _compare (%r, %s, %s))' % (
+				a, operator, b, a, self.__bind (plain), operator, a, b)
+
+		return '_compare (%r, %s, %s)' % (operator, a, b)
+
+	# ---------------------------------------------------------------------------
+
+	def __like (self, element, negate):
+
+		(left, right) = element._children
+		a = self.__expression (left)
+		b = self.__expression (right)
+		generic = '_like (%s, %s, %s)' % (a, b, negate)
+
+		# precompile constant patterns, fall back to the generic evaluation if
+		# the value needs unification
+		if not isinstance (left, GCField) or \
+				self.__plainConstant (right) is not unicode:
+			return generic
+
+		try:
+			pattern = re.compile (_likePattern (self.__constant (right)))
+		except re.error:
+			return generic
+
+		test = negate and 'is None' or 'is not None'
+		return '(%s.match (%s) %s if type (%s) is unicode else %s)' % (
+			self.__bind (pattern), a, test, a, generic)
+
+	# ---------------------------------------------------------------------------
+
+	def __between (self, element):
+
+		(value, lower, upper) = element._children
+		a = self.__expression (value)
+		b = self.__expression (lower)
+		c = self.__expression (upper)
+
+		plain = self.__plainConstant (lower)
+		if plain is not None and plain is self.__plainConstant (upper) and \
+				isinstance (value, GCField):
+			return '(%s <= %s <= %s if type (%s) is %s else _between (%s, %s, %s))' \
+				% (b, a, c, a, self.__bind (plain), a, b, c)
+
+		return '_between (%s, %s, %s)' % (a, b, c)
+
+	# ---------------------------------------------------------------------------
+
+	def __plainConstant (self, element):
+		"""
+		Return the type of a constant if values of this type compare without
+		unification, or None.
+		"""
+
+		if isinstance (element, GCConst) and element.value is not None:
+			kind = type (self.__constant (element))
+			if kind in self.__PLAIN:
+				return kind
+		return None
+
+	# ---------------------------------------------------------------------------
+
+	def __constant (self, element):
+		"""
+		Value of a constant. Strings are converted to unicode here instead of on
+		every unification.
+		"""
+
+		value = element.value
+		if isinstance (value, str):
+			try:
+				value = unicode (value)
+			except UnicodeError:
+				pass
+		return value
+
+	# ---------------------------------------------------------------------------
+
+	def __isConstant (self, element):
+
+		if isinstance (element, GCConst):
+			return True
+		if isinstance (element, (GCField, GCParam)) or not element._children:
+			return False
+		if element._type not in self.__FOLDABLE:
+			return False
+		for child in element._children:
+			if not self.__isConstant (child):
+				return False
+		return True
+
+
+# -----------------------------------------------------------------------------
+# Helpers of compiled conditions, these follow the evaluate methods
+# -----------------------------------------------------------------------------
+
+def _compare (operator, a, b):
+
+	(a, b) = unify ([a, b])
+	if operator == '==':
+		return a == b
+	elif operator == '!=':
+		return a != b
+	elif operator == '>':
+		return a > b
+	elif operator == '>=':
+		return a >= b
+	elif operator == '<':
+		return a < b
+	else:
+		return a <= b
+
+# -----------------------------------------------------------------------------
+
+def _like (a, b, negate):
+
+	(a, b) = unify ([a, b])
+	if negate:
+		return re.compile (_likePattern (b)).match (a) is None
+	# None cannot be like something else
+	if a is None:
+		return False
+	return re.compile (_likePattern (b)).match (a) is not None
+
+# -----------------------------------------------------------------------------
+
+def _likePattern (pattern):
+
+	strpat = "^%s" % pattern
+	return strpat.replace ('?', '.').replace ('%', '.*')
+
+# -----------------------------------------------------------------------------
+
+def _between (a, b, c):
+
+	values = unify ([a, b, c])
+	return values [1] <= values [0] <= values [2]
+
+
 # =============================================================================
 # Convenience methods
 # =============================================================================
@@ -1812,3 +2121,80 @@ def __unify (values, result):
 
 		values [oldValue == v2] = newValue
 		__unify (values, result)
+
+
+# =============================================================================
+# Self test and benchmark of compiled conditions
+# =============================================================================
+
+if __name__ == '__main__':
+
+	import time
+	import __builtin__
+
+	if not __builtin__.__dict__.has_key('checktype'):
+		__builtin__.__dict__['checktype'] = lambda *args: None
+
+	count = len (sys.argv) > 1 and int (sys.argv [1]) or 1000000
+
+	names = [u'Miller', u'Smith', u'Mayer', 'Maier', None, u'M(x', u'Meier']
+	rows = [{'id'   : i,
+		'name' : names [i % len (names)],
+		'price': i % 3 and float (i % 97) or (i % 97),
+		'date' : datetime.date (2000 + i % 20, 1 + i % 12, 1),
+		'flag' : i % 2 == 0} for i in xrange (1000)]
+
+	conditions = [
+		['and', ['eq', ['field', 'flag'], ['const', True]],
+			['like', ['field', 'name'], ['const', 'M%er']]],
+		['or', ['gt', ['field', 'price'], ['const', 50]],
+			['null', ['field', 'name']]],
+		['between', ['field', 'date'], ['const', datetime.date (2005, 1, 1)],
+			['const', '2010-12-31']],
+		['notlike', ['upper', ['field', 'name']], ['const', 'MA%']],
+		['and', ['ne', ['field', 'id'], ['const', '7']],
+			['not', ['le', ['field', 'price'], ['const', 10.5]]],
+			['notbetween', ['field', 'id'], ['const', 100], ['const', 200]]],
+		['eq', ['const', 1], ['const', 1]],
+		['or']]
+
+	# compiled conditions give the same results as evaluate
+	for prefix in conditions:
+		condition = buildCondition (prefix)
+		function = condition.compile ()
+		for row in rows:
+			try:
+				expected = condition.evaluate (row)
+			except Exception, e:
+				expected = e.__class__
+			try:
+				result = function (row)
+			except Exception, e:
+				result = e.__class__
+			assert result == expected, (prefix, row, result, expected)
+		print "ok", prefix
+
+	try:
+		buildCondition (['eq', ['field', 'missing'], ['const', 1]]).compile () ({})
+	except MissingFieldError:
+		print "ok MissingFieldError"
+
+	# benchmark
+	condition = buildCondition (['and',
+		['eq', ['field', 'flag'], ['const', True]],
+		['like', ['field', 'name'], ['const', 'M%er']],
+		['between', ['field', 'price'], ['const', 10.0], ['const', 90.0]]])
+	data = [row for row in rows if isinstance (row ['price'], float)]
+	data = (data * (count / len (data) + 1)) [:count]
+
+	t = time.time ()
+	matches = len ([row for row in data if condition.evaluate (row)])
+	interpreted = time.time () - t
+
+	function = condition.compile ()
+	t = time.time ()
+	assert len ([row for row in data if function (row)]) == matches
+	compiled = time.time () - t
+
+	print "%d rows, %d matches: evaluate %.2f sec, compiled %.2f sec (%.1fx)" \
+		% (count, matches, interpreted, compiled, interpreted / compiled)
@@ -25,10 +25,12 @@ Classes for the datasource object tree.
 """
 
 import cStringIO
+import weakref
 
 from gnue.common.apps import errors
 from gnue.common.definitions import GObjects, GParser, GParserHelpers
 from gnue.common import events
+from gnue.common.datasources import GConditions
 from gnue.common.formatting import GTypecast
 from src.gnue.common.datasources.access import ACCESS
 
@@ -85,6 +87,7 @@ class GDataSource (GObjects.GObj):
 		self.connection = None
 		self.table = None
 		self.cache = 200
+		self.window = 0
 		self.distinct = False
 		self.primarykeyseq = None
 		self.requery = True
@@ -136,6 +139,10 @@ class GDataSource (GObjects.GObj):
 		# The current result set
 		self.__currentResultSet = None
 
+		# Conditions the result sets have been queried with, besides the static
+		# and master conditions
+		self.__queryConditions = weakref.WeakKeyDictionary ()
+
 		# additional parameters we will pass to ResultSet.query function
 		# parameters can be set from triggers with setParameter
 		self._parameters = {}
@@ -670,10 +677,45 @@ class GDataSource (GObjects.GObj):
 		assert masterRecord or not self.__masterPkFields and not self.__masterFkFields, 'Must provide masterRecord'
 
 		resultSet = self.__createResultSet (conditions, access, masterRecord)
+		self.__queryConditions [resultSet] = conditions
 		self._activateResultSet (resultSet)
 		return resultSet
 
 
+	# ---------------------------------------------------------------------------
+	# Create a result set without activating it
+	# ---------------------------------------------------------------------------
+
+	def createDetachedResultSet (self, conditions = {}):
+		"""
+		Execute a read only query on the backend without changing the active
+		result set of this datasource.
+
+		This is useful to load data on demand, like the nodes of a tree. The
+		conditions of the active result set are applied too. For a detail
+		datasource the current record of the master is used, without a current
+		master record the result set is empty.
+
+		@param conditions: Conditions to be applied additionally to the static
+		  condition of the datasource.
+		@return: The new ResultSet object. The caller should close it when done.
+		"""
+
+		if self.__currentResultSet is not None:
+			conditions = GConditions.combineConditions (conditions,
+				self.__queryConditions.get (self.__currentResultSet, {}))
+
+		masterRecord = None
+		if self.__master is not None \
+				and self.__master.__currentResultSet is not None:
+			masterRecord = self.__master.__currentResultSet.current
+
+		if masterRecord is None and (self.__masterPkFields or self.__masterFkFields):
+			return self.__newResultSet (ACCESS.NONE, None)
+
+		return self.__createResultSet (conditions, ACCESS.NONE, masterRecord)
+
+
 	# ---------------------------------------------------------------------------
 	# Requery an existing result set
 	# ---------------------------------------------------------------------------
@@ -801,7 +843,8 @@ class GDataSource (GObjects.GObj):
 			requery          = self.requery,
 			access           = access,
 			details          = self.__details,
-			eventController  = self.__eventController)
+			eventController  = self.__eventController,
+			window           = self.window)
 
 
 	# ---------------------------------------------------------------------------
@@ -1185,6 +1228,15 @@ def getXMLelements (updates = {}):
 					'Description': u_('Cache this number of records'),
 					'Typecast': GTypecast.whole,
 					'Default':  5 },
+				'window':      {
+					'Label': u_('Record Window'),
+					'Description': u_('Keep at most this number of unchanged '
+						'records in memory and fetch the others again '
+						'when needed. Backends with server side '
+						'cursors then stream the result. 0 (default) '
+						'keeps all records.'),
+					'Typecast': GTypecast.whole,
+					'Default':  0 },
 				'prequery':    {
 					'Label': u_('Query on Startup'),
 					'Description': u_('If true, the datasource is populated on '
@@ -28,7 +28,7 @@ Generic Connection class extended by all database driver plugins.
 __all__ = ['Connection']
 
 from gnue.common.apps import GDebug, plugin
-from gnue.common.datasources import GConnections, GSchema
+from gnue.common.datasources import Exceptions, GConnections, GSchema
 
 
 # =============================================================================
@@ -68,6 +68,10 @@ class Connection(object):
 	@cvar _need_rollback_after_exception_: Can be set to False if the backend
 	  does not require to rollback after an exception has happened. Most
 	  prominent example of this is the appserver backend.
+	@cvar _batch_post_: Can be set to True by descendants that implement
+	  L{_postBatch_} in a way that is faster than single statements.
+	  ResultSets then collect the changes of their records and write them with
+	  L{postBatch}.
 
 	@ivar name: Name of the connection from connections.conf.
 	@ivar parameters: Parameters from connections.conf.
@@ -81,6 +85,7 @@ class Connection(object):
 	_rowidField_                    = None
 	_primarykeyFields_              = None
 	_need_rollback_after_exception_ = False
+	_batch_post_                    = False
 
 
 	# ---------------------------------------------------------------------------
@@ -298,6 +303,33 @@ class Connection(object):
 		assert gLeave (8)
 
 
+	# ---------------------------------------------------------------------------
+	# Write a list of changes to the backend
+	# ---------------------------------------------------------------------------
+
+	def postBatch (self, operations, failed = None):
+		"""
+		Write a list of inserts, updates and deletes to the backend.
+
+		@param operations: List of (operation, table, oldfields, newfields)
+		  tuples. operation is one of 'insert', 'update' or 'delete', the other
+		  items are the arguments for L{insert}, L{update} and L{delete}, None
+		  where unused.
+		@param failed: Function called with the index of the operation that
+		  caused an exception, before the exception is passed on.
+		@raise Exception: if writing any of the operations fails. The exact
+		  exception type depends on the backend.
+		"""
+
+		checktype (operations, list)
+
+		assert gEnter (8)
+		if operations:
+			self._postBatch_ (operations, failed)
+			self.__pending = True
+		assert gLeave (8)
+
+
 	# ---------------------------------------------------------------------------
 	# Requery an existing record to reflect changes done by the backend
 	# ---------------------------------------------------------------------------
@@ -326,6 +358,38 @@ class Connection(object):
 
 
 
+	# ---------------------------------------------------------------------------
+	# Requery a list of existing records
+	# ---------------------------------------------------------------------------
+
+	def requeryBatch (self, table, oldfieldsList, fields, parameters = None):
+		"""
+		Requery several existing records of a table at once.
+
+		@param table: Table name.
+		@param oldfieldsList: List of Fieldname/Value dictionaries to find the
+		  existing records (aka where-clause).
+		@param fields: List of field names to query.
+		@return: List with a Fieldname/Value dictionary with data fresh from the
+		  backend for every entry of oldfieldsList, or None where no record was
+		  found.
+		@raise Exception: if the requery fails. The exact exception type depends on
+		  the backend.
+		"""
+
+		checktype (table, basestring)
+		checktype (oldfieldsList, list)
+		checktype (fields, list)
+
+		assert gEnter (8)
+		if oldfieldsList:
+			result = self._requeryBatch_ (table, oldfieldsList, fields, parameters)
+		else:
+			result = []
+		assert gLeave (8, result)
+		return result
+
+
 	# ---------------------------------------------------------------------------
 	# Call a backend function
 	# ---------------------------------------------------------------------------
@@ -597,6 +661,35 @@ class Connection(object):
 
 	# ---------------------------------------------------------------------------
 
+	def _postBatch_ (self, operations, failed):
+		"""
+		Write a list of changes to the backend.
+
+		Drivers that set L{_batch_post_} overwrite this to send several
+		operations at once. The default writes every operation with L{_insert_},
+		L{_update_} or L{_delete_}.
+
+		@param operations: List of (operation, table, oldfields, newfields)
+		  tuples.
+		@param failed: Function to call with the index of a failing operation,
+		  or None.
+		"""
+		for (index, (operation, table, oldfields, newfields)) in \
+				enumerate (operations):
+			try:
+				if operation == 'insert':
+					self._insert_ (table, newfields)
+				elif operation == 'update':
+					self._update_ (table, oldfields, newfields)
+				else:
+					self._delete_ (table, oldfields)
+			except:
+				if failed is not None:
+					failed (index)
+				raise
+
+	# ---------------------------------------------------------------------------
+
 	def _requery_ (self, table, oldfields, fields, parameters):
 		"""
 		Requery an existing record to reflect changes done by the backend (to be
@@ -617,6 +710,30 @@ class Connection(object):
 
 	# ---------------------------------------------------------------------------
 
+	def _requeryBatch_ (self, table, oldfieldsList, fields, parameters):
+		"""
+		Requery several existing records.
+
+		Database drivers can overwrite this method to fetch all records with a
+		single query. The default calls L{_requery_} for every record.
+
+		@param table: Table name.
+		@param oldfieldsList: List of Fieldname/Value dictionaries to find the
+		  existing records.
+		@param fields: List of field names to query.
+		@return: List of Fieldname/Value dictionaries, None for records not
+		  found.
+		"""
+		result = []
+		for oldfields in oldfieldsList:
+			try:
+				result.append (self._requery_ (table, oldfields, fields, parameters))
+			except Exceptions.RecordNotFoundError:
+				result.append (None)
+		return result
+
+	# ---------------------------------------------------------------------------
+
 	def _call_ (self, table, oldfields, methodname, parameters):
 		"""
 		Call a function of the backend (to be implemented by descendants).
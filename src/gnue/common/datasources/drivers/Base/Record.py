@@ -25,7 +25,7 @@
 Record class used by all database driver plugins.
 """
 
-__all__ = ['Record']
+__all__ = ['Record', 'CompactRecord']
 
 from gnue.common.datasources import Exceptions
 import weakref
@@ -101,7 +101,8 @@ class Record(object):
 		requery          = True,
 		access           = ACCESS.FULL,
 		details          = {},
-		eventController  = None):
+		eventController  = None,
+		notifyLoaded     = True):
 		"""
 		Create a new Record instance.
 
@@ -135,6 +136,9 @@ class Record(object):
 		        tuples containing a list of primary key fields and a list of the
 		        corresponding foreign key fields.
 		@param eventController: EventController instance to notify of data events.
+		@param notifyLoaded: dispatch dsRecordLoaded for an existing record. False
+		        if the record replaces a L{CompactRecord} which was already
+		        announced.
 		"""
 
 		# weakref for better garbage collection
@@ -194,7 +198,8 @@ class Record(object):
 			if self.__access & ACCESS.WRITE:
 				self.__fields = self.__fields.copy()
 
-			self.__dispatchEvent ('dsRecordLoaded')
+			if notifyLoaded:
+				self.__dispatchEvent ('dsRecordLoaded')
 
 		else:
 
@@ -283,6 +288,7 @@ class Record(object):
 		#rint "+ field %s value changed: %s (%s) -> %s (%s)" % (fieldname, self.__fields.get(fieldname), type(self.__fields.get(fieldname)), value, type(value))
 
 		self.__fields [fieldname] = value
+		self.__resultSet._recordChanged (self, (fieldname,))
 
 		if self.__modifiedFields is None:
 			self.__modifiedFields = set()
@@ -315,6 +321,7 @@ class Record(object):
 			self.__modifiedFields = None
 			self.__modified = False
 			self.__resultSet._setPending(None)
+			self.__resultSet._recordChanged (self, fieldsChanged)
 			self.__dispatchEvent ('dsRecordChanged', fields=tuple(fieldsChanged))
 
 
@@ -392,6 +399,22 @@ class Record(object):
 		return self.__modifiedFields is not None and fieldname in self.__modifiedFields
 
 
+	# ---------------------------------------------------------------------------
+	# Value of a field without local modifications
+	# ---------------------------------------------------------------------------
+
+	def getInitialValue (self, fieldname):
+		"""
+		Return the value a field had when the record was loaded from the backend
+		or last posted. For new records this is the default value.
+
+		@param fieldname: Field name.
+		@return: The clean value of the field.
+		"""
+
+		return self.__initialData.get (fieldname)
+
+
 	# ---------------------------------------------------------------------------
 	# Mark record as deleted
 	# ---------------------------------------------------------------------------
@@ -580,7 +603,7 @@ class Record(object):
 	# Post changes to database
 	# ---------------------------------------------------------------------------
 
-	def _post (self, parameters):
+	def _post (self, parameters, batch = None):
 		"""
 		Write all local changes for this record to the backend, as
 		well as for all detail records where this record is the master.
@@ -593,6 +616,11 @@ class Record(object):
 		which will set the record status to "clean". However, if an exception in a
 		later operation of the same transaction happens and causes a rollback on
 		the backend, the record's _post method can simply be called again.
+
+		@param batch: If given, the change is added to this batch of the
+		    L{ResultSet} instead of being written at once, and L{_postWritten} is
+		    called once the batch has been written. Records with detail records
+		    or a rowid to fetch flush the batch and write at once.
 		"""
 		# Just to make sure - you never know who calls us...
 		if not self.isPending() or self.isVoid():
@@ -621,40 +649,52 @@ class Record(object):
 
 		# If we have a connection (i.e. we aren't static or unbound), do the post
 		if self.__connection is not None:
-			if self.__deleted:
-				self.__connection.delete (self.__tablename, self.__wherefields())
-			elif self.__inserted or self.__modified:
-				modifiedFields = {}
-				for field in self.__boundFields:
-					#if self.isFieldModified(field):
-					# WORKAROUND: stored procedure always needs all fields
-					# TODO: think about it
-					if self.__rowidField and field != self.__rowidField or self.isFieldModified(field):
-						modifiedFields [field] = self.__fields [field]
-
-				# oleg:
-				# for postgresql_fn: pass parameters with modifiedFields
-				if parameters:
-					p = parameters.copy()
-					p.update(modifiedFields)
-					modifiedFields = p
-
-				if self.__inserted:
-					rowid = self.__connection.insert (self.__tablename, modifiedFields)
-					if self.__rowidField:
-						assert rowid is not None, 'insert not returned new row id for %s' % self.__tablename
-						self.__fields [self.__rowidField] = rowid
-						# Also set initialData so the requery can work
-						self.__initialData [self.__rowidField] = rowid
-						# Requery all the fields that are important for inserting details.
-						# A backend trigger could have e.g. generated a primary key.
-						# TODO: We could save this work for cases where the detail
-						# resultsets don't have any inserted records.
-						if self.__detailLinkFlags:
-							self.__do_requery (self.__detailLinkFlags.keys (), parameters)
+			operation = self.__operation (parameters)
+
+			if batch is not None and operation is not None:
+				if self.__cachedDetailResultSets or \
+						(operation [0] == 'insert' and self.__rowidField):
+					batch.flush ()
 				else:
-					self.__connection.update (self.__tablename, self.__wherefields(),
-						modifiedFields)
+					batch.append (operation, self)
+					return
+
+			if operation is None:
+				pass
+			elif operation [0] == 'delete':
+				self.__connection.delete (self.__tablename, operation [2])
+			elif operation [0] == 'insert':
+				rowid = self.__connection.insert (self.__tablename, operation [3])
+				if self.__rowidField:
+					assert rowid is not None, 'insert not returned new row id for %s' % self.__tablename
+					self.__fields [self.__rowidField] = rowid
+					# Also set initialData so the requery can work
+					self.__initialData [self.__rowidField] = rowid
+					# Find the record by its new rowid in the indexes
+					self.__resultSet._recordChanged (self, (self.__rowidField,))
+					# Requery all the fields that are important for inserting details.
+					# A backend trigger could have e.g. generated a primary key.
+					# TODO: We could save this work for cases where the detail
+					# resultsets don't have any inserted records.
+					if self.__detailLinkFlags:
+						self.__do_requery (self.__detailLinkFlags.keys (), parameters)
+			else:
+				self.__connection.update (self.__tablename, operation [2],
+					operation [3])
+
+		self._postWritten (parameters)
+
+
+	# ---------------------------------------------------------------------------
+	# Finish posting after the changes have been written
+	# ---------------------------------------------------------------------------
+
+	def _postWritten (self, parameters):
+		"""
+		Mark the record as posted, run the post commit hooks and post all
+		detail records. Called by L{_post}, or by L{ResultSet.post} when the
+		batch holding the changes of this record has been written.
+		"""
 
 		# Record needs a requery now
 		self.__requeryStatus = 'posted'
@@ -675,6 +715,44 @@ class Record(object):
 				resultSet.post (fkData = fkData)
 
 
+	# ---------------------------------------------------------------------------
+	# Change to write to the backend
+	# ---------------------------------------------------------------------------
+
+	def __operation (self, parameters):
+		"""
+		Return the (operation, table, oldfields, newfields) tuple to write
+		this record, or None if the record itself has no changes.
+		"""
+
+		if self.__deleted:
+			return ('delete', self.__tablename, self.__wherefields(), None)
+
+		elif self.__inserted or self.__modified:
+			modifiedFields = {}
+			for field in self.__boundFields:
+				#if self.isFieldModified(field):
+				# WORKAROUND: stored procedure always needs all fields
+				# TODO: think about it
+				if self.__rowidField and field != self.__rowidField or self.isFieldModified(field):
+					modifiedFields [field] = self.__fields [field]
+
+			# oleg:
+			# for postgresql_fn: pass parameters with modifiedFields
+			if parameters:
+				p = parameters.copy()
+				p.update(modifiedFields)
+				modifiedFields = p
+
+			if self.__inserted:
+				return ('insert', self.__tablename, None, modifiedFields)
+			else:
+				return ('update', self.__tablename, self.__wherefields(),
+					modifiedFields)
+
+		return None
+
+
 	# ---------------------------------------------------------------------------
 	# Return whether this record must be requeried or not
 	# ---------------------------------------------------------------------------
@@ -697,7 +775,7 @@ class Record(object):
 	# Requery the record data from the backend
 	# ---------------------------------------------------------------------------
 
-	def _requery (self, commit, parameters):
+	def _requery (self, commit, parameters, batch = None):
 		"""
 		Requery this record to reflect changes done by the backend.
 
@@ -710,6 +788,10 @@ class Record(object):
 		@param commit: True if a commit happened since the L{_post} call. If no
 		        commit has happened, the record will be requeried again after the
 		        following commit.
+		@param batch: If given, a record without detail records adds itself and
+		        its where fields to this list instead of querying the backend.
+		        The L{ResultSet} then requeries all of them at once and passes the
+		        new data to L{_requeried}.
 		"""
 
 		if self.__requeryStatus is None:
@@ -735,6 +817,9 @@ class Record(object):
 		# First, requery ourselves
 		if self.__requery:
 			if self.__rowidField or self.__primarykeyFields:
+				if batch is not None and not self.__cachedDetailResultSets:
+					batch.append ((self, self.__wherefields ()))
+					return
 				self.__do_requery (self.__boundFields, parameters)
 
 		# Now, requery detail resultsets
@@ -776,6 +861,8 @@ class Record(object):
 				if not self.isFieldModified(fieldname):
 					self.__fields [fieldname] = value
 
+		self.__resultSet._recordChanged (self, data.keys ())
+
 		# Now, requery detail resultsets
 		if self.__cachedDetailResultSets:
 			for (dataSource, resultSet) in self.__cachedDetailResultSets.items ():
@@ -787,10 +874,21 @@ class Record(object):
 	# ---------------------------------------------------------------------------
 
 	def __do_requery (self, fields, parameters):
-		newfields = self.__connection.requery (self.__tablename,
-			self.__wherefields(), fields, parameters)
+		self._requeried (self.__connection.requery (self.__tablename,
+			self.__wherefields(), fields, parameters))
+
+	# ---------------------------------------------------------------------------
+
+	def _requeried (self, newfields):
+		"""
+		Merge data fresh from the backend into the record.
+
+		@param newfields: Fieldname/value dictionary as returned by
+		        L{Connection.requery}.
+		"""
 		fieldsChanged = tuple((k for k, v in newfields.iteritems() if k not in self.__fields or self.__fields[k] != v))
 		self.__fields.update (newfields)
+		self.__resultSet._recordChanged (self, fieldsChanged)
 		self.__dispatchEvent ('dsRecordChanged', fields=fieldsChanged)
 
 
@@ -871,3 +969,168 @@ class Record(object):
 				print "modified"
 			else:
 				print
+
+
+# =============================================================================
+# Lightweight view of a row of a read only ResultSet
+# =============================================================================
+
+class CompactRecord(object):
+	"""
+	View of a row of a read only L{ResultSet}.
+
+	ResultSets without any access rights and without details store their rows
+	as tuples of values against a column index shared by all rows, instead of
+	keeping a L{Record} instance with its own field dictionary per row. Views
+	are created on demand and behave like clean L{Record} instances.
+
+	The first change through a view (setting a field, deleting, posting, ...)
+	replaces the row in the ResultSet by a full L{Record}. From then on the
+	view delegates everything to that record.
+
+	A view compares equal to other views of the same row, to the row tuple
+	itself and to the record replacing the row.
+	"""
+
+	__slots__ = ('__resultSet', '__columns', '__values', '__index', '__record',
+		'__weakref__')
+
+	# ---------------------------------------------------------------------------
+	# Constructor
+	# ---------------------------------------------------------------------------
+
+	def __init__ (self, resultSet, columns, values, index):
+		"""
+		@param resultSet: ResultSet storing the row.
+		@param columns: Dictionary mapping field names to positions in values.
+		@param values: Tuple of field values.
+		@param index: Position of the row in the ResultSet when the view is
+		        created.
+		"""
+
+		self.__resultSet = weakref.proxy (resultSet)
+		self.__columns   = columns
+		self.__values    = values
+		self.__index     = index
+		self.__record    = None
+
+	# ---------------------------------------------------------------------------
+
+	def __repr__ (self):
+		if self.__record is not None:
+			return repr (self.__record)
+		return "<Compact Record at %d>" % id (self)
+
+	# ---------------------------------------------------------------------------
+	# Identity of the row
+	# ---------------------------------------------------------------------------
+
+	def __eq__ (self, other):
+		if isinstance (other, CompactRecord):
+			return other.__values is self.__values
+		return other is self.__values \
+			or (self.__record is not None and other is self.__record)
+
+	def __ne__ (self, other):
+		return not self.__eq__ (other)
+
+	def __hash__ (self):
+		return hash (id (self.__values))
+
+	# ---------------------------------------------------------------------------
+	# Dictionary emulation
+	# ---------------------------------------------------------------------------
+
+	def __getitem__ (self, fieldname):
+		if self.__record is not None:
+			return self.__record [fieldname]
+		index = self.__columns.get (fieldname)
+		if index is None:
+			return None
+		return self.__values [index]
+
+	# ---------------------------------------------------------------------------
+
+	def __setitem__ (self, fieldname, value):
+		if self.__record is None and fieldname in self.__columns \
+				and self.__values [self.__columns [fieldname]] == value:
+			return
+		self.__promote () [fieldname] = value
+
+	# ---------------------------------------------------------------------------
+
+	def items (self):
+		return self.copy ().items ()
+
+	def keys (self):
+		return self.copy ().keys ()
+
+	def values (self):
+		return self.copy ().values ()
+
+	def copy (self):
+		if self.__record is not None:
+			return self.__record.copy ()
+		values = self.__values
+		return dict ([(name, values [i]) for (name, i) in self.__columns.iteritems ()])
+
+	def getField (self, fieldname):
+		return self [fieldname]
+
+	def getFieldsAsDict (self):
+		return self.copy ()
+
+	# ---------------------------------------------------------------------------
+	# Status of the record
+	# ---------------------------------------------------------------------------
+
+	def isFieldModified (self, fieldname):
+		return self.__record is not None and self.__record.isFieldModified (fieldname)
+
+	def getInitialValue (self, fieldname):
+		if self.__record is not None:
+			return self.__record.getInitialValue (fieldname)
+		return self [fieldname]
+
+	def isEmpty (self):
+		return self.__record is not None and self.__record.isEmpty ()
+
+	def isVoid (self):
+		return self.__record is not None and self.__record.isVoid ()
+
+	def isInserted (self):
+		return self.__record is not None and self.__record.isInserted ()
+
+	def isModified (self):
+		return self.__record is not None and self.__record.isModified ()
+
+	def isDeleted (self):
+		return self.__record is not None and self.__record.isDeleted ()
+
+	def isPending (self):
+		return self.__record is not None and self.__record.isPending ()
+
+	def _needsRequery (self, commit):
+		return self.__record is not None and self.__record._needsRequery (commit)
+
+	def _activate (self):
+		# compact rows have no details
+		if self.__record is not None:
+			self.__record._activate ()
+
+	# ---------------------------------------------------------------------------
+	# Everything else needs a full record
+	# ---------------------------------------------------------------------------
+
+	def __getattr__ (self, name):
+		if not hasattr (Record, name):
+			raise AttributeError, name
+		return getattr (self.__promote (), name)
+
+	# ---------------------------------------------------------------------------
+
+	def __promote (self):
+		if self.__record is None:
+			self.__record = self.__resultSet._promoteRow (self.__values,
+				self.__index)
+		return self.__record
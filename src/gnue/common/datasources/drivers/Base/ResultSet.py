@@ -30,9 +30,10 @@ from src.gnue.common.datasources.drivers.Base import Record
 
 __all__ = ['ResultSet']
 
+import weakref
 
 from gnue.common.datasources import Exceptions
-from src.gnue.common.datasources.drivers.Base.Record import ACCESS
+from src.gnue.common.datasources.drivers.Base.Record import ACCESS, CompactRecord
 
 
 # =============================================================================
@@ -70,7 +71,8 @@ class ResultSet(object):
 		requery          = True,
 		access           = ACCESS.FULL,
 		details          = {},
-		eventController  = None):
+		eventController  = None,
+		window           = 0):
 		"""
 		Create a new ResultSet instance.
 
@@ -103,6 +105,10 @@ class ResultSet(object):
 		    corresponding foreign key fields.
 		@param eventController: EventController instance to notify of data
 		    events.
+		@param window: Maximum number of clean records kept in memory. Records
+		    beyond this window are dropped and fetched again by primary key when
+		    needed, if the driver supports it (see L{_can_refetch_}). 0 keeps
+		    all records in memory.
 		"""
 
 		self.__defaultData      = defaultData
@@ -116,9 +122,11 @@ class ResultSet(object):
 		self.__access           = access
 		self.__details          = details
 		self.__eventController  = eventController
+		self.__window           = window
 
 		# Data for static datasources
 		self.__static_data = []
+		self.__static_index = None
 
 		# Parameters of last query
 		self.__lastquery_type = None
@@ -128,9 +136,35 @@ class ResultSet(object):
 		# Generator to yield fieldname/value dictionaries
 		self.__generator = None
 
-		# List of all Record objects cached in this ResultSet
+		# List of all Record objects cached in this ResultSet. Records dropped
+		# from the window are replaced by _Dropped markers, rows of compact
+		# ResultSets are stored as tuples
 		self.__cached_records = []
 
+		# Read only ResultSets without details store rows as tuples of values
+		# against a shared column index and create CompactRecord views on demand
+		self.__compact = (access == ACCESS.NONE) and not details
+		self.__columns = None
+		self.__views = weakref.WeakValueDictionary()
+
+		# Position in the query result of every record that can be dropped,
+		# by id of the record or row tuple
+		self.__positions = {}
+
+		# Position in the query result of the next record from the generator
+		self.__next_position = 0
+
+		# Range of cache indexes that may contain records to drop
+		self.__evict_lo = 0
+		self.__evict_hi = -1
+
+		# Hash indexes of the cached records used by findRecord, by tuple of
+		# field names. None if records can't be indexed (see findRecord)
+		self.__indexes = {}
+
+		# Cache index of every entry by id, built when needed
+		self.__entry_positions = None
+
 		# Index of the current record
 		self.__current_index = -1
 
@@ -163,7 +197,7 @@ class ResultSet(object):
 			if position >= len(self.__cached_records):
 				if not self.__cache_next_record():
 					break
-			yield self.__cached_records[position]
+			yield self.__record_at(position)
 			position += 1
 
 	# -------------------------------------------------------------------------
@@ -225,6 +259,14 @@ class ResultSet(object):
 		# Dispose current result set data
 		self.__generator = None
 		self.__cached_records = []
+		self.__columns = None
+		self.__views.clear()
+		self.__positions = {}
+		self.__next_position = 0
+		self.__evict_lo = 0
+		self.__evict_hi = -1
+		self.__indexes = None if self.__window else {}
+		self.__entry_positions = None
 		self.__current_index = -1
 		self.__record_count = 0
 		self.current = None
@@ -270,6 +312,28 @@ class ResultSet(object):
 
 		return self.__generator
 
+	# -------------------------------------------------------------------------
+	# Get the size of the record window
+	# -------------------------------------------------------------------------
+
+	def getWindowSize(self):
+		"""
+		Return the maximum number of clean records kept in memory, 0 if all
+		records are kept.
+		"""
+
+		return self.__window
+
+	# -------------------------------------------------------------------------
+
+	def _getPrimarykeyFields(self):
+		"""
+		Return the names of the primary key fields, used by drivers to fetch
+		dropped records again.
+		"""
+
+		return self.__primarykeyFields or []
+
 	# -------------------------------------------------------------------------
 	# Get the number of records in the recordset
 	# -------------------------------------------------------------------------
@@ -285,6 +349,41 @@ class ResultSet(object):
 			# Fallback in case record count unknown
 			return len(self.__cached_records)
 
+	# -------------------------------------------------------------------------
+	# Aggregates calculated by the backend
+	# -------------------------------------------------------------------------
+
+	def canAggregate(self):
+		"""
+		Return True if L{aggregate} is supported for the last query.
+		"""
+		return self._can_aggregate_()
+
+	# -------------------------------------------------------------------------
+
+	def aggregate(self, function, fieldname, exclude=None):
+		"""
+		Calculate an aggregate over all records of the query without fetching
+		them. Local changes not yet posted are not included.
+
+		@param function: One of 'sum', 'count', 'min' or 'max'. None values
+		    are ignored.
+		@param fieldname: Field to aggregate. For 'count' it can be None to
+		    count the records.
+		@param exclude: Records to leave out, e.g. the records changed locally.
+		    Requires a primary key.
+		@return: The aggregate value, None if there are no values.
+		"""
+		assert function in ('sum', 'count', 'min', 'max'), function
+		assert self._can_aggregate_(), 'aggregate not supported by the query'
+		assert not exclude or self.__primarykeyFields, 'exclude requires a primary key'
+
+		# records not posted yet are not in the backend
+		keys = [tuple([record.getInitialValue(field) for field in self.__primarykeyFields])
+			for record in exclude or [] if not record.isInserted()]
+
+		return self._aggregate_(function, fieldname, keys)
+
 
 	# -------------------------------------------------------------------------
 	# Get a specific record (0=based)
@@ -311,7 +410,7 @@ class ResultSet(object):
 		if index + 1 > len(self.__cached_records):
 			return None
 		else:
-			return self.__cached_records[index]
+			return self.__record_at(index)
 
 	def getRecordIndex(self, record):
 		"""
@@ -319,6 +418,18 @@ class ResultSet(object):
 		"""
 		return self.__cached_records.index(record)
 
+	def hasRecord(self, record):
+		"""
+		Return True if the record is in the cache of this ResultSet.
+
+		@param record: a L{Record.Record} instance.
+		"""
+		try:
+			self.__position_of(record)
+		except KeyError:
+			return False
+		return True
+
 	# -------------------------------------------------------------------------
 	# Get data as array
 	# -------------------------------------------------------------------------
@@ -338,13 +449,8 @@ class ResultSet(object):
 
 		checktype(fields, list)
 
-		# First, load all records into the cache
-		while self.__cache_next_record():
-			pass
-
-		# Now build up the array
 		result = []
-		for record in self.__cached_records:
+		for record in self:
 			line = []
 			for field in fields:
 				line.append(record[field])
@@ -378,13 +484,8 @@ class ResultSet(object):
 		checktype(keyfields, list)
 		checktype(fields, list)
 
-		# First, load all records into the cache
-		while self.__cache_next_record():
-			pass
-
-		# Now build up the array
 		result = {}
-		for record in self.__cached_records:
+		for record in self:
 			d = result
 			for field in keyfields:
 				d = d.setdefault(record[field], {})
@@ -508,6 +609,11 @@ class ResultSet(object):
 		cursor to the first record to match the given fieldValues dictionary.
 		If no match is found, then the record pointer is set to -1.
 
+		The first search for a set of fields builds a hash index of the loaded
+		records on these fields, which is kept up to date when records are
+		fetched, inserted, removed or changed. ResultSets with a record window
+		are searched sequentially.
+
 		@param fieldValues: fieldname/value dictionary to search for.
 		@return: the first record that matches as a L{Record.Record}
 		    instance or None if no match was found.
@@ -519,6 +625,29 @@ class ResultSet(object):
 		"""
 		checktype(fieldValues, dict)
 
+		index = self.__index_for(fieldValues.keys())
+		if index is not None:
+			try:
+				key = tuple([fieldValues[field] for field in index.fields])
+				hash(key)
+			except TypeError:
+				# unhashable search value
+				index = None
+
+		if index is not None:
+			while True:
+				entries = index.get(key)
+				if entries:
+					self.__move(min([self.__position_of(entry) for entry in entries]))
+					return self.current
+				if self.__indexes is None or not self.__cache_next_record():
+					break
+			if self.__indexes is not None:
+				# No match found
+				if moveIfNotFound:
+					self.__move(-1)
+				return None
+
 		i = 0
 		while True:
 			if i >= len(self.__cached_records):
@@ -527,7 +656,7 @@ class ResultSet(object):
 					if moveIfNotFound:
 						self.__move(-1)
 					return None
-			record = self.__cached_records[i]
+			record = self.__record_at(i)
 			found = True
 			for (key, value) in fieldValues.items():
 				if record[key] != value:
@@ -542,7 +671,7 @@ class ResultSet(object):
 
 	def __move(self, record):
 		if record != self.__current_index or (self.__current_index >= 0 \
-				and self.current != self.__cached_records[self.__current_index]):
+				and self.current != self.__record_at(self.__current_index)):
 			self.__current_index = record
 			self.__sync(True)
 
@@ -709,7 +838,8 @@ class ResultSet(object):
 		"""
 		if self.__pending is None:
 			for rec in self.__cached_records:
-				if rec.isPending():
+				# dropped records and compact rows are never pending
+				if not isinstance(rec, (_Dropped, tuple)) and rec.isPending():
 					self.__pending = True
 					break
 			if self.__pending is None:
@@ -741,6 +871,11 @@ class ResultSet(object):
 		This method does not change the status of any record, so in case of an
 		exception, it can be just called again.
 
+		If the connection supports it (L{Connection._batch_post_}), changes of
+		records without detail records are collected and written with a single
+		L{Connection.postBatch} call. The commit triggers of these records run
+		before the batch is written, the post commit triggers after it.
+
 		@param fkData: fieldname/value dictionary for foreign key fields. Used
 		    internally for detail resultsets in a master/detail relationship.
 		@raise Exception: if posting the changes to the backend fails for any
@@ -750,12 +885,20 @@ class ResultSet(object):
 		# save current record position
 		currentRecord = self.__current_index
 
+		if self.__connection is not None and self.__connection._batch_post_:
+			batch = _PostBatch(lambda: self.__post_batch(batch, parameters))
+		else:
+			batch = None
+
 		# post our changes
 		try:
 			# we move the cursor along while we post, so triggers see the
 			# posting record as the current record
 			self.__current_index = 0
 			while self.__current_index < len(self.__cached_records):
+				if isinstance(self.__cached_records[self.__current_index], (_Dropped, tuple)):
+					self.__current_index += 1
+					continue
 				self.current = self.__cached_records[self.__current_index]
 				if self.current.isPending() and not self.current.isVoid():
 
@@ -770,10 +913,15 @@ class ResultSet(object):
 							self.current[fieldname] = value
 
 					# write changes to the backend
-					self.current._post(parameters)
+					if batch is not None:
+						batch.index = self.__current_index
+					self.current._post(parameters, batch)
 
 				self.__current_index += 1
 
+			if batch is not None:
+				batch.flush()
+
 		except:
 			# If any error happened on writing to the backend, move the UI to
 			# the record that caused the error
@@ -784,6 +932,32 @@ class ResultSet(object):
 		self.__current_index = currentRecord
 
 
+	# -------------------------------------------------------------------------
+	# Write the changes collected in a batch
+	# -------------------------------------------------------------------------
+
+	def __post_batch(self, batch, parameters):
+
+		if not batch.records:
+			return
+
+		(operations, records) = (batch.operations, batch.records)
+		(batch.operations, batch.records) = ([], [])
+
+		def failed(number):
+			# move the UI to the record that caused the error
+			self.__current_index = records[number][0]
+
+		self.__connection.postBatch(operations, failed)
+
+		index = self.__current_index
+		for (self.__current_index, self.current) in records:
+			self.current._postWritten(parameters)
+		self.__current_index = index
+		if index < len(self.__cached_records):
+			self.current = self.__cached_records[index]
+
+
 	# -------------------------------------------------------------------------
 	# Sync resultset with backend, and sync listeners with resultset
 	# -------------------------------------------------------------------------
@@ -808,28 +982,71 @@ class ResultSet(object):
 		    any reason. The exact exception classes depend on the backend.
 		"""
 
+		# records without details are requeried together after the loop
+		if self.__connection is not None:
+			batch = []
+		else:
+			batch = None
+
 		index = 0
 		while index < len(self.__cached_records):
 			record = self.__cached_records[index]
-			if record._needsRequery(commit):
+			if isinstance(record, (_Dropped, tuple)):
+				index += 1
+			elif record._needsRequery(commit):
 				if ((record.isEmpty() or record.isVoid() \
 							or record.isDeleted()) \
 						and self.__connection is not None):
 					self.__remove_record(index)
 				else:
 					try:
-						record._requery(commit, parameters)
+						record._requery(commit, parameters, batch)
 					except Exceptions.RecordNotFoundError:
 						print "* RecordNotFoundError", index
 						self.__remove_record(index)
 					else:
+						# data differs from the query result now, so the
+						# record can't be dropped and fetched again
+						self.__positions.pop(id(record), None)
 						index += 1
 			else:
 				index += 1
 
+		if batch:
+			self.__requery_batch(batch, parameters)
+
+		# rescan records skipped while they were pending
+		self.__evict_lo = 0
+		self.__evict_hi = len(self.__cached_records) - 1
+
 		self.__sync(False)
 
 
+	# -------------------------------------------------------------------------
+	# Requery a list of records with one call to the backend
+	# -------------------------------------------------------------------------
+
+	def __requery_batch(self, batch, parameters):
+
+		results = self.__connection.requeryBatch(self.__tablename,
+			[wherefields for (record, wherefields) in batch],
+			self.__boundFields, parameters)
+
+		missing = set()
+		for ((record, wherefields), newfields) in zip(batch, results):
+			if newfields is None:
+				missing.add(id(record))
+			else:
+				record._requeried(newfields)
+				self.__positions.pop(id(record), None)
+
+		if missing:
+			for index in range(len(self.__cached_records) - 1, -1, -1):
+				if id(self.__cached_records[index]) in missing:
+					print "* RecordNotFoundError", index
+					self.__remove_record(index)
+
+
 	# -------------------------------------------------------------------------
 	# Merge another ResultSet into this one
 	# -------------------------------------------------------------------------
@@ -859,7 +1076,8 @@ class ResultSet(object):
 		newData = otherResultSet.getDictArray(keyFields, self.__boundFields)
 
 		index = 0
-		for record in self.__cached_records[:]:
+		while index < len(self.__cached_records):
+			record = self.__record_at(index)
 			# FIXED: bug when empty record leaves upon requery. this code is commented out
 			#if record.isEmpty():
 			#	# keep empty record in old ResultSet
@@ -876,6 +1094,7 @@ class ResultSet(object):
 			if d:
 				# Found in newData - update Record
 				record._initialDataFromDict(d)
+				self.__positions.pop(id(self.__cached_records[index]), None)
 				# And set to empty dict to indicate it has been processed
 				d.clear()
 				index += 1
@@ -897,6 +1116,9 @@ class ResultSet(object):
 				record = self.__create_record(initialData = row)
 				self.__record_count += 1
 
+		self.__evict_lo = 0
+		self.__evict_hi = len(self.__cached_records) - 1
+
 		self.__sync(False)
 
 
@@ -954,7 +1176,9 @@ class ResultSet(object):
 		Close the database connection.
 		"""
 
-		self._close_()
+		# A result set never queried has nothing to clean up
+		if self.__lastquery_type is not None:
+			self._close_()
 
 
 	# -------------------------------------------------------------------------
@@ -968,7 +1192,7 @@ class ResultSet(object):
 		if self.__current_index == -1:
 			self.current = None
 		else:
-			self.current = self.__cached_records[self.__current_index]
+			self.current = self.__record_at(self.__current_index)
 
 		# If the current record has *really* changed (this method can be called
 		# for non-changing records after requery or merge) to a new current
@@ -999,11 +1223,150 @@ class ResultSet(object):
 		except StopIteration:
 			return False
 
-		record = self.__create_record(initialData = row)
+		record = self.__new_entry(row)
+		index = len(self.__cached_records)
+		self.__cached_records.append(record)
+		self.__entry_appended(record)
+
+		if self.__window:
+			self.__positions[id(record)] = self.__next_position
+			self.__track(index)
+			self.__evict(index)
+		self.__next_position += 1
+
+		# Compact rows are announced once they are in the cache, so a trigger
+		# changing the view promotes the row at the right index
+		if isinstance(record, tuple) and self.__eventController is not None:
+			self.__eventController.dispatchEvent('dsRecordLoaded',
+				record = self.__view(record, index))
 
 		return True
 
 
+	# -------------------------------------------------------------------------
+	# Get a record from cache, fetching it again if it was dropped
+	# -------------------------------------------------------------------------
+
+	def __record_at(self, index):
+
+		record = self.__cached_records[index]
+		if isinstance(record, _Dropped):
+			self.__reload(index)
+			record = self.__cached_records[index]
+			self.__evict(index)
+		if isinstance(record, tuple):
+			record = self.__view(record, index)
+		return record
+
+	# -------------------------------------------------------------------------
+
+	def __reload(self, index):
+
+		# Fetch a block of records around the requested one, so scrolling in
+		# both directions does not query the backend for every single record
+		count = max(self.__lastquery_cache, self.__window // 2)
+		first = max(0, index - count // 2)
+		dropped = [(i, self.__cached_records[i])
+			for i in xrange(first, min(first + count, len(self.__cached_records)))
+			if isinstance(self.__cached_records[i], _Dropped)]
+
+		rows = self._refetch_(self.__primarykeyFields,
+			[entry.key for (i, entry) in dropped])
+
+		assert gDebug(8, 'Fetched %d of %d records again in %s' % (
+			len(rows), len(dropped), self))
+
+		rows = dict([(self.__row_key(row), row) for row in rows])
+		for (i, entry) in dropped:
+			row = rows.get(entry.key)
+			if row is not None:
+				# the record was loaded before, no dsRecordLoaded again
+				record = self.__new_entry(row, loaded = False)
+				self.__replace_entry(i, record)
+				self.__positions[id(record)] = entry.position
+				self.__track(i)
+
+		if isinstance(self.__cached_records[index], _Dropped):
+			raise Exceptions.RecordNotFoundError
+
+	# -------------------------------------------------------------------------
+
+	def __row_key(self, row):
+
+		return tuple([row.get(field) for field in self.__primarykeyFields])
+
+	# -------------------------------------------------------------------------
+
+	def __entry_key(self, entry):
+
+		if isinstance(entry, tuple):
+			return tuple([entry[self.__columns[field]]
+				for field in self.__primarykeyFields])
+		else:
+			return tuple([entry[field] for field in self.__primarykeyFields])
+
+
+	# -------------------------------------------------------------------------
+	# Drop clean records outside of the window
+	# -------------------------------------------------------------------------
+
+	def __track(self, index):
+
+		if self.__evict_lo > self.__evict_hi:
+			self.__evict_lo = self.__evict_hi = index
+		else:
+			self.__evict_lo = min(self.__evict_lo, index)
+			self.__evict_hi = max(self.__evict_hi, index)
+
+	# -------------------------------------------------------------------------
+
+	def __evict(self, index):
+		"""
+		Replace clean records far from index and from the cursor by markers
+		holding their primary key. Runs only when the tracked range has grown
+		to twice the window, so the cost per fetched record stays constant.
+		"""
+
+		if not self.__window \
+				or self.__evict_hi - self.__evict_lo < 2 * self.__window \
+				or not self.__primarykeyFields \
+				or not self._can_refetch_():
+			return
+
+		keep_lo = index - self.__window // 2
+		keep_hi = index + self.__window // 2
+		lo = hi = None
+
+		for i in xrange(self.__evict_lo, self.__evict_hi + 1):
+			record = self.__cached_records[i]
+			if isinstance(record, _Dropped):
+				continue
+			position = self.__positions.get(id(record))
+			if position is None:
+				# can't be fetched again
+				continue
+			if isinstance(record, tuple):
+				if id(record) in self.__views:
+					# somebody refers to a view of the row
+					continue
+			elif record.isPending() or record.isEmpty():
+				continue
+			if keep_lo <= i <= keep_hi or i == self.__current_index:
+				if lo is None:
+					lo = i
+				hi = i
+				continue
+			del self.__positions[id(record)]
+			self.__replace_entry(i, _Dropped(position, self.__entry_key(record)))
+
+		if lo is None:
+			self.__evict_lo = 0
+			self.__evict_hi = -1
+		else:
+			self.__evict_lo = lo
+			self.__evict_hi = hi
+
+
 	# -------------------------------------------------------------------------
 	# Create a new record in the cache
 	# -------------------------------------------------------------------------
@@ -1011,10 +1374,117 @@ class ResultSet(object):
 	def __create_record(self, initialData = {}, defaultData = {},
 		position = None):
 
+		record = self.__new_record(initialData, defaultData)
+
+		if position is None:
+			self.__cached_records.append(record)
+			self.__entry_appended(record)
+		else:
+			self.__cached_records.insert(position, record)
+			self.__entry_positions = None
+			self.__index_add(record)
+
+			# keep the range of records to drop in sync
+			if position < self.__evict_lo:
+				self.__evict_lo += 1
+			if position <= self.__evict_hi:
+				self.__evict_hi += 1
+
+		return record
+
+	# -------------------------------------------------------------------------
+
+	def __new_entry(self, row, loaded = True):
+		"""
+		Return the cache entry for a row fetched from the backend: a tuple for
+		compact ResultSets, a Record otherwise. dsRecordLoaded for compact rows
+		is dispatched by the caller after the row has been cached.
+
+		@param loaded: dispatch dsRecordLoaded, False for rows fetched again
+		"""
+
+		values = self.__compact_row(row)
+		if values is None:
+			return self.__new_record(initialData = row, notifyLoaded = loaded)
+		return values
+
+	# -------------------------------------------------------------------------
+
+	def __compact_row(self, row):
+
+		if not self.__compact:
+			return None
+
+		if self.__columns is None:
+			self.__columns = dict([(name, i) for (i, name) in enumerate(row.keys())])
+		elif len(row) != len(self.__columns):
+			return None
+
+		values = [None] * len(self.__columns)
+		try:
+			for (name, value) in row.iteritems():
+				values[self.__columns[name]] = value
+		except KeyError:
+			# row with other fields, keep a full record
+			return None
+		return tuple(values)
+
+	# -------------------------------------------------------------------------
+
+	def __view(self, values, index):
+
+		view = self.__views.get(id(values))
+		if view is None:
+			view = CompactRecord(self, self.__columns, values, index)
+			self.__views[id(values)] = view
+		return view
+
+	# -------------------------------------------------------------------------
+
+	def _promoteRow(self, values, index):
+		"""
+		Replace a compact row by a full Record. Called by L{CompactRecord}
+		before the first change.
+
+		@param values: The row tuple.
+		@param index: Position of the row when the view was created.
+		@return: The new L{Record.Record} instance.
+		"""
+
+		record = self.__new_record(
+			initialData  = dict([(name, values[i]) for (name, i) in self.__columns.iteritems()]),
+			notifyLoaded = False)
+
+		if index >= len(self.__cached_records) \
+				or self.__cached_records[index] is not values:
+			# rows have been inserted or removed since the view was created
+			try:
+				index = self.__position_of(values)
+			except KeyError:
+				# the row has been removed, the record is detached
+				return record
+
+		self.__replace_entry(index, record)
+		position = self.__positions.pop(id(values), None)
+		if position is not None:
+			self.__positions[id(record)] = position
+
+		if self.__indexes:
+			for recordIndex in self.__indexes.values():
+				recordIndex.remove(values)
+			self.__index_add(record)
+
+		return record
+
+	# -------------------------------------------------------------------------
+
+	def __new_record(self, initialData = {}, defaultData = {},
+		notifyLoaded = True):
+
 		__defaultData = self.__defaultData.copy()
 		__defaultData.update(defaultData)
 
-		record = Record(self,
+		return Record(self,
 			initialData      = initialData,
 			defaultData      = __defaultData,
 			connection       = self.__connection,
@@ -1026,14 +1496,101 @@ class ResultSet(object):
 			requery          = self.__requery,
 			access           = self.__access,
 			details          = self.__details,
-			eventController  = self.__eventController)
+			eventController  = self.__eventController,
+			notifyLoaded     = notifyLoaded)
 
-		if position is None:
-			self.__cached_records.append(record)
+
+	# -------------------------------------------------------------------------
+	# Hash indexes for findRecord
+	# -------------------------------------------------------------------------
+
+	def __index_for(self, fields):
+
+		if self.__indexes is None:
+			return None
+
+		fields = tuple(sorted(fields))
+		index = self.__indexes.get(fields)
+		if index is None:
+			index = self.__indexes[fields] = _RecordIndex(fields)
+			for entry in self.__cached_records:
+				self.__index_add(entry, [index])
+				if self.__indexes is None:
+					return None
+		return index
+
+	# -------------------------------------------------------------------------
+
+	def __index_key(self, entry, fields):
+
+		if isinstance(entry, tuple):
+			columns = self.__columns
+			return tuple([entry[columns[field]] if field in columns else None
+				for field in fields])
 		else:
-			self.__cached_records.insert(position, record)
+			return tuple([entry[field] for field in fields])
 
-		return record
+	# -------------------------------------------------------------------------
+
+	def __index_add(self, entry, indexes = None):
+
+		if not self.__indexes:
+			return
+
+		for index in indexes or self.__indexes.values():
+			try:
+				index.add(entry, self.__index_key(entry, index.fields))
+			except TypeError:
+				# unhashable field value, search sequentially from now on
+				self.__indexes = None
+				return
+
+	# -------------------------------------------------------------------------
+
+	def __entry_appended(self, entry):
+
+		if self.__entry_positions is not None:
+			self.__entry_positions[id(entry)] = len(self.__cached_records) - 1
+		self.__index_add(entry)
+
+	# -------------------------------------------------------------------------
+
+	def __replace_entry(self, index, entry):
+
+		if self.__entry_positions is not None:
+			self.__entry_positions.pop(id(self.__cached_records[index]), None)
+			self.__entry_positions[id(entry)] = index
+		self.__cached_records[index] = entry
+
+	# -------------------------------------------------------------------------
+
+	def __position_of(self, entry):
+
+		if self.__entry_positions is None:
+			self.__entry_positions = dict([(id(e), i)
+				for (i, e) in enumerate(self.__cached_records)])
+		return self.__entry_positions[id(entry)]
+
+	# -------------------------------------------------------------------------
+
+	def _recordChanged(self, record, fieldnames):
+		"""
+		Update the indexes after field values of a record changed. Called by
+		L{Record.Record}.
+
+		@param record: The changed record.
+		@param fieldnames: Names of the changed fields.
+		"""
+
+		if not self.__indexes:
+			return
+
+		for index in self.__indexes.values():
+			if index.covers(fieldnames) and record in index:
+				index.remove(record)
+				self.__index_add(record, [index])
+				if self.__indexes is None:
+					return
 
 
 	# -------------------------------------------------------------------------
@@ -1042,9 +1599,20 @@ class ResultSet(object):
 
 	def __remove_record(self, index):
 
-		self.__cached_records.pop(index)
+		record = self.__cached_records.pop(index)
+		self.__positions.pop(id(record), None)
 		self.__record_count -= 1
 
+		self.__entry_positions = None
+		if self.__indexes:
+			for recordIndex in self.__indexes.values():
+				recordIndex.remove(record)
+
+		if index < self.__evict_lo:
+			self.__evict_lo -= 1
+		if index <= self.__evict_hi:
+			self.__evict_hi -= 1
+
 		# if a record preceding the cursor position was deleted, move cursor
 		# position along
 		if index <= self.__current_index:
@@ -1069,6 +1637,7 @@ class ResultSet(object):
 		Parameters depend on the type of query (object/sql).
 		"""
 		self.__static_data = data
+		self.__static_index = None
 
 	# -------------------------------------------------------------------------
 
@@ -1098,6 +1667,81 @@ class ResultSet(object):
 
 	# -------------------------------------------------------------------------
 
+	def _can_refetch_(self):
+		"""
+		Return True if L{_refetch_} can be used for the last query.
+
+		Records are only dropped from memory if they can be fetched again.
+		"""
+		return self.__lastquery_type == 'static'
+
+	# -------------------------------------------------------------------------
+
+	def _refetch_(self, keyfields, keys):
+		"""
+		Fetch records of the query again by primary key.
+
+		Descendants supporting this must overwrite this function and
+		L{_can_refetch_}.
+
+		@param keyfields: Names of the primary key fields.
+		@param keys: List of tuples of primary key values.
+		@return: A list of fieldname/value dictionaries in any order. Records
+		    not found any more are missing.
+		"""
+		if self.__static_index is None:
+			self.__static_index = dict([
+				(tuple([row.get(field) for field in keyfields]), row)
+				for row in self.__static_data])
+		return [self.__static_index[key] for key in keys
+			if key in self.__static_index]
+
+	# -------------------------------------------------------------------------
+
+	def _can_aggregate_(self):
+		"""
+		Return True if L{_aggregate_} can be used for the last query.
+
+		Descendants supporting this must overwrite this function and
+		L{_aggregate_}.
+		"""
+		return self.__lastquery_type == 'static'
+
+	# -------------------------------------------------------------------------
+
+	def _aggregate_(self, function, fieldname, exclude):
+		"""
+		Calculate an aggregate over all records of the query.
+
+		@param function: One of 'sum', 'count', 'min' or 'max'.
+		@param fieldname: Field to aggregate, None to count records.
+		@param exclude: List of primary key value tuples of records to leave out.
+		@return: The aggregate value.
+		"""
+		rows = self.__static_data
+		if exclude:
+			exclude = set(exclude)
+			rows = [row for row in rows if tuple([row.get(field) for field in
+				self.__primarykeyFields]) not in exclude]
+
+		if fieldname is None:
+			return len(rows)
+
+		values = [row.get(fieldname) for row in rows]
+		values = [value for value in values if value is not None]
+		if function == 'count':
+			return len(values)
+		elif not values:
+			return None
+		elif function == 'sum':
+			return reduce(lambda r, x: r + x, values)
+		elif function == 'min':
+			return min(values)
+		else:
+			return max(values)
+
+	# -------------------------------------------------------------------------
+
 	def _close_(self):
 		"""
 		Close the cursor.
@@ -1106,3 +1750,169 @@ class ResultSet(object):
 		_query_ functions.
 		"""
 		pass
+
+
+# =============================================================================
+# Record dropped from the window
+# =============================================================================
+
+class _Dropped(object):
+	"""
+	Cache entry of a record dropped from the record window.
+	"""
+
+	__slots__ = ('position', 'key')
+
+	def __init__(self, position, key):
+
+		self.position = position	# position in the query result
+		self.key = key				# tuple of primary key values
+
+
+# =============================================================================
+# Changes collected by ResultSet.post
+# =============================================================================
+
+class _PostBatch(object):
+	"""
+	Changes of records to be written with one L{Connection.postBatch} call.
+	Records add themselves in L{Record._post} and call L{flush} before they
+	write anything themselves.
+	"""
+
+	def __init__(self, flush):
+
+		self.flush = flush
+		self.index = None			# cache index of the posting record
+		self.operations = []
+		self.records = []			# (index, record) for every operation
+
+	# -------------------------------------------------------------------------
+
+	def append(self, operation, record):
+		self.operations.append(operation)
+		self.records.append((self.index, record))
+
+
+# =============================================================================
+# Hash index of cached records
+# =============================================================================
+
+class _RecordIndex(object):
+	"""
+	Cache entries (records or compact rows) of a ResultSet by the values of a
+	tuple of fields, in cache order.
+	"""
+
+	def __init__(self, fields):
+
+		self.fields = fields
+		self.__entries = {}			# key -> list of entries
+		self.__keys = {}			# id(entry) -> key
+
+	# -------------------------------------------------------------------------
+
+	def __contains__(self, entry):
+		return id(entry) in self.__keys
+
+	# -------------------------------------------------------------------------
+
+	def covers(self, fieldnames):
+		for field in fieldnames:
+			if field in self.fields:
+				return True
+		return False
+
+	# -------------------------------------------------------------------------
+
+	def get(self, key):
+		return self.__entries.get(key)
+
+	# -------------------------------------------------------------------------
+
+	def add(self, entry, key):
+		self.__entries.setdefault(key, []).append(entry)
+		self.__keys[id(entry)] = key
+
+	# -------------------------------------------------------------------------
+
+	def remove(self, entry):
+		key = self.__keys.pop(id(entry), None)
+		entries = self.__entries.get(key)
+		if entries is None:
+			return
+		for (i, e) in enumerate(entries):
+			if e is entry:
+				del entries[i]
+				break
+		if not entries:
+			del self.__entries[key]
+
+
+# =============================================================================
+# Memory benchmark for compact read only ResultSets
+# =============================================================================
+
+if __name__ == '__main__':
+
+	import sys
+	import __builtin__
+
+	if not __builtin__.__dict__.has_key('gDebug'):
+		__builtin__.__dict__['gDebug'] = lambda *args: True
+
+	class EventController:
+		def dispatchEvent(self, event, **params):
+			pass
+
+	def sizeof(obj, seen):
+		"""
+		Bytes of the containers and records reachable from obj, field values
+		are shared with the source rows and not counted.
+		"""
+		if id(obj) in seen or isinstance(obj, (basestring, int, long, float,
+				type(None), ResultSet, EventController)):
+			return 0
+		seen.add(id(obj))
+		size = sys.getsizeof(obj)
+		if isinstance(obj, dict):
+			for (key, value) in obj.iteritems():
+				size += sizeof(key, seen) + sizeof(value, seen)
+		elif isinstance(obj, (list, tuple, set)):
+			for item in obj:
+				size += sizeof(item, seen)
+		elif isinstance(obj, weakref.ProxyTypes):
+			pass
+		elif hasattr(obj, '__dict__'):
+			size += sizeof(obj.__dict__, seen)
+		return size
+
+	rows = 100000
+	fields = ['field%d' % i for i in xrange(10)]
+	data = [dict([(name, i * 10 + j) for (j, name) in enumerate(fields)])
+		for i in xrange(rows)]
+
+	for compact in (False, True):
+		resultset = ResultSet(boundFields = fields, access = ACCESS.NONE,
+			eventController = EventController())
+		resultset._ResultSet__compact = compact
+		resultset.query('static', 5, data = data)
+		resultset.lastRecord()
+
+		size = sizeof(resultset._ResultSet__cached_records, set())
+		print "compact=%-5s %d rows x %d fields: %.1f MB, %d bytes/row" % (
+			compact, rows, len(fields), size / 1048576.0, size / rows)
+
+	# changes of ON-RECORDLOADED triggers are kept in the cache
+	class LoadedController(EventController):
+		def dispatchEvent(self, event, **params):
+			if event == 'dsRecordLoaded':
+				params['record']['field1'] = -1
+
+	resultset = ResultSet(boundFields = fields, access = ACCESS.NONE,
+		eventController = LoadedController())
+	resultset.query('static', 5, data = data[:100])
+	resultset.lastRecord()
+	assert [record['field1'] for record in resultset] == [-1] * 100
+
+	print "Thank you for playing."
@@ -31,8 +31,12 @@ __all__ = ['Connection']
 import sys
 import datetime
 import decimal
+import re
+import threading
 import time
 
+from collections import OrderedDict
+
 from gnue.common.datasources import Exceptions
 from gnue.common.datasources.drivers import Base
 
@@ -63,6 +67,15 @@ class Connection (Base.Connection):
 	  module does not return a correct value for cursor.rowcount.
 	@cvar _named_as_sequence_: If paramstyle = 'named' pass parameters as
 	  sequence (True) or as mapping (False). Can be overwritten by descendants.
+	@cvar _named_cursors_: Can be set to True by descendants if the DBSIG2
+	  module supports scrollable server side cursors created with a name (see
+	  L{_named_cursor_}). ResultSets with a record window use them to stream
+	  records.
+	@cvar _batch_post_: Can be set to True by descendants if the backend
+	  understands SAVEPOINT, ROLLBACK TO SAVEPOINT and RELEASE SAVEPOINT as well
+	  as INSERT statements with several rows of VALUES. Changes of records are
+	  then written in batches of up to L{_batch_size_} rows per statement.
+	@cvar _batch_size_: Maximum number of rows written by one batch statement.
 	@cvar _std_datetime_: If True, the driver will use python's (2.3+) datetime
 	  types for time and timestamp values. If so, the constructors Timestamp and
 	  Time will be called with an extra argument for microseconds.
@@ -80,8 +93,9 @@ class Connection (Base.Connection):
 	# of fetchmany () because the open
 	# cursor will not survive a commit?
 	_named_as_sequence_ = False           # Pass 'named' parameters as sequence
+	_named_cursors_     = False           # Server side cursors with cursor(name)?
 	_std_datetime_      = False
-
+	_batch_size_        = 100             # Rows per statement in batched posts
 
 	# ---------------------------------------------------------------------------
 	# Constructor
@@ -140,14 +154,7 @@ class Connection (Base.Connection):
 	# ---------------------------------------------------------------------------
 
 	def _update_ (self, table, oldfields, newfields):
-		(where, parameters) = self.__where (oldfields)
-		updates = []
-		for (field, value) in newfields.items ():
-			key = 'new_' + field
-			updates.append ("%s=%%(%s)s" % (field, key))
-			parameters [key] = value
-		statement = "UPDATE %s SET %s WHERE %s" % (table, ', '.join (updates),
-			where)
+		(statement, parameters) = self.__update (table, oldfields, newfields)
 		self.sql0 (statement, parameters)
 
 	# ---------------------------------------------------------------------------
@@ -159,25 +166,100 @@ class Connection (Base.Connection):
 
 	# ---------------------------------------------------------------------------
 
+	def _postBatch_ (self, operations, failed):
+
+		# Backends without SAVEPOINT and drivers with their own way to write
+		# (e.g. stored procedures) get every operation written by itself
+		if not self._batch_post_ or self.__customPost ():
+			return Base.Connection._postBatch_ (self, operations, failed)
+
+		# Consecutive operations with the same statement are written together.
+		# The order of the operations is kept, so a row can be deleted and
+		# inserted again with the same unique key.
+		indexes = []
+		last = None
+		for (index, (operation, table, oldfields, newfields)) in \
+				enumerate (operations):
+			key = (operation, table,
+				tuple (sorted ((newfields or {}).keys ())),
+				tuple ([(field, value is None) for (field, value) in
+					sorted ((oldfields or {}).items ())]))
+			if key != last or len (indexes) >= self._batch_size_:
+				if indexes:
+					self.__postGroup (operations, indexes, failed)
+				indexes = []
+				last = key
+			indexes.append (index)
+
+		if indexes:
+			self.__postGroup (operations, indexes, failed)
+
+	# ---------------------------------------------------------------------------
+
 	def _requery_ (self, table, oldfields, fields, parameters):
 		(where, parameters) = self.__where (oldfields, parameters)
 		statement = "SELECT %s FROM %s WHERE %s" % (', '.join (fields), table,
 			where)
 		rows = self.sql (statement, parameters)
 		if len (rows):
-			row = rows [0]
-			result = {}
-			for i in range (len (fields)):
-				if isinstance (row [i], str):
-					result [fields [i]] = unicode (row [i], self._encoding)
-				else:
-					result [fields [i]] = row [i]
-			return result
+			return self.__rowdict (fields, rows [0])
 		else:
 			raise Exceptions.RecordNotFoundError
 
 	# ---------------------------------------------------------------------------
 
+	def _requeryBatch_ (self, table, oldfieldsList, fields, parameters):
+
+		# Drivers with their own way to requery (e.g. stored procedures) get it
+		# called for every record
+		if self.__class__._requery_.im_func is not Connection._requery_.im_func:
+			return Base.Connection._requeryBatch_ (self, table, oldfieldsList,
+				fields, parameters)
+
+		keyfields = sorted (oldfieldsList [0].keys ())
+		columns = fields + [field for field in keyfields if field not in fields]
+
+		found = {}
+		for start in range (0, len (oldfieldsList), self._batch_size_):
+			chunk = oldfieldsList [start:start + self._batch_size_]
+			params = {}
+			if len (keyfields) == 1:
+				keys = []
+				for (number, oldfields) in enumerate (chunk):
+					key = 'old%d_%s' % (number, keyfields [0])
+					keys.append ('%%(%s)s' % key)
+					params [key] = oldfields.get (keyfields [0])
+				where = '%s IN (%s)' % (keyfields [0], ', '.join (keys))
+			else:
+				conditions = []
+				for (number, oldfields) in enumerate (chunk):
+					(condition, params) = self.__where (oldfields, params,
+						'old%d_' % number)
+					conditions.append ('(%s)' % condition)
+				where = ' OR '.join (conditions)
+			statement = "SELECT %s FROM %s WHERE %s" % (', '.join (columns), table,
+				where)
+			for row in self.sql (statement, params):
+				record = self.__rowdict (columns, row)
+				found [tuple ([record [field] for field in keyfields])] = \
+					dict ([(field, record [field]) for field in fields])
+
+		result = []
+		for oldfields in oldfieldsList:
+			key = tuple ([oldfields.get (field) for field in keyfields])
+			if key in found:
+				result.append (found [key])
+			else:
+				# Key values may differ in type from the values read, so make sure
+				try:
+					result.append (self._requery_ (table, oldfields, fields,
+						parameters))
+				except Exceptions.RecordNotFoundError:
+					result.append (None)
+		return result
+
+	# ---------------------------------------------------------------------------
+
 	def _commit_ (self):
 		assert gDebug (3, 'DBSIG2 Commit')
 		while True:
@@ -213,7 +295,7 @@ class Connection (Base.Connection):
 	# Build WHERE-Clause based on a dictionary of fieldname/value pairs
 	# ---------------------------------------------------------------------------
 
-	def __where (self, oldfields, parameters=None):
+	def __where (self, oldfields, parameters=None, prefix='old_'):
 
 		where = []
 		if parameters is None:
@@ -222,13 +304,126 @@ class Connection (Base.Connection):
 			if value is None:
 				where.append ("%s IS NULL" % field)
 			else:
-				key = 'old_' + field
+				key = prefix + field
 				where.append ("%s=%%(%s)s" % (field, key))
 				parameters [key] = value
 
 		return (' AND '.join (where), parameters)
 
 
+	# ---------------------------------------------------------------------------
+	# Fieldname/value dictionary of a result row
+	# ---------------------------------------------------------------------------
+
+	def __rowdict (self, fields, row):
+
+		result = {}
+		for i in range (len (fields)):
+			if isinstance (row [i], str):
+				result [fields [i]] = unicode (row [i], self._encoding)
+			else:
+				result [fields [i]] = row [i]
+		return result
+
+
+	# ---------------------------------------------------------------------------
+	# Build UPDATE statement for a record
+	# ---------------------------------------------------------------------------
+
+	def __update (self, table, oldfields, newfields):
+
+		(where, parameters) = self.__where (oldfields)
+		updates = []
+		for (field, value) in newfields.items ():
+			key = 'new_' + field
+			updates.append ("%s=%%(%s)s" % (field, key))
+			parameters [key] = value
+		statement = "UPDATE %s SET %s WHERE %s" % (table, ', '.join (updates),
+			where)
+		return (statement, parameters)
+
+
+	# ---------------------------------------------------------------------------
+	# Test if a descendant writes records in its own way
+	# ---------------------------------------------------------------------------
+
+	def __customPost (self):
+
+		for name in ('_insert_', '_update_', '_delete_'):
+			if getattr (self.__class__, name).im_func is not \
+					getattr (Connection, name).im_func:
+				return True
+		return False
+
+
+	# ---------------------------------------------------------------------------
+	# Write a group of operations with the same statement
+	# ---------------------------------------------------------------------------
+
+	def __postGroup (self, operations, indexes, failed):
+
+		def single (index):
+			if failed is not None:
+				failed (indexes [index])
+
+		group = [operations [index] for index in indexes]
+		if len (group) == 1:
+			Base.Connection._postBatch_ (self, group, single)
+			return
+
+		(operation, table) = group [0][:2]
+
+		self.sql0 ('SAVEPOINT gnue_batch')
+		try:
+			if operation == 'insert':
+				self.__insertRows (table, [op [3] for op in group])
+			elif operation == 'update':
+				statement = self.__update (table, group [0][2], group [0][3])[0]
+				self.__executemany (statement,
+					[self.__update (table, op [2], op [3])[1] for op in group])
+			else:
+				self.__deleteRows (table, [op [2] for op in group])
+
+		except Exception:
+			# Write the records one by one, so the failing one can be told
+			self.sql0 ('ROLLBACK TO SAVEPOINT gnue_batch')
+			Base.Connection._postBatch_ (self, group, single)
+
+		else:
+			self.sql0 ('RELEASE SAVEPOINT gnue_batch')
+
+	# ---------------------------------------------------------------------------
+
+	def __insertRows (self, table, rows):
+
+		fields = sorted (rows [0].keys ())
+		values = []
+		parameters = {}
+		for (number, newfields) in enumerate (rows):
+			keys = []
+			for field in fields:
+				key = 'new%d_%s' % (number, field)
+				keys.append ('%%(%s)s' % key)
+				parameters [key] = newfields [field]
+			values.append ('(%s)' % ', '.join (keys))
+		statement = "INSERT INTO %s (%s) VALUES %s" % (table, ', '.join (fields),
+			', '.join (values))
+		self.sql0 (statement, parameters)
+
+	# ---------------------------------------------------------------------------
+
+	def __deleteRows (self, table, rows):
+
+		conditions = []
+		parameters = {}
+		for (number, oldfields) in enumerate (rows):
+			(where, parameters) = self.__where (oldfields, parameters,
+				'old%d_' % number)
+			conditions.append ('(%s)' % where)
+		statement = 'DELETE FROM %s WHERE %s' % (table, ' OR '.join (conditions))
+		self.sql0 (statement, parameters)
+
+
 	# ---------------------------------------------------------------------------
 	# Execute the given SQL statement and return the result matrix
 	# ---------------------------------------------------------------------------
@@ -322,7 +517,7 @@ class Connection (Base.Connection):
 	# Create a new DBSIG2 cursor object and execute the given SQL statement
 	# ---------------------------------------------------------------------------
 
-	def makecursor (self, statement, parameters = None):
+	def makecursor (self, statement, parameters = None, name = None):
 		"""
 		Create a new DBSIG2 cursor object and execute the given SQL statement.
 
@@ -331,6 +526,9 @@ class Connection (Base.Connection):
 		@param parameters: A dictionary with the parameter values. The values of
 		  the dictionary can be 8-bit strings, unicode strings, integer or floating
 		  point numbers, booleans or datetime values.
+		@param name: If given and the driver supports server side cursors, the
+		  statement is executed in a server side cursor with this name, and rows
+		  are transferred only when fetched.
 		@return: A DBSIG2 cursor object holding the result of the query.
 		"""
 		assert gDebug('sql', statement % dict(((k, pythonConstToSql(v)) for k, v in (parameters or {}).iteritems())))
@@ -343,33 +541,7 @@ class Connection (Base.Connection):
 				checktype (parameters_key, basestring)
 		# checktype (parameters_value, .....) -- too many valid types :-)
 
-		# Convert to encoded string for database
-		if isinstance (statement, unicode):
-			s = statement.encode (self._encoding)
-		else:
-			s = statement
-
-		if parameters:
-			assert gDebug('sql', "query parameters:\n" + '\n'.join(("\t%-24s = %s" % (k, pythonConstToSql(parameters[k])) for k in sorted(parameters.keys()))))
-
-			# convert parameter dictionary to encoded strings
-			p = {}
-			for (key, value) in parameters.items ():
-				if isinstance (key, unicode):
-					k = key.encode (self._encoding)
-				else:
-					k = key
-				p [k] = self.make_parameter (value)
-
-			# assert gDebug('sql', "ENCODED query parameters:\n" + '\n'.join(("\t%-24s = %s (%s)" % (k, repr(p[k]), type(p[k])) for k in sorted(p.keys()))))
-
-			# Convert parameters into correct style
-			paramstyle = self._driver.paramstyle
-			if paramstyle != 'pyformat':
-				(s, p) = getattr (self, '_Connection__param_' + paramstyle) (s, p)
-
-		else:
-			p = None
+		(s, p) = self.__prepare (statement, parameters)
 
 		assert gDebug (3, "DBSIG2 Statement: %s" % s)
 		assert gDebug (3, "DBSIG2 Parameters: %s" % p)
@@ -378,7 +550,10 @@ class Connection (Base.Connection):
 
 		while True:
 			# Create DBSIG2 cursor and execute statement
-			cursor = self._native.cursor ()
+			if name is not None and self._named_cursors_:
+				cursor = self._named_cursor_ (name)
+			else:
+				cursor = self._native.cursor ()
 			try:
 				if p is not None:
 					cursor.execute (s, p)
@@ -412,6 +587,77 @@ class Connection (Base.Connection):
 		return cursor
 
 
+	# ---------------------------------------------------------------------------
+	# Execute a statement once for every set of parameters
+	# ---------------------------------------------------------------------------
+
+	def __executemany (self, statement, parameterlist):
+
+		assert gDebug (3, "DBSIG2 Statement (%d times): %s" % (len (parameterlist),
+			statement))
+
+		prepared = [self.__prepare (statement, parameters)
+			for parameters in parameterlist]
+		s = prepared [0][0]
+		p = [parameters for (x, parameters) in prepared]
+
+		while True:
+			cursor = self._native.cursor ()
+			try:
+				self._executemany_ (cursor, s, p)
+			except self._driver.DatabaseError:
+				error = self.decorateError(Exceptions.ConnectionError(self._getExceptionMessage(), statement, parameterlist [0]))
+				cursor.close ()
+				if error is None:
+					continue # retry
+				raise error
+			except:
+				cursor.close ()
+				raise
+			else:
+				cursor.close ()
+				break
+
+
+	# ---------------------------------------------------------------------------
+	# Encode statement and parameters and convert them to the paramstyle
+	# ---------------------------------------------------------------------------
+
+	def __prepare (self, statement, parameters):
+
+		# Convert to encoded string for database
+		if isinstance (statement, unicode):
+			s = statement.encode (self._encoding)
+		else:
+			s = statement
+
+		if parameters:
+			assert gDebug('sql', "query parameters:\n" + '\n'.join(("\t%-24s = %s" % (k, pythonConstToSql(parameters[k])) for k in sorted(parameters.keys()))))
+
+			# convert parameter dictionary to encoded strings
+			p = {}
+			for (key, value) in parameters.items ():
+				if isinstance (key, unicode):
+					k = key.encode (self._encoding)
+				else:
+					k = key
+				p [k] = self.make_parameter (value)
+
+			# assert gDebug('sql', "ENCODED query parameters:\n" + '\n'.join(("\t%-24s = %s (%s)" % (k, repr(p[k]), type(p[k])) for k in sorted(p.keys()))))
+
+			# Convert parameters into correct style
+			paramstyle = self._driver.paramstyle
+			if paramstyle != 'pyformat':
+				(s, names) = statementcache.get (s, paramstyle)
+				if paramstyle != 'named' or (self._named_as_sequence_ and names):
+					p = [p [name] for name in names]
+
+		else:
+			p = None
+
+		return (s, p)
+
+
 	# ---------------------------------------------------------------------------
 	# Convert type into what the DBSIG2 driver wants as parameter
 	# ---------------------------------------------------------------------------
@@ -474,96 +720,43 @@ class Connection (Base.Connection):
 
 
 	# ---------------------------------------------------------------------------
-	# Change SQL statement and parameters to different paramstyles
-	# ---------------------------------------------------------------------------
-
-	# All these functions receive the statement and the params in pyformat style
-	# and convert to whatever style is needed (according to function name).
-	# One of these functions get called in makecursor.
-
-	def __param_qmark (self, statement, parameters):
-		s = statement
-		l = []
-		while True:
-			start = s.find ('%(')
-			if start == -1:
-				break
-			end = s.find (')s', start)
-			if end == -1:
-				break
-			key = s [start+2:end]
-			s = s [:start] + '?' + s [end+2:]
-			l.append (parameters [key])
-		return (s, l)
-
-	# ---------------------------------------------------------------------------
-
-	def __param_numeric (self, statement, parameters):
-		s = statement
-		l = []
-		i = 0
-		while True:
-			start = s.find ('%(')
-			if start == -1:
-				break
-			end = s.find (')s', start)
-			if end == -1:
-				break
-			i += 1
-			key = s [start+2:end]
-			s = s [:start] + (':%d' % i) + s [end+2:]
-			l.append (parameters [key])
-		return (s, l)
-
+	# Virtual methods to be implemented by descendants
 	# ---------------------------------------------------------------------------
 
-	def __param_named (self, statement, parameters):
-		s = statement
-		values = []
-		while True:
-			start = s.find ('%(')
-			if start == -1:
-				break
-			end = s.find (')s', start)
-			if end == -1:
-				break
-			key = s [start+2:end]
-			s = s [:start] + (':%s' % key) + s [end+2:]
-			values.append (parameters [key])
+	def _getConnectParams_ (self, connectData):
+		"""
+		Return a tuple with a list and a dictionary, being the parameters and
+		keyword arguments to be passed to the connection function of the DBSIG2
+		driver.
 
-		return (s, self._named_as_sequence_ and values or parameters)
+		This method must be overwritten by all descendants.
+		"""
+		return ([], {})
 
 	# ---------------------------------------------------------------------------
 
-	def __param_format (self, statement, parameters):
-		s = statement
-		l = []
-		while True:
-			start = s.find ('%(')
-			if start == -1:
-				break
-			end = s.find (')s', start)
-			if end == -1:
-				break
-			key = s [start+2:end]
-			s = s [:start] + '%s' + s [end+2:]
-			l.append (parameters [key])
-		return (s, l)
+	def _named_cursor_ (self, name):
+		"""
+		Create a scrollable server side cursor. Only called if L{_named_cursors_}
+		is True.
 
+		@param name: Name of the cursor, unique within the connection.
+		@return: A DBSIG2 cursor object.
+		"""
+		return self._native.cursor (name)
 
-	# ---------------------------------------------------------------------------
-	# Virtual methods to be implemented by descendants
 	# ---------------------------------------------------------------------------
 
-	def _getConnectParams_ (self, connectData):
+	def _executemany_ (self, cursor, statement, parameters):
 		"""
-		Return a tuple with a list and a dictionary, being the parameters and
-		keyword arguments to be passed to the connection function of the DBSIG2
-		driver.
+		Execute a statement for a list of parameter sets. Used to write batches
+		of updates if L{_batch_post_} is True.
 
-		This method must be overwritten by all descendants.
+		@param cursor: A DBSIG2 cursor object.
+		@param statement: The statement, already converted to the paramstyle.
+		@param parameters: List of parameter sets in the paramstyle.
 		"""
-		return ([], {})
+		cursor.executemany (statement, parameters)
 
 	# ---------------------------------------------------------------------------
 
@@ -652,6 +845,103 @@ class Connection (Base.Connection):
 		
 	    
 
+# =============================================================================
+# Cache of statements converted to the paramstyle of the driver
+# =============================================================================
+
+class StatementCache:
+	"""
+	Least recently used cache of statements converted from pyformat to another
+	paramstyle, together with the parameter names in order of appearance.
+	"""
+
+	# %(name)s placeholders
+	__PLACEHOLDER = re.compile (r'%\((.*?)\)s', re.DOTALL)
+
+	# ---------------------------------------------------------------------------
+	# Constructor
+	# ---------------------------------------------------------------------------
+
+	def __init__ (self, max_size = 1000):
+
+		self.max_size = max_size
+		self.__statements = OrderedDict ()	# (statement, paramstyle) -> result
+		self.__lock = threading.Lock ()
+
+
+	# ---------------------------------------------------------------------------
+	# Converted statement
+	# ---------------------------------------------------------------------------
+
+	def get (self, statement, paramstyle):
+		"""
+		Return the statement converted to the paramstyle and the list of the
+		parameter names in the order the converted statement expects them.
+
+		@param statement: Encoded statement with %(name)s placeholders.
+		@param paramstyle: One of 'qmark', 'numeric', 'named' and 'format'.
+		"""
+
+		key = (statement, paramstyle)
+
+		self.__lock.acquire ()
+		try:
+			result = self.__statements.pop (key, None)
+			if result is not None:
+				self.__statements [key] = result
+				return result
+		finally:
+			self.__lock.release ()
+
+		result = self.__convert (statement, paramstyle)
+
+		self.__lock.acquire ()
+		try:
+			self.__statements [key] = result
+			while len (self.__statements) > self.max_size:
+				self.__statements.popitem (last = False)
+		finally:
+			self.__lock.release ()
+
+		return result
+
+	# ---------------------------------------------------------------------------
+
+	def clear (self):
+
+		self.__lock.acquire ()
+		try:
+			self.__statements.clear ()
+		finally:
+			self.__lock.release ()
+
+
+	# ---------------------------------------------------------------------------
+	# Convert a statement
+	# ---------------------------------------------------------------------------
+
+	def __convert (self, statement, paramstyle):
+
+		names = []
+
+		def replace (match):
+			names.append (match.group (1))
+			if paramstyle == 'qmark':
+				return '?'
+			elif paramstyle == 'numeric':
+				return ':%d' % len (names)
+			elif paramstyle == 'named':
+				return ':' + match.group (1)
+			else:
+				return '%s'
+
+		return (self.__PLACEHOLDER.sub (replace, statement), names)
+
+
+#: The cache used by all DBSIG2 connections of the process
+statementcache = StatementCache ()
+
+
 PYTYPE2SQLCONV = {
 	type(None)        : lambda x: 'null',
 	bool              : lambda x: 'true' if x else 'false',
@@ -683,7 +973,49 @@ def sorted(l):
 	return l
 
 
+# =============================================================================
+# Benchmark of makecursor on the sqlite3 module (qmark paramstyle)
+# =============================================================================
+
 if __name__ == '__main__':
 	print pythonConstToSql(['zzz', 'qqq'])
 	print pythonConstToSql([1,2,3L])
 
+	import __builtin__
+	import sqlite3
+
+	for name in ('gDebug', 'gEnter', 'gLeave'):
+		if not __builtin__.__dict__.has_key(name):
+			__builtin__.__dict__[name] = lambda *args: True
+	if not __builtin__.__dict__.has_key('checktype'):
+		__builtin__.__dict__['checktype'] = lambda *args: None
+
+	class SqliteConnection(Connection):
+		_drivername_ = 'sqlite3'
+
+		def __init__(self):
+			# no connection manager needed to run statements
+			self._driver = sqlite3
+			self._native = sqlite3.connect(':memory:')
+			self._encoding = 'utf-8'
+
+	connection = SqliteConnection()
+	fields = ['field%02d' % i for i in range(30)]
+	connection.sql0('CREATE TABLE bench (id INTEGER, %s)' % ', '.join(fields))
+
+	statement = 'INSERT INTO bench (id, %s) VALUES (%%(id)s, %s)' % (
+		', '.join(fields), ', '.join(['%%(%s)s' % f for f in fields]))
+	parameters = dict([(f, u'value') for f in fields])
+
+	for (label, size) in (('uncached', 0), ('cached', 1000)):
+		statementcache.max_size = size
+		statementcache.clear()
+		count = 20000
+		t = time.time()
+		for i in xrange(count):
+			parameters['id'] = i
+			connection.makecursor(statement, parameters).close()
+		t = time.time() - t
+		print "makecursor %-8s %d statements: %.2f sec, %d/sec" % (label,
+			count, t, count / t)
+
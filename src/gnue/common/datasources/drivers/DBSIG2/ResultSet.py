@@ -28,6 +28,7 @@ Generic ResultSet class for DBSIG2 based database driver plugins.
 __all__ = ['ResultSet']
 
 from gnue.common.apps import errors
+from gnue.common.datasources import GConditions
 from gnue.common.datasources.drivers import Base
 
 
@@ -56,8 +57,38 @@ class ResultSet (Base.ResultSet):
 	"""
 	Generic ResultSet class for SQL based backends using a DBSIG2 compatible
 	Python module.
+
+	If the ResultSet has a record window (see L{Base.ResultSet.__init__}) and
+	a primary key, drivers with server side cursors (_named_cursors_) stream
+	the records: they are fetched in batches from a named cursor instead of
+	transferring the whole result on execute, and dropped records are fetched
+	again by primary key. The query is ordered by the primary key too, so the
+	cursor declared again after a commit returns the rows in the same order.
 	"""
 
+	# Maximum number of keys in one query fetching records again
+	_refetch_size_ = 200
+
+	# Statement and parameters of the server side cursor
+	__cursor_query = None
+
+	# Table and field list of the last object query, used to fetch dropped
+	# records again
+	__refetch_query = None
+
+	# Table, where clause and parameters of the last object query, used to
+	# calculate aggregates in the backend
+	__aggregate_query = None
+
+	# Name of the server side cursor, None for client side cursors
+	__cursor_name = None
+
+	# Number of rows fetched from the cursor
+	__fetched = 0
+
+	# Number of ResultSets having created a server side cursor
+	__cursor_count = 0
+
 	# ---------------------------------------------------------------------------
 	# Execute query for object type datasources
 	# ---------------------------------------------------------------------------
@@ -71,10 +102,15 @@ class ResultSet (Base.ResultSet):
 			what = 'DISTINCT ' + what
 		where = condition.asSQL (params)
 
+		streaming = self.__isStreaming (connection)
+		if streaming:
+			sortorder = self.__uniqueSortorder (sortorder)
+
 		# If the connection has a broken row count, query for the number of records
 		# first. This avoids conflicts with some drivers not supporting multiple
-		# open cursors (like adodbapi).
-		if connection._broken_rowcount_:
+		# open cursors (like adodbapi). Server side cursors don't know the row
+		# count before all rows are fetched.
+		if connection._broken_rowcount_ or streaming:
 			if distinct:
 				self.__count = 0
 			else:
@@ -83,9 +119,9 @@ class ResultSet (Base.ResultSet):
 
 		query = self.__buildQuery (table, what, where, sortorder)
 
-		self.__cursor = connection.makecursor (query, params)
+		self.__open (connection, query, params, streaming)
 
-		if not connection._broken_rowcount_:
+		if not connection._broken_rowcount_ and not streaming:
 			self.__count = self.__cursor.rowcount
 
 		# If the driver has a broken rowcount, but does not report it as broken,
@@ -96,6 +132,13 @@ class ResultSet (Base.ResultSet):
 		self.__connection = connection
 		self.__fieldnames = fieldnames
 
+		if streaming:
+			self.__refetch_query = (table, what)
+
+		# DISTINCT would change the meaning of aggregates
+		if not distinct:
+			self.__aggregate_query = (table, where, params)
+
 
 	# ---------------------------------------------------------------------------
 	# Build the query string
@@ -144,20 +187,78 @@ class ResultSet (Base.ResultSet):
 
 	def _query_sql_ (self, connection, sql):
 
-		self.__cursor = connection.makecursor (sql)
+		# The description of server side cursors is not available before the
+		# first fetch, so raw SQL queries always use a client side cursor
+		self.__open (connection, sql, None, False)
 
 		if connection._broken_rowcount_:
 			self.__count = 0                  # No chance to find it out
 		else:
 			self.__count = self.__cursor.rowcount
 
-		self.__connection = connection
-
 		# get field names from cursor description
 		self.__fieldnames = [(unicode (d [0], connection._encoding)).lower () \
 				for d in self.__cursor.description]
 
 
+	# ---------------------------------------------------------------------------
+	# Open the cursor
+	# ---------------------------------------------------------------------------
+
+	def __isStreaming (self, connection):
+
+		return self.getWindowSize () > 0 and connection._named_cursors_ \
+			and bool (self._getPrimarykeyFields ())
+
+	# ---------------------------------------------------------------------------
+
+	def __uniqueSortorder (self, sortorder):
+		"""
+		Append the primary key fields to the sort order.
+		"""
+
+		result = list (sortorder or [])
+		names = [item ['name'] for item in result]
+		for field in self._getPrimarykeyFields ():
+			if field not in names:
+				result.append ({'name': field})
+		return result
+
+	# ---------------------------------------------------------------------------
+
+	def __open (self, connection, statement, parameters, streaming):
+
+		self.__connection = connection
+		self.__fetched = 0
+		self.__refetch_query = None
+
+		if streaming:
+			ResultSet.__cursor_count += 1
+			self.__cursor_name = 'gnue_resultset_%d' % ResultSet.__cursor_count
+			self.__cursor_query = (statement, parameters)
+		else:
+			self.__cursor_name = None
+			self.__cursor_query = None
+
+		self.__cursor = connection.makecursor (statement, parameters,
+			name = self.__cursor_name)
+
+	# ---------------------------------------------------------------------------
+
+	def __reopen (self):
+		"""
+		Declare the server side cursor again after it has been closed by the end
+		of the transaction, and move it to the number of fetched rows.
+		"""
+
+		assert gDebug (8, 'Opening cursor %s again' % self.__cursor_name)
+
+		(statement, parameters) = self.__cursor_query
+		self.__cursor = self.__connection.makecursor (statement, parameters,
+			name = self.__cursor_name)
+		self.__cursor.scroll (self.__fetched, 'absolute')
+
+
 	# ---------------------------------------------------------------------------
 	# Return result count
 	# ---------------------------------------------------------------------------
@@ -167,6 +268,46 @@ class ResultSet (Base.ResultSet):
 		return self.__count
 
 
+	# ---------------------------------------------------------------------------
+	# Calculate aggregates in the backend
+	# ---------------------------------------------------------------------------
+
+	def _can_aggregate_ (self):
+
+		return self.__aggregate_query is not None
+
+	# ---------------------------------------------------------------------------
+
+	def _aggregate_ (self, function, fieldname, exclude):
+
+		(table, where, params) = self.__aggregate_query
+
+		if exclude:
+			condition = ['or']
+			for key in exclude:
+				condition.append (['and'] + [['eq', ['field', field], ['const', value]]
+					for (field, value) in zip (self._getPrimarykeyFields (), key)])
+
+			params = params.copy ()
+			excluded = 'NOT (%s)' % GConditions.buildConditionFromPrefix (
+				condition).asSQL (params)
+			if where:
+				where = '(%s) AND %s' % (where, excluded)
+			else:
+				where = excluded
+
+		if fieldname is None:
+			what = 'COUNT (*)'
+		else:
+			what = '%s (%s)' % (function.upper (), fieldname)
+
+		query = 'SELECT ' + what + ' FROM ' + table
+		if where:
+			query += ' WHERE ' + where
+
+		return self.__connection.sql1 (query, params)
+
+
 	# ---------------------------------------------------------------------------
 	# Yield data of next record
 	# ---------------------------------------------------------------------------
@@ -176,7 +317,14 @@ class ResultSet (Base.ResultSet):
 		while True:
 
 			# fetch next records from the backend
-			if self.__connection._must_fetchall_:
+			if self.__cursor_name is not None:
+				try:
+					rows = self.__cursor.fetchmany (cachesize)
+				except self.__connection._driver.Error:
+					# the transaction holding the cursor has ended
+					self.__reopen ()
+					rows = self.__cursor.fetchmany (cachesize)
+			elif self.__connection._must_fetchall_:
 				rows = self.__cursor.fetchall ()
 			elif self.__connection._broken_fetchmany_:
 				try:
@@ -190,14 +338,61 @@ class ResultSet (Base.ResultSet):
 			if not rows:
 				break
 
-			# convert String to Unicode and yield a dictionary
+			self.__fetched += len (rows)
+
 			for row in rows:
-				result = {}
-				for (fieldname, value) in zip (self.__fieldnames, row):
-					if isinstance (value, str):
-						value = unicode (value, self.__connection._encoding)
-					result [fieldname] = value
-				yield result
+				yield self.__makeDict (row)
+
+
+	# ---------------------------------------------------------------------------
+	# Convert String to Unicode and return a dictionary
+	# ---------------------------------------------------------------------------
+
+	def __makeDict (self, row):
+
+		result = {}
+		for (fieldname, value) in zip (self.__fieldnames, row):
+			if isinstance (value, str):
+				value = unicode (value, self.__connection._encoding)
+			result [fieldname] = value
+		return result
+
+
+	# ---------------------------------------------------------------------------
+	# Fetch records again by primary key
+	# ---------------------------------------------------------------------------
+
+	def _can_refetch_ (self):
+
+		return self.__refetch_query is not None \
+			or Base.ResultSet._can_refetch_ (self)
+
+	# ---------------------------------------------------------------------------
+
+	def _refetch_ (self, keyfields, keys):
+
+		if self.__refetch_query is None:
+			return Base.ResultSet._refetch_ (self, keyfields, keys)
+
+		(table, what) = self.__refetch_query
+
+		result = []
+		for start in xrange (0, len (keys), self._refetch_size_):
+			condition = ['or']
+			for key in keys [start:start + self._refetch_size_]:
+				condition.append (['and'] + [['eq', ['field', field], ['const', value]]
+					for (field, value) in zip (keyfields, key)])
+
+			params = {}
+			where = GConditions.buildConditionFromPrefix (condition).asSQL (params)
+			cursor = self.__connection.makecursor (
+				'SELECT ' + what + ' FROM ' + table + ' WHERE ' + where, params)
+			try:
+				result.extend ([self.__makeDict (row) for row in cursor.fetchall ()])
+			finally:
+				cursor.close ()
+
+		return result
 
 
 	# ---------------------------------------------------------------------------
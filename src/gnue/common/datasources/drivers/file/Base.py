@@ -31,9 +31,12 @@ __noplugin__ = True
 
 import glob
 import os
+import threading
+
+from collections import OrderedDict
 
 from gnue import paths
-from gnue.common.datasources import GSchema
+from gnue.common.datasources import Exceptions, GSchema
 from gnue.common.datasources.drivers import Base
 
 
@@ -99,23 +102,154 @@ class ResultSet (Base.ResultSet):
 		distinct):
 		self.__data = connection._getFile (table)
 		self.__fieldnames = fieldnames
-		self.__condition  = condition       # currently not honored
-		self.__sortorder  = sortorder       # currently not honored
-		self.__distinct   = distinct        # currently not honored
+		self.__sortorder  = sortorder or []
+		self.__distinct   = distinct
+		self.__selected   = None
+
+		# Fields needed for the condition and the sorting but not requested
+		self.__lookupnames = list (fieldnames)
+		extra = [order ['name'] for order in self.__sortorder]
+
+		if condition is not None and condition._children:
+			self.__evaluate = condition.compile ()
+			extra.extend ([field.name for field in \
+				condition.findChildrenOfType ('GCCField', True, True)])
+		else:
+			self.__evaluate = None
+
+		for name in extra:
+			if name not in self.__lookupnames:
+				self.__lookupnames.append (name)
 
 	# ---------------------------------------------------------------------------
 
 	def _count_ (self):
-		return len (self.__data)
+
+		if self.__evaluate is None and not self.__distinct \
+				and not self.__sortorder:
+			return len (self.__data)
+
+		# The number of matching rows is only known after a full pass, so keep the
+		# selected rows for _fetch_
+		self.__selected = self.__select ()
+		return len (self.__selected)
 
 	# ---------------------------------------------------------------------------
 
 	def _fetch_ (self, cachesize):
+
+		if self.__selected is None:
+			rows = self.__rows ()
+		else:
+			rows = self.__selected
+			self.__selected = None
+
+		if len (self.__lookupnames) == len (self.__fieldnames):
+			for row in rows:
+				yield row
+		else:
+			for row in rows:
+				result = {}
+				for fn in self.__fieldnames:
+					result [fn] = row [fn]
+				yield result
+
+
+	# ---------------------------------------------------------------------------
+	# Iterate over the rows matching the condition
+	# ---------------------------------------------------------------------------
+
+	def __rows (self):
+
+		names    = self.__lookupnames
+		evaluate = self.__evaluate
+
 		for row in self.__data:
 			result = {}
-			for fn in self.__fieldnames:
+			for fn in names:
 				result [fn] = row.get (fn)
-			yield result
+			if evaluate is None or evaluate (result):
+				yield result
+
+
+	# ---------------------------------------------------------------------------
+	# Build the list of distinct and sorted rows matching the condition
+	# ---------------------------------------------------------------------------
+
+	def __select (self):
+
+		if self.__distinct:
+			fieldnames = self.__fieldnames
+			seen = set ()
+			result = []
+			for row in self.__rows ():
+				key = tuple ([row [fn] for fn in fieldnames])
+				if key not in seen:
+					seen.add (key)
+					result.append (row)
+		else:
+			result = list (self.__rows ())
+
+		# Python's sort is stable, so sorting by the least significant key first
+		# gives the complete order
+		for order in reversed (self.__sortorder):
+			result.sort (key = _sortKey (order ['name'], order.get ('ignorecase')),
+				reverse = bool (order.get ('descending')))
+
+		return result
+
+
+# -----------------------------------------------------------------------------
+# Sort key for a field
+# -----------------------------------------------------------------------------
+
+def _sortKey (name, ignorecase):
+
+	if ignorecase:
+		def key (row):
+			value = row [name]
+			if isinstance (value, basestring):
+				return value.upper ()
+			return value
+	else:
+		def key (row):
+			return row [name]
+
+	return key
+
+
+# =============================================================================
+# Cached contents of a file
+# =============================================================================
+
+class _FileData:
+	"""
+	Records of a file together with the modification time and size they were
+	loaded for and hash indexes built on demand.
+	"""
+
+	def __init__ (self, rows, stamp):
+
+		self.rows    = rows
+		self.stamp   = stamp
+		self.indexes = {}
+
+	# ---------------------------------------------------------------------------
+
+	def index (self, fieldnames):
+		"""
+		Return a dictionary mapping tuples of the values of the given fields to the
+		list of records having these values.
+		"""
+
+		result = self.indexes.get (fieldnames)
+		if result is None:
+			result = {}
+			for row in self.rows:
+				key = tuple ([row.get (fn) for fn in fieldnames])
+				result.setdefault (key, []).append (row)
+			self.indexes [fieldnames] = result
+		return result
 
 
 # =============================================================================
@@ -130,6 +264,17 @@ class Connection (Base.Connection):
 	_resultSetClass_ = ResultSet
 	_behavior_       = Behavior
 
+	# Descendants holding uncommitted changes in the loaded data must set this to
+	# False, so every query reads the data from _loadFile_
+	_cache_files_    = True
+
+	# Number of files kept in the cache, the least recently used are dropped
+	_cache_size_     = 20
+
+	# Loaded files of all connections: (class, filename) -> _FileData
+	__filecache = OrderedDict ()
+	__filelock  = threading.Lock ()
+
 
 	# ---------------------------------------------------------------------------
 	# Constructor
@@ -157,16 +302,17 @@ class Connection (Base.Connection):
 	# ---------------------------------------------------------------------------
 
 	def _requery_ (self, table, oldfields, fields, parameters):
-		for row in self._getFile (table):
-			found = True
-			for (fieldname, value) in oldfields:
-				if row.get (fieldname) != value:
-					found = False
-			if found:
-				result = {}
-				for fieldname in fields:
-					result [fieldname] = row.get (fieldname)
-				return result
+
+		keys = tuple (sorted (oldfields.keys ()))
+		key  = tuple ([oldfields [fn] for fn in keys])
+
+		for row in self.__getData (table).index (keys).get (key, []):
+			result = {}
+			for fieldname in fields:
+				result [fieldname] = row.get (fieldname)
+			return result
+
+		raise Exceptions.RecordNotFoundError
 
 
 	# ---------------------------------------------------------------------------
@@ -197,7 +343,45 @@ class Connection (Base.Connection):
 		    records of the file.
 		"""
 
-		return self._loadFile_ (self._getFilename (table), table)
+		return self.__getData (table).rows
+
+	# ---------------------------------------------------------------------------
+
+	def __getData (self, table):
+
+		filename = self._getFilename (table)
+
+		if not self._cache_files_:
+			return _FileData (self._loadFile_ (filename, table), None)
+
+		try:
+			info  = os.stat (filename)
+			stamp = (info.st_mtime, info.st_size)
+		except OSError:
+			stamp = None
+
+		key = (self.__class__, filename)
+
+		self.__filelock.acquire ()
+		try:
+			data = self.__filecache.pop (key, None)
+			if data is not None and stamp is not None and data.stamp == stamp:
+				self.__filecache [key] = data
+				return data
+		finally:
+			self.__filelock.release ()
+
+		data = _FileData (self._loadFile_ (filename, table), stamp)
+		if stamp is not None:
+			self.__filelock.acquire ()
+			try:
+				self.__filecache [key] = data
+				while len (self.__filecache) > self._cache_size_:
+					self.__filecache.popitem (last = False)
+			finally:
+				self.__filelock.release ()
+
+		return data
 
 
 	# ---------------------------------------------------------------------------
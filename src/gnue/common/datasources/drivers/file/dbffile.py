@@ -109,6 +109,8 @@ class Connection (Base.Connection):
 				if scale:
 					field.precision = scale
 
+		f.close ()
+
 		return result
 
 
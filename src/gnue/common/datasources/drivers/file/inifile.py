@@ -104,6 +104,9 @@ class Connection (Base.Connection):
 
 	_primarykeyFields_ = ['_section_name']
 
+	# Uncommitted changes are held in the parsers, not in the file
+	_cache_files_ = False
+
 
 	# ---------------------------------------------------------------------------
 	# Constructor
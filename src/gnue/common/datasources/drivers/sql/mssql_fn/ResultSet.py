@@ -209,7 +209,8 @@ class ResultSet(DBSIG2.ResultSet):
 				g.sort(compare)
 
 		if self.__condition:
-			g = [row for row in g if self.__condition.evaluate(row)]
+			evaluate = self.__condition.compile()
+			g = [row for row in g if evaluate(row)]
 			# update row count
 			self.__count = len(g)
 
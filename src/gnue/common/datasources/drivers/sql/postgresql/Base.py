@@ -43,6 +43,7 @@ class Connection(ErrorDecorators, DBSIG2.Connection):
 	"""
 
 	_behavior_ = Behavior.Behavior
+	_batch_post_ = True
 
 	# The oid column is not created by default with Postgres >= 8.0, so don't use
 	# it by default.
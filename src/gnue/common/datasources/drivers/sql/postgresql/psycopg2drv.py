@@ -111,6 +111,25 @@ class Connection (Base.Connection):
 
 	_drivername_ = 'psycopg2'
 	_need_rollback_after_exception_ = True
+	_named_cursors_ = True
+
+	def _named_cursor_(self, name):
+		"""
+		overrided DBSIG2 Connection._named_cursor_
+		"""
+		return self._native.cursor(name, scrollable=True)
+
+	def _executemany_(self, cursor, statement, parameters):
+		"""
+		overrided DBSIG2 Connection._executemany_
+		"""
+		# psycopg2 >= 2.7 sends several statements per round-trip
+		try:
+			from psycopg2.extras import execute_batch
+		except ImportError:
+			cursor.executemany(statement, parameters)
+		else:
+			execute_batch(cursor, statement, parameters, page_size=self._batch_size_)
 
 	def make_parameter(self, value):
 		"""
@@ -46,6 +46,9 @@ class Connection(Connection):
 
 	_resultSetClass_ = ResultSet
 
+	# Records are written by stored procedures, one call per record
+	_batch_post_ = False
+
 	def _getSessionKey(self):
 		return self.manager._getSessionKey()
 
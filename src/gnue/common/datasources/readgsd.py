@@ -28,9 +28,11 @@ import os
 import re
 import sets
 import datetime
+import xml.sax
 
 from gnue.common.apps import errors, GBaseApp, GClientApp
-from gnue.common.datasources import GSchema, GDataSource, GConditions
+from gnue.common.datasources import GSchema, GConditions
+from gnue.common.definitions import GParser
 from gnue.common.utils.FileUtils import openResource
 from gnue.common.utils import GDateTime
 from gnue.common.apps.i18n import utranslate as u_          # for epydoc
@@ -112,6 +114,194 @@ class InvalidTypeError(errors.ApplicationError):
 		errors.ApplicationError.__init__(self, msg)
 
 
+# Number of rows read, checked against the backend and written at once
+_BATCH_SIZE = 500
+
+# Number of bytes fed to the XML parser at once when reading rows
+_CHUNK_SIZE = 65536
+
+
+# =============================================================================
+# Schema handler leaving out the data rows
+# =============================================================================
+
+class _StructureHandler(GSchema.xmlSchemaHandler):
+	"""
+	Builds the object tree of a gsd file without the <row> elements, which are
+	read later on by L{_readRows}. Remembers the names of all tables having rows
+	in the file.
+	"""
+
+	def __init__(self):
+
+		GSchema.xmlSchemaHandler.__init__(self)
+		self.tables = sets.Set()
+		self.__table = None
+		self.__depth = 0            # nesting level inside of a <row>
+
+	# -------------------------------------------------------------------------
+
+	def startElementNS(self, name, qname, attrs):
+
+		if self.__depth or name[1] == 'row':
+			if not self.__depth:
+				self.tables.add(self.__table)
+			self.__depth += 1
+			return
+
+		if name[1] == 'tabledata':
+			self.__table = attrs.get((None, 'tablename'), '').strip().lower()
+
+		GSchema.xmlSchemaHandler.startElementNS(self, name, qname, attrs)
+
+	# -------------------------------------------------------------------------
+
+	def endElementNS(self, name, qname):
+
+		if self.__depth:
+			self.__depth -= 1
+		else:
+			GSchema.xmlSchemaHandler.endElementNS(self, name, qname)
+
+	# -------------------------------------------------------------------------
+
+	def characters(self, content):
+
+		if not self.__depth:
+			GSchema.xmlSchemaHandler.characters(self, content)
+
+	# -------------------------------------------------------------------------
+
+	def comment(self, text):
+
+		if not self.__depth:
+			GSchema.xmlSchemaHandler.comment(self, text)
+
+
+# =============================================================================
+# Handler collecting the rows of a table
+# =============================================================================
+
+class _RowHandler(xml.sax.ContentHandler):
+	"""
+	Collects the rows of all <tabledata> elements for a table as dictionaries
+	of lowercase fieldnames and the text of the values.
+	"""
+
+	def __init__(self, tablename):
+
+		xml.sax.ContentHandler.__init__(self)
+		self.rows = []
+		self.__tablename = tablename
+		self.__active = False
+		self.__row = None
+		self.__field = None
+		self.__text = None
+
+	# -------------------------------------------------------------------------
+
+	def startElementNS(self, name, qname, attrs):
+
+		tag = name[1]
+
+		if tag == 'tabledata':
+			self.__active = attrs.get((None, 'tablename'), '').strip().lower() \
+				== self.__tablename
+
+		elif not self.__active:
+			return
+
+		elif tag == 'row':
+			self.__row = {}
+
+		elif tag == 'value' and self.__row is not None:
+			self.__field = attrs.get((None, 'field'), '').strip().lower()
+			self.__text = []
+
+	# -------------------------------------------------------------------------
+
+	def characters(self, content):
+
+		if self.__text is not None:
+			self.__text.append(content)
+
+	# -------------------------------------------------------------------------
+
+	def endElementNS(self, name, qname):
+
+		tag = name[1]
+
+		if tag == 'value' and self.__text is not None:
+			self.__row[self.__field] = u"".join(self.__text)
+			self.__text = None
+
+		elif tag == 'row' and self.__row is not None:
+			self.rows.append(self.__row)
+			self.__row = None
+
+		elif tag == 'tabledata':
+			self.__active = False
+
+
+# -----------------------------------------------------------------------------
+# Iterate over the rows of a table in a gsd file
+# -----------------------------------------------------------------------------
+
+def _readRows(filename, tablename):
+	"""
+	Parse a gsd file incrementally and yield the rows of the given table as
+	dictionaries of lowercase fieldnames and the text of the values.
+	"""
+
+	handler = _RowHandler(tablename)
+
+	parser = xml.sax.make_parser()
+	parser.setFeature(xml.sax.handler.feature_namespaces, 1)
+	parser.setContentHandler(handler)
+
+	stream = openResource(filename)
+	try:
+		while True:
+			chunk = stream.read(_CHUNK_SIZE)
+			try:
+				if chunk:
+					parser.feed(chunk)
+				else:
+					parser.close()
+
+			except xml.sax.SAXParseException, e:
+				raise GParser.MarkupError, (errors.getException()[2], filename,
+					e.getLineNumber())
+
+			rows = handler.rows
+			handler.rows = []
+			for row in rows:
+				yield row
+
+			if not chunk:
+				break
+
+	finally:
+		stream.close()
+
+
+# -----------------------------------------------------------------------------
+# Split an iterable into lists of a given size
+# -----------------------------------------------------------------------------
+
+def _chunks(iterable, size):
+
+	chunk = []
+	for item in iterable:
+		chunk.append(item)
+		if len(chunk) == size:
+			yield chunk
+			chunk = []
+
+	if chunk:
+		yield chunk
+
+
 # =============================================================================
 # Client application reading and importing GNUe Schema Definition files
 # =============================================================================
@@ -290,12 +480,19 @@ class gsdClient(GClientApp.GClientApp):
 
 	def __load_input_files(self):
 		"""
-		Builds a schema from the list of input filehandles stored in self._files
+		Builds a schema from the list of input filehandles stored in self._files.
+		The data rows are not loaded, they are read from the files table by table
+		during the import.
 		"""
 		self._schema = None
+		self.__rowfiles = []
+
+		for (filename, stream) in zip(self.ARGUMENTS, self._files):
+			handler = _StructureHandler()
+			xmltree = GParser.loadXMLObject(stream, lambda: handler, 'GSSchema',
+				'schema', attributes = {'_app': None})
+			self.__rowfiles.append((filename, handler.tables))
 
-		for stream in self._files:
-			xmltree = GSchema.loadFile(stream)
 			if self._schema is None:
 				self._schema = xmltree
 			else:
@@ -361,14 +558,11 @@ class gsdClient(GClientApp.GClientApp):
 
 		tables = {}
 		pkeys  = {}
-		fields = {}
 
 		# Then make sure to have valid key information for all tables
 		for tdata in self._schema.findChildrenOfType('GSTableData',False,True):
 			table = self.__findTable(tdata.tablename)
 			tables[table.name.lower()] = (table, tdata)
-			fields[table.name.lower()] = sets.Set([f.name.lower() for f in \
-						table.findChildrenOfType('GSField', False, True)])
 
 			key = tdata.findChildOfType('GSPrimaryKey')
 			if key is None:
@@ -387,27 +581,6 @@ class gsdClient(GClientApp.GClientApp):
 				pkeys[table.name.lower()] = sets.Set([f.name.lower() for f in \
 							key.findChildrenOfType('GSPKField', False, True)])
 
-		# Since we have all key information available now, double check the
-		# rows
-		for item in self._schema.findChildrenOfType('GSTableData',False,True):
-			keySet = pkeys.get(item.tablename.lower())
-
-			for (n, r) in enumerate(item.findChildrenOfType('GSRow', False,
-					True)):
-				rowfields = sets.Set([value.field.lower() \
-							for value in r.findChildrenOfType('GSValue', False, True)])
-
-				# If the table has a key, are all keyfields available in the
-				# row
-				if keySet is not None and not keySet.issubset(rowfields):
-					raise MissingKeyFieldError, (item.tablename, n, keySet,
-						rowfields)
-
-				# Are all fields in the row defined by the table
-				if not rowfields.issubset(fields[item.tablename.lower()]):
-					raise InvalidFieldsError, (item.tablename, n,
-						rowfields.difference(fields[item.tablename]))
-
 		# Order the tables so the do not violate constraints
 		references = {}
 		fishhooks  = {}
@@ -427,14 +600,20 @@ class gsdClient(GClientApp.GClientApp):
 					if not fkname in deps:
 						deps.append(fkname)
 
+		# Rows are checked while they are read, so a bad row of a later table
+		# must undo the rows already written
 		needCommit = False
-		for name in self.__order_by_dependency(references):
-			(table, tdata) = tables[name]
-			if not name in pkeys:
-				needCommit |= self.__import_all_inserts(table, tdata)
-			else:
-				needCommit |= self.__import_table(table, tdata,
-					fishhooks.get(name))
+		try:
+			for name in self.__order_by_dependency(references):
+				(table, tdata) = tables[name]
+				if not name in pkeys:
+					needCommit |= self.__import_all_inserts(table, tdata)
+				else:
+					needCommit |= self.__import_table(table, tdata,
+						fishhooks.get(name))
+		except:
+			self.connection.rollback()
+			raise
 
 		if needCommit:
 			self.connection.commit()
@@ -446,106 +625,135 @@ class gsdClient(GClientApp.GClientApp):
 
 	def __import_table(self, table, tabledata, fishes):
 
-		fields = {}
-		for field in table.findChildrenOfType('GSField', False, True):
-			fields[field.name.lower()] = field
-
+		fields = self.__get_fields(table)
 		pkf = [f.name.lower() for f in \
 				tabledata.findChildrenOfType('GSPKField', False, True)]
-		rows       = {}
-		rowFields  = {}
-		fishLookup = {}
 
-		for row in tabledata.findChildrenOfType('GSRow', False, True):
-			record = {}
-			for value in row.findChildrenOfType('GSValue'):
-				fname = value.field.lower()
-				rowFields[fname] = True
-				record[fname] = self.__getValue(value, fields[fname])
+		records = self.__read_records(table, fields, pkf)
 
-			pkey = tuple([record[k] for k in pkf])
-			rows[pkey] = record
+		# Records referencing other records of the same table are written level
+		# by level, so referenced records always exist before
+		if fishes is not None:
+			levels = self.__order_records(table, records, pkf, fishes)
+		else:
+			levels = [records]
 
-			if fishes is not None:
-				for fkey in fishes:
-					ref = []
-					for fkfield in fkey.findChildrenOfType('GSFKField'):
-						ref.append(record.get(fkfield.references.lower()))
+		print o(u_("  updating table '%s' ...") % table.name)
+		new  = 0
+		upd  = 0
+		rows = 0
 
-					fishLookup.setdefault(fkey.name, {})[tuple(ref)] = pkey
+		for records in levels:
+			for chunk in _chunks(records, _BATCH_SIZE):
+				(n, u, r) = self.__merge_records(table, pkf, chunk)
+				new  += n
+				upd  += u
+				rows += r
 
+		print o(u_("    Rows: %(ins)d inserted, %(upd)d updated, %(kept)d "
+				"unchanged.") \
+				% {'ins': new, 'upd': upd, 'kept': rows - upd - new})
 
-		if fishes is not None:
-			sortdict = {}
+		return (new + upd) > 0
 
-			for (key, data) in rows.items():
-				deps = sortdict.setdefault(key, [])
 
-				for fkey in fishes:
-					k = tuple([data.get(f.name.lower()) for f in \
-								fkey.findChildrenOfType('GSFKField')])
-					rkey = fishLookup[fkey.name].get(k)
+	# --------------------------------------------------------------------------
+	# Insert or update a batch of records
+	# --------------------------------------------------------------------------
 
-					if rkey is not None:
-						deps.append(rkey)
+	def __merge_records(self, table, pkf, records):
+		"""
+		Look up a batch of records in the backend with a single query and write
+		the new and changed ones.
 
-			recOrder = self.__order_by_dependency(sortdict,
-				CircularDataReferences, table.name)
-		else:
-			recOrder = rows.keys()
+		@return: tuple with the number of inserted, updated and unique records
+		"""
 
-		# Build a datasource and insert the data
-		source = GDataSource.DataSourceWrapper(connections = self.connections,
-			attributes = {'name'      : "dts_%s" % table.name,
-				'connection': self.connection.name,
-				'table'     : table.name,
-				'primarykey': ",".join(pkf)},
-			fields = rowFields.keys())
+		# Later rows with the same key replace earlier ones
+		order = []
+		bykey = {}
+		names = {}
+		for record in records:
+			key = tuple([record[k] for k in pkf])
+			if not key in bykey:
+				order.append(key)
+			bykey[key] = record
+			names.update(dict.fromkeys(record))
+
+		keys = [dict(zip(pkf, key)) for key in order]
+		existing = self.connection.requeryBatch(table.name, keys,
+			sorted(names.keys()))
+
+		operations = []
+		new = 0
+		upd = 0
 
-		# Build a mapping for the existing table, based on the primary key
-		existing  = {}
-		resultSet = source.createResultSet()
+		for (index, key) in enumerate(order):
+			record  = bykey[key]
+			current = existing[index]
 
-		rec = resultSet.firstRecord()
-		while rec is not None:
-			recKey = tuple([rec[f] for f in pkf])
-			existing[recKey] = rec
+			if current is None:
+				operations.append(('insert', table.name, None, record))
+				new += 1
+				continue
 
-			rec = resultSet.nextRecord()
+			changed = {}
+			for (field, value) in record.items():
+				(ov, nv) = GConditions.unify([current.get(field), value])
+				if ov != nv:
+					changed[field] = value
 
-		# Now run over all datarows in the previously determined order
-		print o(u_("  updating table '%s' ...") % table.name)
-		doPost = False
-		new = 0
-		upd = 0
+			if changed:
+				operations.append(('update', table.name, keys[index], changed))
+				upd += 1
 
-		for key in recOrder:
-			if key in existing:
-				rs = existing[key]
-				changed = 0
+		self.connection.postBatch(operations)
 
-				for (field, value) in rows[key].items():
-					(ov, nv) = GConditions.unify([rs.getField(field), value])
-					if ov != nv:
-						rs.setField(field, value)
-						changed = 1
+		return (new, upd, len(order))
 
-				upd += changed
 
-			else:
-				new   += 1
-				newRec = resultSet.insertRecord()
-				for (field, value) in rows[key].items():
-					newRec.setField(field, value)
+	# --------------------------------------------------------------------------
+	# Order the records of a table referencing itself
+	# --------------------------------------------------------------------------
 
-		if new or upd:
-			resultSet.post()
+	def __order_records(self, table, records, pkf, fishes):
+		"""
+		Group the records of a table into levels, where the records of a level
+		only reference records of the previous levels.
 
-		print o(u_("    Rows: %(ins)d inserted, %(upd)d updated, %(kept)d "
-				"unchanged.") \
-				% {'ins': new, 'upd': upd, 'kept': len(rows) - upd - new})
+		@return: list of lists of records
+		"""
 
-		return (new + upd) > 0
+		rows       = {}
+		fishLookup = {}
+
+		for record in records:
+			pkey = tuple([record[k] for k in pkf])
+			rows[pkey] = record
+
+			for fkey in fishes:
+				ref = []
+				for fkfield in fkey.findChildrenOfType('GSFKField'):
+					ref.append(record.get(fkfield.references.lower()))
+
+				fishLookup.setdefault(fkey.name, {})[tuple(ref)] = pkey
+
+		sortdict = {}
+
+		for (key, data) in rows.items():
+			deps = sortdict.setdefault(key, [])
+
+			for fkey in fishes:
+				k = tuple([data.get(f.name.lower()) for f in \
+							fkey.findChildrenOfType('GSFKField')])
+				rkey = fishLookup[fkey.name].get(k)
+
+				if rkey is not None and rkey != key:
+					deps.append(rkey)
+
+		return [[rows[key] for key in level] for level in \
+				self.__levels_by_dependency(sortdict, CircularDataReferences,
+					table.name)]
 
 
 	# -------------------------------------------------------------------------
@@ -554,45 +762,78 @@ class gsdClient(GClientApp.GClientApp):
 
 	def __import_all_inserts(self, table, tabledata):
 
+		fields = self.__get_fields(table)
+		rows   = 0
+
+		for chunk in _chunks(self.__read_records(table, fields, None),
+				_BATCH_SIZE):
+			if not rows:
+				print o(u_("  inserting into table '%s' ...") % table.name)
+
+			self.connection.postBatch([('insert', table.name, None, record) \
+					for record in chunk])
+			rows += len(chunk)
+
+		if not rows:
+			return False
+
+		print o(u_("    Rows: %(ins)d inserted") % {'ins': rows})
+
+		return True
+
+
+	# -------------------------------------------------------------------------
+	# Get the fields of a table
+	# -------------------------------------------------------------------------
+
+	def __get_fields(self, table):
+
 		fields = {}
 		for field in table.findChildrenOfType('GSField', False, True):
 			fields[field.name.lower()] = field
 
-		rows = []
-		rowFields = {}
+		return fields
 
-		for row in tabledata.findChildrenOfType('GSRow', False, True):
-			record = {}
-			for value in row.findChildrenOfType('GSValue'):
-				fname = value.field.lower()
-				rowFields[fname] = True
-				record[fname] = self.__getValue(value, fields[fname])
 
-			rows.append(record)
+	# -------------------------------------------------------------------------
+	# Iterate over the records of a table in all input files
+	# -------------------------------------------------------------------------
 
-		if not rows:
-			return False
+	def __read_records(self, table, fields, pkf):
+		"""
+		Read the rows of a table from all input files, check them and yield them
+		as dictionaries of native python values.
 
-		# Build a datasource and insert the data
-		source = GDataSource.DataSourceWrapper(connections = self.connections,
-			attributes = {'name'      : "dts_%s" % table.name,
-				'connection': self.connection.name,
-				'table'     : table.name},
-			fields = rowFields.keys())
+		@param fields: dictionary of all GSField instances of the table
+		@param pkf: list of key fields every row must have, or None
+		"""
 
-		print o(u_("  inserting into table '%s' ...") % table.name)
+		name = table.name.lower()
+		n = 0
 
-		resultSet = source.createEmptyResultSet()
-		for record in rows:
-			new = resultSet.insertRecord()
-			for (field, value) in record.items():
-				new.setField(field, value)
+		for (filename, tablenames) in self.__rowfiles:
+			if not name in tablenames:
+				continue
 
-		resultSet.post()
+			for row in _readRows(filename, name):
+				# If the table has a key, are all keyfields available in the row
+				if pkf is not None:
+					for key in pkf:
+						if not key in row:
+							raise MissingKeyFieldError, (table.name, n,
+								sets.Set(pkf), sets.Set(row.keys()))
 
-		print o(u_("    Rows: %(ins)d inserted") % {'ins': len(rows)})
+				# Are all fields in the row defined by the table
+				invalid = [f for f in row if not f in fields]
+				if invalid:
+					raise InvalidFieldsError, (table.name, n, invalid)
 
-		return True
+				record = {}
+				for (fname, contents) in row.items():
+					record[fname] = self.__getValue(contents, fields[fname])
+
+				n += 1
+				yield record
 
 
 	# -------------------------------------------------------------------------
@@ -602,41 +843,50 @@ class gsdClient(GClientApp.GClientApp):
 	def __order_by_dependency(self, depTree, error=CircularReferenceError, *ea):
 
 		result = []
+		for level in self.__levels_by_dependency(depTree, error, *ea):
+			result.extend(level)
 
-		while depTree:
-			addition = []
+		return result
+
+
+	# -------------------------------------------------------------------------
+	# Group the keys of a dependency tree by their level
+	# -------------------------------------------------------------------------
 
-			for (key, deps) in depTree.items():
-				# If a key has no dependencies, add it to the result
-				if not len(deps):
-					addition.append(key)
+	def __levels_by_dependency(self, depTree, error=CircularReferenceError,
+		*ea):
 
-					# and remove that key from all other dependency sequences
-					for otherDeps in depTree.values():
-						if key in otherDeps:
-							otherDeps.remove(key)
+		result = []
 
-					# finally remove it from the dictionary
-					del depTree[key]
+		while depTree:
+			# All keys without dependencies form the next level
+			addition = [key for (key, deps) in depTree.items() if not len(deps)]
 
 			# If no key without a dependency was found, but there are still
 			# entries in the tree, they *must* have circular references
-			if not addition and depTree:
+			if not addition:
 				raise error, ea
 
-			result.extend(addition)
+			# Remove these keys from the dictionary and from all other dependency
+			# sequences
+			for key in addition:
+				del depTree[key]
+
+			for deps in depTree.values():
+				deps[:] = [key for key in deps if key in depTree]
+
+			result.append(addition)
 
 		return result
 
 
 	# -------------------------------------------------------------------------
-	# Get a native python value from a GSValue instance using a given GSField
+	# Get a native python value from the contents of a <value> using a GSField
 	# -------------------------------------------------------------------------
 
-	def __getValue(self, value, field):
+	def __getValue(self, contents, field):
 
 		ftype    = field.type.lower()
-		contents = value.getChildrenAsContent()
 
 		# unquote the contents if it is quoted
 		if len(contents) > 1 and contents[0] in ["'", '"']:
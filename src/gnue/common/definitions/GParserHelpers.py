@@ -24,6 +24,7 @@
 """
 Base classes for GNUe objects which can be represented as XML.
 """
+import copy
 import types
 import weakref
 from xml.sax import saxutils
@@ -182,6 +183,37 @@ class ParserObj(object):
 				new.setParent (self)
 
 
+	# ---------------------------------------------------------------------------
+	# Deep copy keeping parent links
+	# ---------------------------------------------------------------------------
+
+	def __deepcopy__ (self, memo):
+		"""
+		Copy the object and all of its attributes. The parent is a weakref proxy
+		which must not be copied, so the copy keeps the parent of the original
+		until the parent itself is copied and sets itself as the parent of the
+		copied children.
+
+		@param memo: memo dictionary of L{copy.deepcopy}
+		@returns: the copy of the object
+		"""
+
+		new = self.__class__.__new__ (self.__class__)
+		memo [id (self)] = new
+
+		for (name, value) in self.__dict__.iteritems ():
+			if name == '_ParserObj__parent':
+				new.__dict__ [name] = value
+			else:
+				new.__dict__ [name] = copy.deepcopy (value, memo)
+
+		for child in new._children:
+			if isinstance (child, ParserObj):
+				child.setParent (new)
+
+		return new
+
+
 	# ---------------------------------------------------------------------------
 	# Merge another object tree with this tree
 	# ---------------------------------------------------------------------------
@@ -38,11 +38,14 @@ from the three base classes in this module.
 """
 
 import re
+import threading
 import types
 
+from collections import OrderedDict
+
 from gnue.common.logic.language import ImplementationError, AbortRequest
 
-__all__ = ['LanguageAdapter', 'ExecutionContext']
+__all__ = ['LanguageAdapter', 'ExecutionContext', 'CodeCache', 'codecache']
 
 
 # =============================================================================
@@ -75,6 +78,115 @@ class LanguageAdapter:
 		raise ImplementationError, (self.__class__, 'createNewContext()')
 
 
+# =============================================================================
+# Process-wide cache of compiled user code
+# =============================================================================
+
+class CodeCache:
+	"""
+	Least recently used cache of compiled user code, shared by all execution
+	contexts of the process.
+
+	Language adapters store whatever their compilation step produces (e.g.
+	code objects) under a key built from the language, the normalized source
+	code and the parameter list. The cached objects must not depend on the
+	namespaces of an execution context, binding them stays per instance.
+	"""
+
+	# -------------------------------------------------------------------------
+	# Constructor
+	# -------------------------------------------------------------------------
+
+	def __init__(self, max_size=2000):
+
+		self.max_size = max_size
+		self.__items = OrderedDict()
+		self.__lock = threading.Lock()
+		self.__hits = 0
+		self.__misses = 0
+		self.__evictions = 0
+
+
+	# -------------------------------------------------------------------------
+	# Get a cached object or compile it
+	# -------------------------------------------------------------------------
+
+	def get(self, key, compile):
+		"""
+		Return the object cached for the key. If there is none, call compile()
+		and cache its result.
+
+		@param key: hashable key, starting with the language name
+		@param compile: function without parameters returning the object to
+		    cache. Exceptions raised by it are passed through and nothing is
+		    cached.
+		"""
+
+		self.__lock.acquire()
+		try:
+			if key in self.__items:
+				self.__hits += 1
+				result = self.__items.pop(key)
+				self.__items[key] = result
+				return result
+			self.__misses += 1
+		finally:
+			self.__lock.release()
+
+		# compile without lock, another thread may compile the same code
+		# meanwhile, last one wins
+		result = compile()
+
+		self.__lock.acquire()
+		try:
+			self.__items[key] = result
+			while len(self.__items) > self.max_size:
+				self.__items.popitem(last=False)
+				self.__evictions += 1
+		finally:
+			self.__lock.release()
+
+		return result
+
+
+	# -------------------------------------------------------------------------
+	# Statistics
+	# -------------------------------------------------------------------------
+
+	def statistics(self):
+		"""
+		Return dictionary with hits, misses, evictions and the current size.
+		"""
+
+		self.__lock.acquire()
+		try:
+			return {
+				'hits'      : self.__hits,
+				'misses'    : self.__misses,
+				'evictions' : self.__evictions,
+				'size'      : len(self.__items),
+			}
+		finally:
+			self.__lock.release()
+
+	# -------------------------------------------------------------------------
+
+	def clear(self):
+		"""
+		Remove all cached objects. Statistics are not reset.
+		"""
+
+		self.__lock.acquire()
+		try:
+			self.__items.clear()
+		finally:
+			self.__lock.release()
+
+
+#: The cache used by all language adapters
+codecache = CodeCache()
+
+
 # =============================================================================
 # Helper function to raise an AbortRequest exception
 # =============================================================================
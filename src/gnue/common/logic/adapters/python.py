@@ -29,11 +29,12 @@ Language adapter plugin for Python.
 """
 
 import sys
+import __builtin__
 from gnue.common.apps import errors
 from gnue.common.logic import language
 from gnue.common.logic.adapters import Base
 
-__all__ = ['LanguageAdapter', 'ExecutionContext', 'Function']
+__all__ = ['LanguageAdapter', 'ExecutionContext', 'Function', 'CompiledFunction']
 
 
 # =============================================================================
@@ -81,6 +82,10 @@ class ExecutionContext(Base.ExecutionContext):
 		self.__global_namespace = global_namespace
 		self.__builtin_namespace = builtin_namespace
 
+		#: Compile code into function objects instead of running a generated
+		#: module on every call (see CompiledTriggers option)
+		self.compiled = gConfig('CompiledTriggers')
+
 
 	# -------------------------------------------------------------------------
 	# Create a function
@@ -133,6 +138,19 @@ class ExecutionContext(Base.ExecutionContext):
 						"Unindent does not match any outer indentation level at row %d") \
 						% row
 
+		# Make sure namespaces are clean
+		# TODO: This can be moved to Base.ExecutionContext.__init__() after all
+		# the depreciated functions are removed.
+		self.__make_safe_namespace(self.__builtin_namespace)
+		self.__make_safe_namespace(self.__local_namespace)
+		self.__make_safe_namespace(self.__global_namespace)
+
+		if self.compiled:
+			return CompiledFunction(
+				build = lambda: self.__compile_function(name, parameters, lines),
+				local_namespace = self.__local_namespace,
+				builtin_namespace = self.__builtin_namespace)
+
 		# The whole code is enclosed into a pseudo function definition. This
 		# way, the code can contain "return" statements.
 		# Start with the function header
@@ -159,8 +177,71 @@ for (__key, __value) in __builtins.items():
 __result = %s(__namespace, **__parameters)
 """ % (encoding, name, ", ".join(parameters), '\n'.join(lines), name)
 
+		compiled_code = Base.codecache.get(('python', revised_code),
+			lambda: self.__compile(revised_code, lines))
+
+		return Function(
+			compiled_code = compiled_code,
+			local_namespace = {
+				'__builtins': self.__builtin_namespace,
+				'__namespace': self.__local_namespace},
+			global_namespace = self.__global_namespace)
+
+
+	# -------------------------------------------------------------------------
+	# Compile user code into a real python function
+	# -------------------------------------------------------------------------
+
+	def __compile_function(self, name, parameters, lines):
+		"""
+		Compile the code once into a function object living in the global
+		namespace. Names of the local namespace are bound as local variables
+		at the start of the function, reading the namespace passed as hidden
+		default argument.
+
+		The code object is shared with other contexts through
+		L{Base.codecache}, so only the namespace binding is done here.
+
+		@return: tuple (function, set of bound local names)
+		"""
+
+		local_names = self.__local_namespace.keys()
+		local_names.sort()
+
+		if local_names:
+			parameters = parameters + ['__namespace=__namespace']
+
+		revised_code = u"""\
+# -*- coding: %s -*-
+def %s(%s):
+%s
+%s
+""" % ('UTF-8', name, ", ".join(parameters),
+			'\n'.join(['    %s = __namespace["%s"]' % (i, i) for i in local_names]),
+			'\n'.join(lines))
+
+		compiled_code = Base.codecache.get(('python', revised_code),
+			lambda: self.__compile(revised_code, lines))
+
+		namespace = {'__namespace': self.__local_namespace}
+		exec compiled_code in self.__global_namespace, namespace
+
+		return namespace[name], frozenset(local_names)
+
+
+	# -------------------------------------------------------------------------
+	# Compile revised code
+	# -------------------------------------------------------------------------
+
+	def __compile(self, revised_code, lines):
+
+		# NOTE: code objects are cached by source, so the file name in
+		# tracebacks is the one of the context that compiled it first
+
+		encoding = 'UTF-8'
+
 		try:
-			compiled_code = compile(
+			return compile(
 				revised_code.encode(encoding),
 				'<%s>' % self.shortname.encode(encoding),
 				'exec'
@@ -174,20 +255,6 @@ __result = %s(__namespace, **__parameters)
 				group = 'application'
 			raise language.CompileError, (group, name, message, detail)
 
-		# Make sure namespaces are clean
-		# TODO: This can be moved to Base.ExecutionContext.__init__() after all
-		# the depreciated functions are removed.
-		self.__make_safe_namespace(self.__builtin_namespace)
-		self.__make_safe_namespace(self.__local_namespace)
-		self.__make_safe_namespace(self.__global_namespace)
-
-		return Function(
-			compiled_code = compiled_code,
-			local_namespace = {
-				'__builtins': self.__builtin_namespace,
-				'__namespace': self.__local_namespace},
-			global_namespace = self.__global_namespace)
-
 
 	# -------------------------------------------------------------------------
 	# Make sure the given Namespace has no invalid identifiers
@@ -297,3 +364,123 @@ class Function:
 			raise language.RuntimeError, (group, name, message, detail)
 
 		return __self.__local_namespace.get('__result')
+
+
+# =============================================================================
+# Class encapsulating user provided Python code compiled into a real function
+# =============================================================================
+
+class CompiledFunction:
+	"""
+	Implementation of a virtual function using a python function object.
+
+	The code is compiled once, calling it is a plain function call. The
+	function is rebuilt if names of the local namespace change afterwards.
+	"""
+
+	# -------------------------------------------------------------------------
+	# Constructor
+	# -------------------------------------------------------------------------
+
+	def __init__(self, build, local_namespace, builtin_namespace):
+
+		self.__build = build
+		self.__local_namespace = local_namespace
+		self.__builtin_namespace = builtin_namespace
+		(self.__function, self.__bound_names) = build()
+
+
+	# -------------------------------------------------------------------------
+	# Execute the function
+	# -------------------------------------------------------------------------
+
+	def __call__(__self, *args, **params):
+		"""
+		Call the compiled function with the given parameters.
+		"""
+
+		# We call our own self parameter "__self" here so that the user
+		# function can have a parameter "self".
+
+		if __self.__local_namespace.viewkeys() != __self.__bound_names:
+			(__self.__function, __self.__bound_names) = __self.__build()
+
+		# FIXME: This allows the "self" parameter to be passed as a non-keyword
+		# argument. DEPRECATED.
+		if args:
+			params['self'] = args[0]
+
+		builtins = __builtin__.__dict__
+		for (key, value) in __self.__builtin_namespace.iteritems():
+			if builtins.get(key) is not value:
+				builtins[key] = value
+
+		try:
+			return __self.__function(**params)
+
+		except language.AbortRequest:
+			# Pass through AbortRequests unchanged
+			raise
+
+		except:
+			# All others raise a RuntimeError
+			(group, name, message, detail) = errors.getException (1)
+			if group == 'system':
+				group = 'application'
+			raise language.RuntimeError, (group, name, message, detail)
+
+
+# =============================================================================
+# Self test code
+# =============================================================================
+
+if __name__ == '__main__':
+
+	import time
+
+	if not __builtin__.__dict__.has_key('gConfig'):
+		__builtin__.__dict__['gConfig'] = lambda name: True
+
+	class Record:
+		value = 0
+
+	triggers = {
+		'ON-NEWRECORD': """
+			self.value = 0
+			if counter[0] < 0:
+				abort("never")""",
+		'POST-CHANGE': """
+			counter[0] += 1
+			return self.value + 1""",
+	}
+
+	count = 100000
+
+	for compiled in (False, True):
+		context = ExecutionContext('benchmark', {}, {'counter': [0]}, {})
+		context.compiled = compiled
+
+		functions = [context.build_function(name, ['self'], code)
+			for (name, code) in triggers.items()]
+
+		record = Record()
+		start = time.time()
+		for i in xrange(count):
+			for function in functions:
+				function(self = record)
+		elapsed = time.time() - start
+
+		print "compiled=%-5s %d x %s: %.3f s, %.1f us/call" % (compiled,
+			count, ", ".join(triggers.keys()), elapsed,
+			elapsed * 1000000 / (count * len(functions)))
+
+	# names replaced by the same number of other names
+	names = {'old': 1}
+	context = ExecutionContext('rebind', names, {}, {})
+	context.compiled = True
+	function = context.build_function('rebind', [], "return new")
+	del names['old']
+	context.bindObject('new', 2)
+	assert function() == 2
+
+	print "Thank you for playing."
@@ -21,10 +21,10 @@
 #
 # $Id: dbf.py 9222 2007-01-08 13:02:49Z johannes $
 
-import struct
+import array
 import datetime
-import types
 import os
+import struct
 
 # =============================================================================
 # Exceptions
@@ -35,11 +35,137 @@ class InvalidFormatError (Exception):
 		Exception.__init__ (self, "Not a valid DBF file: %s" % message)
 
 
+# =============================================================================
+# Decoding of field values
+# =============================================================================
+
+def _decodeNumber (raw, decimals):
+	raw = raw.split ('\x00', 1) [0].strip () or 0
+	if decimals:
+		return float (raw)
+	else:
+		return int (raw)
+
+# -----------------------------------------------------------------------------
+
+def _decodeBoolean (raw, decimals):
+	raw = raw.strip ()
+	if raw in ['?', '']:
+		return None
+	return raw.lower () in ['t', 'y']
+
+# -----------------------------------------------------------------------------
+
+def _decodeDate (raw, decimals):
+	return datetime.date (int (raw [:4]), int (raw [4:6]), int (raw [6:]))
+
+# -----------------------------------------------------------------------------
+
+def _decodeInteger (raw, decimals):
+	return struct.unpack ('<i', raw) [0]
+
+# -----------------------------------------------------------------------------
+
+def _decodeString (raw, decimals):
+	return raw
+
+# -----------------------------------------------------------------------------
+
+_DECODERS = {
+	'N': _decodeNumber,
+	'L': _decodeBoolean,
+	'D': _decodeDate,
+	'I': _decodeInteger}
+
+
+# =============================================================================
+# A single record of a dBase file
+# =============================================================================
+
+class _Record (object):
+	"""
+	Read-only mapping of fieldnames to the values of a record. The values are
+	decoded from the contents of the file on access, so only the fields
+	actually asked for are converted.
+	"""
+
+	__slots__ = ['__buffer', '__offset', '__fields']
+
+	# ---------------------------------------------------------------------------
+	# Constructor
+	# ---------------------------------------------------------------------------
+
+	def __init__ (self, buffer, offset, fields):
+
+		self.__buffer = buffer
+		self.__offset = offset
+		self.__fields = fields
+
+	# ---------------------------------------------------------------------------
+	# Decode a single field
+	# ---------------------------------------------------------------------------
+
+	def __getitem__ (self, name):
+
+		(start, length, decimals, decode) = self.__fields [name]
+		start += self.__offset
+		raw = self.__buffer [start:start + length]
+
+		# Is the field empty ?
+		if not raw.strip ():
+			return None
+
+		return decode (raw, decimals)
+
+	# ---------------------------------------------------------------------------
+	# Dictionary interface
+	# ---------------------------------------------------------------------------
+
+	def get (self, name, default = None):
+		if name in self.__fields:
+			return self [name]
+		return default
+
+	def has_key (self, name):
+		return name in self.__fields
+
+	__contains__ = has_key
+
+	def keys (self):
+		return self.__fields.keys ()
+
+	def __iter__ (self):
+		return iter (self.__fields)
+
+	def __len__ (self):
+		return len (self.__fields)
+
+	def items (self):
+		return [(name, self [name]) for name in self.__fields]
+
+	def __repr__ (self):
+		return repr (dict (self.items ()))
+
+
 # =============================================================================
 # Class implementing read-only access to dBase files
 # =============================================================================
 
 class dbf:
+	"""
+	Read-only access to a dBase file.
+
+	Only the header is read when the file is opened. Records are read in pages
+	when they are accessed and decoded on access, so only the fields actually
+	asked for are converted. The file is not kept open between reads, records
+	already returned keep their values if the file is changed later, reading
+	more records of a changed file raises an InvalidFormatError. Deleted
+	records are skipped: indexing and len () refer to the remaining records
+	only.
+	"""
+
+	# Size of the pages records are read in
+	_page_size_ = 65536
 
 	_SIGNATURES = { 2: 'FoxBase',
 		3: 'File without DBT',
@@ -65,7 +191,6 @@ class dbf:
 
 		self.__filename = filename
 		self.__file     = open (filename, 'rb')
-		self.__size     = os.stat (filename).st_size
 
 		self.fields     = []
 		self.signature  = None
@@ -78,11 +203,20 @@ class dbf:
 		self.languageDriver = None
 
 		self.__version    = None
-		self.__cache      = []
+		self.__live       = None      # numbers of the undeleted records
+		self.__page       = None      # (first recno, data) of the last page read
+		self.__layout     = {}        # fieldname -> (start, length, dec, decoder)
+
+		try:
+			stat = os.fstat (self.__file.fileno ())
+			self.__size  = stat.st_size
+			self.__stamp = (stat.st_size, stat.st_mtime)
+			self.__readHeader ()
+			self.__readFieldDescriptorArray ()
+		finally:
+			self.__file.close ()
 
-		self.__readHeader ()
-		self.__readFieldDescriptorArray ()
-		self.__readRecords ()
+		self.__pageRecords = max (1, self._page_size_ / self.recordLen)
 
 
 	# ---------------------------------------------------------------------------
@@ -144,6 +278,9 @@ class dbf:
 		self.__file.seek (32, 0)
 		append = self.fields.append
 
+		# Field values start *after* the deleted flag
+		start = 1
+
 		for fix in range ((self.headerLen - 33) / 32):
 			fieldName = self.__file.read (11).split ('\x00', 1) [0].strip ()
 			fieldType = self.__file.read (1)
@@ -158,79 +295,109 @@ class dbf:
 
 			append ((fieldName, fieldType, fieldLen, decCount, hasIndex))
 
+			self.__layout [fieldName] = (start, fieldLen, decCount,
+				_DECODERS.get (fieldType, _decodeString))
+			start += fieldLen
+
 		if not self.fields:
 			raise InvalidFormatError, "Invalid field count"
 
 
 	# ---------------------------------------------------------------------------
-	# Read all records from the file and put them into the cache sequence
+	# Read the data of some records from the file
 	# ---------------------------------------------------------------------------
 
-	def __readRecords (self):
+	def __read (self, recno, count):
+
+		f = open (self.__filename, 'rb')
+		try:
+			stat = os.fstat (f.fileno ())
+			if (stat.st_size, stat.st_mtime) != self.__stamp:
+				raise InvalidFormatError, "file has been changed"
+
+			f.seek (self.dataOffset + recno * self.recordLen, 0)
+			data = f.read (count * self.recordLen)
+		finally:
+			f.close ()
+
+		if len (data) < count * self.recordLen:
+			raise InvalidFormatError, "wrong file size"
 
-		self.__file.seek (self.dataOffset)
-		append = self.__cache.append
+		return data
 
-		for recordNumber in xrange (self.__numRecords):
-			stream = self.__file.read (self.recordLen)
+	# ---------------------------------------------------------------------------
 
-			# The first byte in the record stream holds the 'deleted flag'
-			if stream [0] == '*':
-				continue
+	def __pages (self):
+		"""
+		Yield the number of the first record and the data of all pages.
+		"""
 
-			append (self.__getRecordDict (stream [1:]))
+		for first in xrange (0, self.__numRecords, self.__pageRecords):
+			yield (first, self.__read (first,
+				min (self.__pageRecords, self.__numRecords - first)))
 
 
 	# ---------------------------------------------------------------------------
-	# Convert a given record stream into a dictionary
+	# Find the undeleted records
 	# ---------------------------------------------------------------------------
 
-	def __getRecordDict (self, stream):
+	def __getLive (self):
+
+		if self.__live is None:
+			# The first byte of every record holds the 'deleted flag'
+			live = array.array ('L')
+			deleted = False
+			for (first, data) in self.__pages ():
+				flags = data [::self.recordLen]
+				if '*' in flags:
+					deleted = True
+				live.extend ([first + i for (i, flag) in enumerate (flags) \
+					if flag != '*'])
+
+			if deleted:
+				self.__live = live
+			else:
+				self.__live = xrange (self.__numRecords)
 
-		# The given stream starts *after* the deleted flag, so position 0 is the
-		# first byte of the first field.
+		return self.__live
 
-		cpos   = 0
-		record = {}
 
-		for (fname, ftype, flen, fdec, index) in self.fields:
-			raw = stream [cpos:cpos + flen]
-			cpos += flen
+	# ---------------------------------------------------------------------------
+	# Get the record with the given physical record number
+	# ---------------------------------------------------------------------------
+
+	def record (self, recno):
+		"""
+		Return the record with the given physical record number, including
+		deleted records.
 
-			# Is the field empty ?
-			if not raw.strip ():
-				value = None
+		@param recno: zero based number of the record in the file
+		@return: mapping of fieldnames to values
+		"""
 
-			# Numeric conversion
-			elif ftype == 'N':
-				if fdec:
-					value = float (raw.split ('\x00', 1) [0].strip () or 0)
-				else:
-					value = int (raw.split ('\x00', 1) [0].strip () or 0)
+		if not 0 <= recno < self.__numRecords:
+			raise IndexError, recno
 
-			# Booleans
-			elif ftype == 'L':
-				if raw.strip () in ['?', '']:
-					value = None
-				else:
-					value = raw.strip ().lower () in ['t', 'y']
+		first = recno - recno % self.__pageRecords
+		if self.__page is None or self.__page [0] != first:
+			self.__page = (first, self.__read (first,
+				min (self.__pageRecords, self.__numRecords - first)))
 
-			# Date values
-			elif ftype == 'D':
-				(year, month, day) = map (int, [raw [:4], raw [4:6], raw [6:]])
-				value = datetime.date (year, month, day)
+		return _Record (self.__page [1], (recno - first) * self.recordLen,
+			self.__layout)
 
-			# FoxPro Integers
-			elif ftype == 'I':
-				value = struct.unpack ('<i', raw) [0]
 
-			# All other types (including character data)
-			else:
-				value = raw
+	# ---------------------------------------------------------------------------
+	# Release the data read from the file
+	# ---------------------------------------------------------------------------
 
-			record [fname] = value
+	def close (self):
+		"""
+		Release the data read from the file. Records already returned keep their
+		data.
+		"""
 
-		return record
+		self.__page = None
 
 
 	# ---------------------------------------------------------------------------
@@ -238,7 +405,7 @@ class dbf:
 	# ---------------------------------------------------------------------------
 
 	def __len__ (self):
-		return len (self.__cache)
+		return len (self.__getLive ())
 
 
 	# ---------------------------------------------------------------------------
@@ -246,7 +413,7 @@ class dbf:
 	# ---------------------------------------------------------------------------
 
 	def __nonzero__ (self):
-		return len (self.__cache) > 0
+		return len (self.__getLive ()) > 0
 
 
 	# ---------------------------------------------------------------------------
@@ -255,8 +422,13 @@ class dbf:
 
 	def __iter__ (self):
 
-		for record in self.__cache:
-			yield record
+		layout = self.__layout
+		length = self.recordLen
+
+		for (first, data) in self.__pages ():
+			for (i, flag) in enumerate (data [::length]):
+				if flag != '*':
+					yield _Record (data, i * length, layout)
 
 
 	# ---------------------------------------------------------------------------
@@ -264,7 +436,14 @@ class dbf:
 	# ---------------------------------------------------------------------------
 
 	def __getitem__ (self, index):
-		return self.__cache [index]
+
+		live = self.__getLive ()
+
+		if isinstance (index, slice):
+			return [self.record (recno) for recno in \
+				[live [i] for i in xrange (*index.indices (len (live)))]]
+
+		return self.record (live [index])
 
 # =============================================================================
 # Module self test
@@ -272,23 +451,122 @@ class dbf:
 
 if __name__ == '__main__':
 
-	dbfile = dbf ('/home/johannes/checkit.dbf')
-
-	print "STATs:"
-	print "  Signature:", dbfile.signature
-	print "  # Records:", len (dbfile)
-	print "  Recordlen:", dbfile.recordLen
-	print "  incomplete transactions:", dbfile.incompleteTransaction
-	print "  Encrypted              :", dbfile.encrypted
-	print
-	print "  Fields"
-	for fdef in dbfile.fields:
-		print "    ", fdef
-
-	raw_input ()
-	print
-	print "ROWS:"
-	print
-
-	for row in dbfile:
-		print "  ", row
+	import sys
+	import tempfile
+	import time
+
+	# ---------------------------------------------------------------------------
+	# Write a test file with the given number of records
+	# ---------------------------------------------------------------------------
+
+	def writeTestFile (filename, count):
+
+		fields = [('ID', 'N', 10, 0), ('NAME', 'C', 40, 0), ('PRICE', 'N', 12, 2),
+			('BORN', 'D', 8, 0), ('ACTIVE', 'L', 1, 0), ('NOTE', 'C', 120, 0)]
+
+		headerLen = 32 + 32 * len (fields) + 1
+		recordLen = 1 + sum ([f [2] for f in fields])
+
+		out = open (filename, 'wb')
+		out.write (struct.pack ('<B3BLHH20x', 3, 107, 1, 1, count, headerLen,
+			recordLen))
+		for (name, ftype, length, dec) in fields:
+			out.write (struct.pack ('<11sc4xBB14x', name, ftype, length, dec))
+		out.write ('\x0d')
+
+		for i in xrange (count):
+			out.write ((i % 10 == 9) and '*' or ' ')
+			out.write ('%10d' % i)
+			out.write (('name %d' % i).ljust (40))
+			out.write ('%12.2f' % (i * 0.5))
+			out.write ('2007%02d%02d' % (i % 12 + 1, i % 28 + 1))
+			out.write ('TF' [i % 2])
+			out.write (('note %d' % i).ljust (120))
+
+		out.write ('\x1a')
+		out.close ()
+
+	# ---------------------------------------------------------------------------
+
+	if len (sys.argv) > 1:
+		dbfile = dbf (sys.argv [1])
+
+		print "STATs:"
+		print "  Signature:", dbfile.signature
+		print "  # Records:", len (dbfile)
+		print "  Recordlen:", dbfile.recordLen
+		print "  incomplete transactions:", dbfile.incompleteTransaction
+		print "  Encrypted              :", dbfile.encrypted
+		print
+		print "  Fields"
+		for fdef in dbfile.fields:
+			print "    ", fdef
+
+		print
+		print "ROWS:"
+		print
+
+		for row in dbfile:
+			print "  ", row
+
+		sys.exit ()
+
+	# Benchmark: open a file, read two columns of all records and look up single
+	# records by number
+	count = 200000
+	(handle, filename) = tempfile.mkstemp ('.dbf')
+	os.close (handle)
+
+	try:
+		writeTestFile (filename, count)
+		print "File with %d records, %d bytes" % (count, os.stat (filename).st_size)
+
+		start = time.time ()
+		dbfile = dbf (filename)
+		print "  open:            %8.4f s" % (time.time () - start)
+
+		start = time.time ()
+		total = len (dbfile)
+		print "  count:           %8.4f s (%d undeleted)" % (time.time () - start,
+			total)
+
+		assert total == count - count / 10
+		assert dbfile [0]['NAME'].strip () == 'name 0'
+		assert dbfile [9]['ID'] == 10
+		assert dbfile [-1]['ID'] == count - 2
+		assert dbfile [8]['PRICE'] == 4.0
+		assert dbfile [1]['BORN'] == datetime.date (2007, 2, 2)
+		assert dbfile [1]['ACTIVE'] is False
+		assert dbfile.record (9)['ID'] == 9
+
+		start = time.time ()
+		for row in dbfile:
+			(row ['ID'], row ['NAME'])
+		print "  two columns:     %8.4f s" % (time.time () - start)
+
+		start = time.time ()
+		for row in dbfile:
+			dict (row.items ())
+		print "  all columns:     %8.4f s" % (time.time () - start)
+
+		start = time.time ()
+		for i in xrange (0, total, 97):
+			dbfile [i]['NAME']
+		print "  random access:   %8.4f s (%d records)" % (time.time () - start,
+			len (xrange (0, total, 97)))
+
+		# Records don't change if the file is written again
+		row = dbfile [0]
+		dbfile.close ()
+		writeTestFile (filename, 1)
+		assert row ['NAME'].strip () == 'name 0'
+		try:
+			dbfile [1000]
+		except InvalidFormatError:
+			pass
+		else:
+			raise AssertionError, "changed file not detected"
+		assert len (dbf (filename)) == 1
+
+	finally:
+		os.unlink (filename)
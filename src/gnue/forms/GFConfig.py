@@ -260,4 +260,12 @@ ConfigOptions = (
 		'Description': 'Set path for include files for HTML UI driver for GNUe Forms',
 		'Typecast'   : GTypecast.text,
 		'Default'    : 'Z:X:' },
+
+	{ 'Name'       : 'FormTemplateCacheSize',
+		'Type'       : 'Setting',
+		'Comment'    : 'Number of parsed forms kept in memory, 0 disables the cache',
+		'Description': 'Number of parsed, translated forms kept in memory and '
+		+ 'copied for new form instances. 0 disables the cache.',
+		'Typecast'   : GTypecast.integer,
+		'Default'    : 200 },
 )
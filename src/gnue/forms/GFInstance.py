@@ -28,6 +28,8 @@ Classes that manage a running instance of GNUe Forms.
 import os
 import re
 import gc
+import urllib2
+import urlparse
 from urllib2 import HTTPError
 
 from gnue import paths
@@ -37,6 +39,7 @@ from gnue.common.datasources.GDataSource import getAppserverResource
 from gnue.common.utils import FileUtils
 from gnue.forms import GFForm
 from gnue.forms.GFParser import loadFile
+from gnue.forms.GFTemplateCache import templatecache
 from gnue.forms.input import GFKeyMapper
 from src.gnue.forms.GFExceptionDecorator import decorate_exception
 
@@ -237,8 +240,93 @@ class GFInstance(events.EventAware):
 
 	def __load_file_with_translations(self, filename, check_required):
 
+		size = gConfigForms('FormTemplateCacheSize')
+
+		if filename.startswith('appserver://') or not size:
+			return self.__parse_file_with_translations(filename, check_required)
+
+		templatecache.max_size = size
+
+		# the query string carries the session, the server tells about access
+		# with the ETag
+		url = self.__make_absolute_url(filename, False)
+		key = (url, i18n.getlanguage(), check_required)
+
+		if re.match(r'(?i)https?://', url):
+			return self.__load_http_template(filename, key, check_required)
+		else:
+			return self.__load_file_template(filename, key, check_required)
+
+	# -------------------------------------------------------------------------
+
+	def __load_file_template(self, filename, key, check_required):
+
+		(urltype, host, path, param, query, frag) = urlparse.urlparse(key[0])
+		if urltype not in ('file', '') or os.path.splitdrive(key[0])[0]:
+			path = key[0]
+
+		fingerprint = []
+		for fn in [path] + self.__translation_filenames(filename):
+			try:
+				stat = os.stat(fn)
+			except OSError:
+				continue
+			fingerprint.append((fn, stat.st_mtime, stat.st_size))
+		fingerprint = tuple(fingerprint)
+
+		form = templatecache.instantiate(key, fingerprint, self)
+		if form is None:
+			form = self.__parse_file_with_translations(filename, check_required)
+			templatecache.store(key, fingerprint, form, self, replace=True)
+		return form
+
+	# -------------------------------------------------------------------------
+
+	def __load_http_template(self, filename, key, check_required):
+
+		request = urllib2.Request(self.__make_absolute_url(filename))
+		etags = templatecache.fingerprints(key)
+		if etags:
+			request.add_header('If-None-Match', ', '.join(etags))
+
+		try:
+			filehandle = urllib2.urlopen(request)
+		except HTTPError, e:
+			if e.code == 304:
+				form = templatecache.instantiate(key, e.info().getheader('ETag'),
+					self)
+				if form is not None:
+					return form
+			# let the plain loader report errors
+			return self.__parse_file_with_translations(filename, check_required)
+		except IOError:
+			return self.__parse_file_with_translations(filename, check_required)
+
+		etag = filehandle.info().getheader('ETag')
+		form = self.__parse_file_with_translations(filename, check_required,
+			filehandle)
+		if etag:
+			templatecache.store(key, etag, form, self)
+		return form
+
+	# -------------------------------------------------------------------------
+
+	def __parse_file_with_translations(self, filename, check_required,
+		filehandle=None):
+
 		# Load base form
-		form = self.__load_file(filename, check_required)
+		form = self.__load_file(filename, check_required, filehandle)
+
+		# Merge language specific versions
+		for fn in self.__translation_filenames(filename):
+			if os.path.isfile(fn):
+				form.merge(self.__load_file(fn, False), overwrite=True)
+
+		return form
+
+	# -------------------------------------------------------------------------
+
+	def __translation_filenames(self, filename):
 
 		(base, ext) = os.path.splitext(filename)
 
@@ -252,19 +340,14 @@ class GFInstance(events.EventAware):
 				filenames.append(base + os.path.extsep + lang + ext)
 				filenames.append(os.path.join(base, lang + ext))
 
-		# Merge language specific versions
-		for fn in filenames:
-			if os.path.isfile(fn):
-				form.merge(self.__load_file(fn, False), overwrite=True)
-
-		return form
+		return filenames
 
 	# -------------------------------------------------------------------------
 
-	def __make_absolute_url(self, url):
+	def __make_absolute_url(self, url, add_query_string=True):
 		if self.__globals.get('__form_server_url__') and not re.match(r'(?i)[a-z]+://|/|[a-z]:', url):
 			url = '%s/%s' % (self.__globals.get('__form_server_url__'), url)
-		if self.__globals.get('__form_server_query_string__') and re.match(r'(?i)[a-z]+://', url):
+		if add_query_string and self.__globals.get('__form_server_query_string__') and re.match(r'(?i)[a-z]+://', url):
 			if re.search(r'(?i)\?[a-z]+\=', url):
 				url += '&'
 			else:
@@ -272,7 +355,7 @@ class GFInstance(events.EventAware):
 			url += self.__globals.get('__form_server_query_string__')
 		return url
 
-	def __load_file(self, filename, check_required):
+	def __load_file(self, filename, check_required, filehandle=None):
 		try:
 			if filename.startswith('appserver://'):
 				param = {'language': i18n.language, 'formwidth': 80,
@@ -282,7 +365,8 @@ class GFInstance(events.EventAware):
 				form = self.__load(filehandle, filename, check_required)
 				filehandle.close()
 			else:
-				filehandle = FileUtils.openResource(self.__make_absolute_url(filename))
+				if filehandle is None:
+					filehandle = FileUtils.openResource(self.__make_absolute_url(filename))
 				form = self.__load(filehandle, filename, check_required)
 				filehandle.close()
 
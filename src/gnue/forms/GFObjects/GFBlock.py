@@ -585,10 +585,10 @@ class GFBlock(GFContainer, events.EventAware):
 				field.clearLookup()
 				descFieldName = self.getField(field.fk_resolved_description).field
 				
-				for row in self.__rs:
-					key = row[field.field]
-					if key is not None:
-						field._addLookupPair(key, row[descFieldName] or _('(! unresolved: %s)') % key)
+				field._addLookupPairs([(row[field.field],
+						unicode(row[descFieldName]) if row[descFieldName] is not None \
+							else _('(! unresolved: %s)') % row[field.field])
+					for row in self.__rs if row[field.field] is not None])
 
 				field._refreshLookup()
 
@@ -25,8 +25,10 @@
 Fields of a block, representing database columns.
 """
 
+import bisect
 import re
 import types
+import weakref
 from gnue.common.apps               import errors
 from gnue.common.definitions        import GParser
 from gnue.common.utils              import datatypes
@@ -75,9 +77,13 @@ class GFField(GFObj):
 		# Lookup info for foreign key lookup fields
 		self.__is_lookup = False                # True for lookup fields
 		self.__lookup_list = []                 # all valid user values
+		self.__lookup_folded = []               # [(upper user_value, user_value)]
+		self.__lookup_sorted = True             # False if lists need sorting
 		self.__lookup_dict = {}                 # {db_value: user_value}
 		self.__lookup_dict_reverse = {}         # {user_value: db_value}
 		self.__fkReset = False                 # set to True at first fk datasorce refresh
+		self.__fk_resultSet = None
+		self.__fk_record_keys = weakref.WeakKeyDictionary() # {record: db_value}
 
 		# Autoquery support
 		self.__autoquery_value = None
@@ -247,7 +253,11 @@ class GFField(GFObj):
 			self.__fk_datasource.registerEventListeners ({
 					'dsResultSetActivated': self.__dsResultSetActivated,
 					'dsResultSetChanged'  : self.__dsResultSetActivated, # sic!
-					'dsCursorMoved'       : self.__dsCursorMoved})
+					'dsCursorMoved'       : self.__dsCursorMoved,
+					'dsRecordInserted'    : self.__dsRecordChanged,
+					'dsRecordChanged'     : self.__dsRecordChanged,
+					'dsRecordDeleted'     : self.__dsRecordChanged,
+					'dsRecordUndeleted'   : self.__dsRecordChanged})
 
 			self.__is_lookup = True
 
@@ -337,8 +347,14 @@ class GFField(GFObj):
 		if not self.__is_lookup or getattr(self, 'disableAutoCompletion', False):
 			return (value, cursor)
 
-		for allowed in self.__lookup_list:
-			if allowed.upper().startswith(value.upper()):
+		self.__sort_lookup()
+
+		# The first entry not less than the prefix is the only candidate
+		prefix = value.upper()
+		index = bisect.bisect_left(self.__lookup_folded, (prefix,))
+		if index < len(self.__lookup_folded):
+			(folded, allowed) = self.__lookup_folded[index]
+			if folded.startswith(prefix):
 				return (allowed, cursor)
 
 		# Nothing found, return original user input.
@@ -658,24 +674,17 @@ class GFField(GFObj):
 
 		#load allowed values
 		self.clearLookup()
-
-		dpSep = gConfigForms('DropdownSeparator')
-		if dpSep.startswith('"') and dpSep.endswith('"') and len(dpSep) > 2:
-			dpSep = dpSep[1:-1]
+		self.__fk_record_keys.clear()
 
 		array = event.resultSet.getArray([self.fk_key] + self.__fk_descr)
 		if not array and self.required:
 			gDebug(1, "WARNING: empty item added the choices of a required " \
 					"field")
-			self.__lookup_list.append(u"")
-
-		for line in array:
-			key = line[0]
-			descr = dpSep.join(["%s" % i for i in line[1:]])
+			self.__add_lookup_value(u"")
 
-			self._addLookupPair(key, descr, sortLookupList=False)
-
-		self.__lookup_list.sort()
+		dpSep = self.__dropdown_separator()
+		self._addLookupPairs([(line[0], dpSep.join(["%s" % i for i in line[1:]]))
+				for line in array])
 
 		# And now, position the resultSet to the correct record according to
 		# the current field content.
@@ -705,14 +714,61 @@ class GFField(GFObj):
 		self.__refresh_ui()
 
 
+	def __dsRecordChanged(self, event):
+
+		# A record of the *foreign key* result set has been inserted, changed or
+		# deleted: update its pair in the valid values.
+		if self.__fk_resultSet is None:
+			return
+
+		fields = getattr(event, 'fields', None)
+		if fields is not None and self.fk_key not in fields \
+				and not [f for f in fields if f in self.__fk_descr]:
+			return
+
+		record = event.record
+		if record in self.__fk_record_keys:
+			old_key = self.__fk_record_keys[record]
+		elif record.isInserted():
+			old_key = None
+		else:
+			old_key = record.getInitialValue(self.fk_key)
+
+		if record.isDeleted():
+			key = None
+		else:
+			key = record[self.fk_key]
+
+		if old_key is not None and old_key != key \
+				and old_key in self.__lookup_dict:
+			self._removeLookupPair(old_key)
+		if key is not None:
+			self._addLookupPair(key, self.__dropdown_separator().join(
+				["%s" % record[f] for f in self.__fk_descr]))
+		self.__fk_record_keys[record] = key
+
+		self._refreshLookup()
+
+	# -------------------------------------------------------------------------
+
+	def __dropdown_separator(self):
+
+		dpSep = gConfigForms('DropdownSeparator')
+		if dpSep.startswith('"') and dpSep.endswith('"') and len(dpSep) > 2:
+			dpSep = dpSep[1:-1]
+		return dpSep
+
+
 	def isLookup(self):
 		return self.__is_lookup
 
 
 	def clearLookup(self):
 		del self.__lookup_list[:]
+		del self.__lookup_folded[:]
+		self.__lookup_sorted = True
 		if not self.required:
-			self.__lookup_list.append(u"")
+			self.__add_lookup_value(u"")
 		self.__lookup_dict.clear()
 		self.__lookup_dict_reverse.clear()
 
@@ -721,11 +777,62 @@ class GFField(GFObj):
 		self._refreshLookup()
 
 	def _addLookupPair(self, key, descr, sortLookupList=True):
-		self.__lookup_list.append(descr)
-		if sortLookupList:
-			self.__lookup_list.sort()
+		"""
+		Add a valid key and its user value. A user value already known for the
+		key is replaced.
+
+		@param sortLookupList: if False, the lookup list is only sorted on the
+		    next access. Use L{_addLookupPairs} to add many pairs at once.
+		"""
+		if key in self.__lookup_dict:
+			if self.__lookup_dict[key] == descr:
+				return
+			self._removeLookupPair(key)
 		self.__lookup_dict[key] = descr
 		self.__lookup_dict_reverse[descr] = key
+		if sortLookupList and self.__lookup_sorted:
+			self.__insort_lookup_value(descr)
+		else:
+			self.__add_lookup_value(descr)
+
+	def _addLookupPairs(self, pairs):
+		"""
+		Add a sequence of (key, user value) pairs. The lookup list is sorted only
+		once on the next access.
+		"""
+		for (key, descr) in pairs:
+			self._addLookupPair(key, descr, sortLookupList=False)
+
+	def _removeLookupPair(self, key):
+		"""
+		Remove a key and its user value from the valid values.
+		"""
+		descr = self.__lookup_dict.pop(key)
+		if self.__lookup_dict_reverse.get(descr) == key:
+			del self.__lookup_dict_reverse[descr]
+
+		if self.__lookup_sorted:
+			del self.__lookup_list[bisect.bisect_left(self.__lookup_list, descr)]
+			del self.__lookup_folded[bisect.bisect_left(self.__lookup_folded,
+				(descr.upper(), descr))]
+		else:
+			self.__lookup_list.remove(descr)
+			self.__lookup_folded.remove((descr.upper(), descr))
+
+	def __add_lookup_value(self, descr):
+		self.__lookup_list.append(descr)
+		self.__lookup_folded.append((descr.upper(), descr))
+		self.__lookup_sorted = False
+
+	def __insort_lookup_value(self, descr):
+		bisect.insort(self.__lookup_list, descr)
+		bisect.insort(self.__lookup_folded, (descr.upper(), descr))
+
+	def __sort_lookup(self):
+		if not self.__lookup_sorted:
+			self.__lookup_list.sort()
+			self.__lookup_folded.sort()
+			self.__lookup_sorted = True
 
 	def _refreshLookup(self):
 		# Update the list of choices in all entries bound to this field
@@ -765,6 +872,8 @@ class GFField(GFObj):
 
 	def __refresh_ui_choices(self):
 
+		self.__sort_lookup()
+
 		if self._block.mode == 'query':
 			lookup = [u_("(all)"), u_("(empty)")] + self.__lookup_list
 			if '' in lookup:
@@ -1002,3 +1111,124 @@ class InvalidDefaultValueError(GParser.MarkupError):
 			) % {
 				'value': value,
 				'name': field.name}, field._url, field._lineNumber)
+
+
+# =============================================================================
+# Self test and benchmark of the lookup structures
+# =============================================================================
+
+if __name__ == '__main__':
+
+	import random
+	import time
+
+	count = 100000
+	random.seed(1)
+	words = [u"%s %d" % (random.choice([u"alpha", u"Beta", u"gamma", u"Delta"]),
+		i) for i in xrange(count)]
+
+	field = GFField()
+	field.required = False
+	field._GFField__is_lookup = True
+
+	start = time.time()
+	field.clearLookup()
+	field._addLookupPairs(enumerate(words))
+	field._GFField__sort_lookup()
+	print "Bulk load of %d pairs: %.3f s" % (count, time.time() - start)
+
+	# The old way: sort the whole list after every pair
+	old = []
+	start = time.time()
+	for descr in words[:5000]:
+		old.append(descr)
+		old.sort()
+	print "Sorting after each of 5000 pairs: %.3f s" % (time.time() - start)
+
+	prefixes = [w[:random.randint(1, len(w))].lower() for w in
+		random.sample(words, 1000)]
+
+	start = time.time()
+	for prefix in prefixes:
+		(result, cursor) = field.autocomplete(prefix, len(prefix))
+		assert result.upper().startswith(prefix.upper())
+	print "1000 autocompletions: %.4f s" % (time.time() - start)
+
+	allowed = sorted(words + [u""], key=lambda w: (w.upper(), w))
+	start = time.time()
+	for prefix in prefixes[:50]:
+		for value in allowed:
+			if value.upper().startswith(prefix.upper()):
+				break
+		assert field.autocomplete(prefix, 0)[0] == value
+	print "50 autocompletions by linear scan: %.4f s" % (time.time() - start)
+
+	# Incremental changes keep the structures sorted
+	start = time.time()
+	for key in xrange(0, count, 10):
+		field._removeLookupPair(key)
+	for key in xrange(0, count, 20):
+		field._addLookupPair(key, u"epsilon %d" % key)
+	field._addLookupPair(1, u"Zeta")
+	print "%d removals and %d inserts: %.3f s" % (count / 10, count / 20,
+		time.time() - start)
+
+	lookup = field._GFField__lookup_list
+	assert lookup == sorted(lookup)
+	assert len(lookup) == count - count / 10 + count / 20 + 1
+	assert field.autocomplete(u"EPS", 3)[0] == u"epsilon 0"
+	assert field.autocomplete(u"zet", 3)[0] == u"Zeta"
+	assert field.autocomplete(u"xyz", 3) == (u"xyz", 3)
+	assert field.reverse_lookup(u"Zeta") == 1
+
+	# Changes of the foreign key records update the valid values
+	class Block:
+		mode = 'normal'
+
+	class Record(object):
+		inserted = deleted = False
+		def __init__(self, data):
+			self.data = dict(data)
+			self.initial = dict(data)
+		def __getitem__(self, fieldname):
+			return self.data[fieldname]
+		def __setitem__(self, fieldname, value):
+			self.data[fieldname] = value
+		def isInserted(self):
+			return self.inserted
+		def isDeleted(self):
+			return self.deleted
+		def getInitialValue(self, fieldname):
+			return self.initial.get(fieldname)
+
+	class Event:
+		def __init__(self, record, fields=None):
+			self.record = record
+			if fields is not None:
+				self.fields = fields
+
+	import __builtin__
+	__builtin__.__dict__['gConfigForms'] = lambda name: '"; "'
+	field._block = Block()
+	field.fk_key = 'id'
+	field._GFField__fk_descr = ['name', 'born']
+	field._GFField__fk_resultSet = []
+	changed = field._GFField__dsRecordChanged
+
+	record = Record({'id': 1, 'name': u"Zeta", 'born': 1970})
+	record['name'] = u"Omega"
+	changed(Event(record, ('name',)))
+	assert field.reverse_lookup(u"Omega; 1970") == 1
+	record['id'] = -1
+	changed(Event(record, ('id',)))
+	assert field.reverse_lookup(u"Omega; 1970") == -1 and 1 not in field._GFField__lookup_dict
+	record.deleted = True
+	changed(Event(record))
+	assert -1 not in field._GFField__lookup_dict
+	record = Record({'id': None, 'name': None, 'born': None})
+	record.inserted = True
+	changed(Event(record))
+	record.data.update({'id': -2, 'name': u"New", 'born': 2000})
+	changed(Event(record, ('id', 'name', 'born')))
+	assert field.reverse_lookup(u"New; 2000") == -2
+	assert field._GFField__lookup_list == sorted(field._GFField__lookup_list)
@@ -24,7 +24,8 @@
 Splitter
 """
 
-import operator
+import weakref
+
 #from GFObj import GFObj as BaseClass
 from gnue.common.logic.usercode import UserCode as BaseClass
 
@@ -36,16 +37,28 @@ __all__ = ['GFTotal']
 # =============================================================================
 
 class GFTotal(BaseClass):
+	"""
+	Keeps the total of a column in the parent field.
+
+	Totals are maintained incrementally: every record contributes one value
+	(None if it does not count) and a change of a record applies the
+	difference of its old and new contribution. Only min and max have to be
+	calculated again, when the current minimum or maximum is changed.
+
+	A clean record contributes its initial value, so only the contributions
+	of changed records are kept. Records dropped from the record window and
+	fetched again are counted correctly this way.
 
-	OPERATIONS = {
-		#          reduce function          filter function           start value
-		#          -----------------------  ------------------------  -----------
-		'sum'   : (lambda r, x: r + x,      lambda x: x is not None,  0          ),
-		'count' : (lambda r, x: r + 1,      lambda x: True,           0          ),
-		'min'   : (lambda r, x: min(r, x),  lambda x: x is not None,  None       ),
-		'max'   : (lambda r, x: max(r, x),  lambda x: x is not None,  None       ),
+	With pushdown the start values are calculated by the database, so records
+	not fetched yet are counted without loading them. A changed minimum or
+	maximum is calculated by the database too, from the records not changed
+	locally and the contributions of the changed ones.
+	"""
 
-	# assume start value to be first value if start value is None
+	# function -> function returning the better of two values
+	EXTREMES = {
+		'min' : min,
+		'max' : max,
 	}
 
 	# -------------------------------------------------------------------------
@@ -54,6 +67,7 @@ class GFTotal(BaseClass):
 
 	def __init__(self, parent=None):
 		BaseClass.__init__(self, parent, "GFTotal")
+		self.pushdown = False
 
 	# -------------------------------------------------------------------------
 	# Initialisation
@@ -69,6 +83,13 @@ class GFTotal(BaseClass):
 		self.__resultSet = None
 		self.__field = None
 
+		# incremental state
+		self.__values = weakref.WeakKeyDictionary()	# changed record -> contribution
+		self.__sum = 0
+		self.__count = 0
+		self.__extreme = None
+		self.__valid = False
+
 		for source in self.source.split(','):
 			blockName, fieldName = source.strip().split('.')
 			block = self.getParent()._form._logic.getBlock(blockName)
@@ -80,10 +101,25 @@ class GFTotal(BaseClass):
 
 			assert self.__field is None or self.function == 'usercode', "multiple source in totals requires function='usercode'"
 			self.__field = block.getField(fieldName)
-			self.__field.associateTrigger('POST-CHANGE', self.__on_field_change)
+
+			if self.function == 'usercode':
+				self.__field.associateTrigger('POST-CHANGE', self.__on_field_change)
+			else:
+				block.getDataSource().registerEventListeners({
+						'dsRecordInserted'    : self.__ds_record_changed,	# from datasources.drivers.Base.Record
+						'dsRecordChanged'     : self.__ds_record_changed,	# -/-
+						'dsRecordDeleted'     : self.__ds_record_changed,	# -/-
+						'dsRecordUndeleted'   : self.__ds_record_changed,	# -/-
+					})
+
+	# -------------------------------------------------------------------------
+	# Events
+	# -------------------------------------------------------------------------
 
 	def __ds_resultset_activated(self, event):
 		self.__resultSet = event.resultSet
+		if self.function != 'usercode':
+			self.__start()
 		self.__refresh()
 
 	def __on_field_change(__self, *args, **kwargs):
@@ -91,22 +127,155 @@ class GFTotal(BaseClass):
 		if __self.__resultSet:
 			__self.__refresh()
 
-	def __calculate(self):
-		reduceFn, filterFn, startValue = self.OPERATIONS[self.function]
+	def __ds_record_changed(self, event):
+		if self.__resultSet is None:
+			return
 
-		columnName = self.__field.field
+		record = event.record
+		if event.getEvent() == 'dsRecordInserted':
+			# the record is not in the cache of its result set yet
+			old = None
+		elif not self.__resultSet.hasRecord(record):
+			# record of another result set of the datasource
+			return
+		else:
+			old = self.__values.get(record, NotImplemented)
+			if old is NotImplemented:
+				old = self.__cleanContribution(record)
 
-		values   = (row[columnName] for row in self.__resultSet if not row.isEmpty())
-		filtered = (i for i in values if filterFn(i))
+		new = self.__recordContribution(record)
+		self.__keep(record, new)
+		if new != old:
+			self.__apply(old, new)
+			self.__refresh()
 
-		try:
-			if startValue is None:
-				startValue = filtered.next()
-				assert not isinstance(startValue, float), 'must be decimal!'
-		except StopIteration:
+	# -------------------------------------------------------------------------
+	# Incremental calculation
+	# -------------------------------------------------------------------------
+
+	def __contribution(self, value):
+		if self.function == 'count':
+			return 1
+		else:
+			return value
+
+	def __recordContribution(self, record):
+		if record.isEmpty() or record.isDeleted():
+			return None
+		return self.__contribution(record[self.__field.field])
+
+	def __cleanContribution(self, record):
+		"""
+		Contribution of the record as loaded from the backend
+		"""
+		if record.isEmpty() or record.isInserted() or record.isVoid():
 			return None
+		return self.__contribution(record.getInitialValue(self.__field.field))
+
+	def __keep(self, record, value):
+		"""
+		Remember the contribution of a record if it differs from the clean one
+		"""
+		if value == self.__cleanContribution(record):
+			self.__values.pop(record, None)
+		else:
+			self.__values[record] = value
+
+	def __start(self):
+		"""
+		Calculate start values for the new result set
+		"""
+		self.__values.clear()
+		self.__sum = 0
+		self.__count = 0
+		self.__extreme = None
+		self.__valid = True
+
+		if self.pushdown and self.__resultSet.canAggregate():
+			columnName = self.__field.field
+			if self.function == 'count':
+				self.__sum = self.__count = self.__resultSet.aggregate('count', None)
+			elif self.function in self.EXTREMES:
+				self.__extreme = self.__resultSet.aggregate(self.function, columnName)
+			else:
+				self.__sum = self.__resultSet.aggregate('sum', columnName) or 0
+				self.__count = self.__resultSet.aggregate('count', columnName)
+		else:
+			self.__scan()
+
+	def __scan(self):
+		"""
+		Calculate totals from all records of the result set
+		"""
+		self.__values.clear()
+		self.__sum = 0
+		self.__count = 0
+		self.__extreme = None
+		self.__valid = True
+
+		for record in self.__resultSet:
+			value = self.__recordContribution(record)
+			self.__keep(record, value)
+			self.__apply(None, value)
+
+	def __reaggregate(self):
+		"""
+		Calculate minimum or maximum by the database, with the changed records
+		replaced by their contributions
+		"""
+		better = self.EXTREMES[self.function]
+		changed = self.__values.items()
+
+		values = [value for record, value in changed if value is not None]
+		values.append(self.__resultSet.aggregate(self.function, self.__field.field,
+			exclude=[record for record, value in changed]))
+		values = [value for value in values if value is not None]
+
+		self.__extreme = reduce(better, values) if values else None
+		self.__valid = True
+
+	def __apply(self, old, new):
+		"""
+		Replace contribution old of a record with new one
+		"""
+		better = self.EXTREMES.get(self.function)
+
+		if better is None:
+			if old is not None:
+				self.__sum -= old
+				self.__count -= 1
+			if new is not None:
+				self.__sum += new
+				self.__count += 1
+
+		elif self.__valid:
+			if old is not None and old == self.__extreme \
+					and (new is None or better(old, new) != new):
+				# current extreme is gone, scan again when needed
+				self.__valid = False
+			elif new is not None and (self.__extreme is None or better(self.__extreme, new) == new):
+				self.__extreme = new
+
+	def __calculate(self):
+		if self.function in self.EXTREMES:
+			if not self.__valid:
+				if self.pushdown and self.__resultSet.canAggregate() \
+						and self.__resultSet._getPrimarykeyFields():
+					self.__reaggregate()
+				else:
+					self.__scan()
+			assert not isinstance(self.__extreme, float), 'must be decimal!'
+			return self.__extreme
+
+		elif self.function == 'avg':
+			if self.__count:
+				if isinstance(self.__sum, (int, long)):
+					return float(self.__sum) / self.__count
+				return self.__sum / self.__count
+			return None
+
 		else:
-			return reduce(reduceFn, filtered, startValue)
+			return self.__sum
 
 	def __refresh(self):
 		if self.function == 'usercode':
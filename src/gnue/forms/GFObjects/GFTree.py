@@ -34,6 +34,7 @@ import datetime
 
 from GFTabStop                      import GFTabStop
 from toolib                         import debug
+from gnue.common.apps               import errors
 from gnue.common.datasources.access import ACCESS
 from src.gnue.forms.GFObjects import GFStyles
 
@@ -41,6 +42,9 @@ from src.gnue.forms.GFObjects import GFStyles
 REC_FIELD = re.compile(r"\%(\([A-Za-z_]\w*\))")
 DEBUG=0
 
+# max number of parent ids in one condition when loading lazy tree nodes
+_LEVEL_CHUNK = 200
+
 
 
 class GFTreeMixIn(object):
@@ -56,6 +60,7 @@ class GFTreeMixIn(object):
 
 		# default attribute values
 		self.rootname = None
+		self.lazy = False
 
 		# will be definded in phase 1 init
 		self._rootId          = None
@@ -74,6 +79,10 @@ class GFTreeMixIn(object):
 		self._idRow = {}
 		self._structureChanged = False
 
+		# lazy tree data, nodes loaded from backend
+		self.__parentIds = {}		# { id : parentId }
+		self.__nodeValues = {}		# { id : { rsField : value } }
+
 		self.__nodeStyles = None
 
 		# state fix
@@ -178,6 +187,8 @@ class GFTreeMixIn(object):
 		#
 		self.__childIds.clear()
 		self._idRow.clear()
+		self.__parentIds.clear()
+		self.__nodeValues.clear()
 
 		# if we have virtual root
 		if self.rootname is not None:
@@ -186,16 +197,20 @@ class GFTreeMixIn(object):
 
 			# children of NotImplemented parent is Virtual Root (row -1)
 			self.__childIds[NotImplemented] = [self._rootId]
-
-		for row, record in enumerate(self._rs or ()):
-			if not record.isDeleted() and not record.isEmpty():
-				id = record[self._fldId]
-				self._idRow[id] = row
-				parentId = record[self._fldParent]
-				if id != parentId:
-					self.__childIds.setdefault(parentId, []).append(id)
-				else:
-					debug.error("! Cyclic tree node reference removed", id)
+			self.__parentIds[self._rootId] = NotImplemented
+
+		# lazy tree loads nodes on demand, see __loadLevel
+		if not self.lazy:
+			for row, record in enumerate(self._rs or ()):
+				if not record.isDeleted() and not record.isEmpty():
+					id = record[self._fldId]
+					self._idRow[id] = row
+					parentId = record[self._fldParent]
+					if id != parentId:
+						self.__childIds.setdefault(parentId, []).append(id)
+						self.__parentIds[id] = parentId
+					else:
+						debug.error("! Cyclic tree node reference removed", id)
 
 		#######################################
 		if 0:
@@ -212,6 +227,124 @@ class GFTreeMixIn(object):
 		print "------------------------------------"
 		print self._idRow
 		print "------------------------------------"
+
+	##################################################################
+	# Lazy loading
+	#
+	def __loadLevel(self, parentIds):
+		"""
+		loads children of all given parents from backend
+		with one query per _LEVEL_CHUNK parents
+		"""
+		parentIds = [i for i in parentIds if i is not NotImplemented and i not in self.__childIds]
+		for i in parentIds:
+			self.__childIds[i] = []
+
+		for start in xrange(0, len(parentIds), _LEVEL_CHUNK):
+			chunk = parentIds[start:start + _LEVEL_CHUNK]
+			for id, parentId in self.__queryNodes(self._fldParent, chunk):
+				if id != parentId:
+					self.__childIds[parentId].append(id)
+				else:
+					debug.error("! Cyclic tree node reference removed", id)
+
+	def __queryNodes(self, rsField, values):
+		"""
+		queries nodes with rsField value in values, caches node values
+		and yields (id, parentId) for every node found
+		"""
+		fields = [self._fldId, self._fldParent] + self._fldsNodeName
+		if self._fldStyle:
+			fields.append(self._fldStyle)
+
+		rs = self._block.getDataSource().createDetachedResultSet(
+			self.__conditions(rsField, values))
+		try:
+			for record in rs:
+				id = record[self._fldId]
+				parentId = record[self._fldParent]
+				self.__nodeValues[id] = dict([(field, record[field]) for field in fields])
+				if id != parentId:
+					self.__parentIds[id] = parentId
+				yield id, parentId
+		finally:
+			rs.close()
+
+	def __queryNodesData(self, ids, fieldnames):
+		"""
+		returns { id : { fieldname : value } } of nodes loaded from backend
+		with one query per _LEVEL_CHUNK ids
+		"""
+		fields = [(name, self._rsField(name)) for name in fieldnames]
+		result = {}
+		for start in xrange(0, len(ids), _LEVEL_CHUNK):
+			rs = self._block.getDataSource().createDetachedResultSet(
+				self.__conditions(self._fldId, ids[start:start + _LEVEL_CHUNK]))
+			try:
+				for record in rs:
+					result[record[self._fldId]] = dict([(name, record[field]) for name, field in fields])
+			finally:
+				rs.close()
+		return result
+
+	def __conditions(self, rsField, values):
+		conditions = [
+			['null', ['field', rsField]] if value is None else ['eq', ['field', rsField], ['const', value]]
+			for value in values
+		]
+		if len(conditions) > 1:
+			conditions.insert(0, 'or')
+		else:
+			conditions = conditions[0]
+		return conditions
+
+	def __getParentId(self, id):
+		"""
+		returns parent id of node, loads node from backend if not known yet
+		raises KeyError if there is no such node
+		"""
+		try:
+			return self.__parentIds[id]
+		except KeyError:
+			if self.lazy and id is not NotImplemented:
+				for i in self.__queryNodes(self._fldId, [id]):
+					pass
+			return self.__parentIds[id]
+
+	def __children(self, nodeId):
+		try:
+			return self.__childIds[nodeId]
+		except KeyError:
+			if self.lazy and nodeId is not NotImplemented:
+				self.__loadLevel([nodeId])
+				return self.__childIds[nodeId]
+			return ()
+
+	def _getNodeValue(self, id, rsField):
+		"""
+		returns resultset field value of node
+		"""
+		if self.lazy:
+			try:
+				return self.__nodeValues[id][rsField]
+			except KeyError:
+				pass
+		return self._rs[self._getRow(id)][rsField]
+
+	def _getRow(self, id):
+		"""
+		returns block row of node
+		lazy tree knows only row of current record
+		"""
+		if self.lazy:
+			if id == self._rootId and self.rootname is not None:
+				return -1
+			row = self._rs.getRecordNumber()
+			if row >= 0 and self._rs[row][self._fldId] == id:
+				return row
+			raise KeyError, id
+		else:
+			return self._idRow[id]
 	
 	def _iterRowsRecursive(self, row, includeSelf=True):
 
@@ -233,22 +366,28 @@ class GFTreeMixIn(object):
 			return self._rootId
 
 	def iterChildIds(self, nodeId):
-		return self.__childIds.get(nodeId, ())
+		children = self.__children(nodeId)
+		if self.lazy:
+			# load next level at once so child counts of children are known
+			self.__loadLevel(children)
+		return children
 
 	def iterChildIdsRecursive(self, nodeId, includeSelf=True):
 		if includeSelf:
 			yield nodeId
-		for i in self.__childIds.get(nodeId, ()):
+		for i in self.iterChildIds(nodeId):
 			for j in self.iterChildIdsRecursive(i, True):
 				yield j
 
 	def getChildCount(self, id):
-		return len(self.__childIds.get(id, ()))
+		return len(self.__children(id))
 
 	def formatNodeName(self, id):
 		if id != self._rootId:
-			row = self._idRow[id]
-			return (self.__nodeNamePattern % tuple([self._getFieldFormattedValueAt(row, field) for field in self.__nodeNameFields])).replace('\n', ' ').strip()
+			return (self.__nodeNamePattern % tuple([
+				self._formatFieldValue(field, self._getNodeValue(id, self._rsField(field)))
+				for field in self.__nodeNameFields
+			])).replace('\n', ' ').strip()
 		else:
 			return self.rootname
 
@@ -258,7 +397,7 @@ class GFTreeMixIn(object):
 		works only for text fields
 		"""
 		if id is not NotImplemented:
-			row = self._idRow[id]
+			row = self._getRow(id)
 			pattern = re.sub(r'(?i)\\\%[^a-z]*[a-z]', lambda m: '(.+)', re.escape(self.__nodeNamePattern)) + '$'
 			m = re.match(pattern, text)
 			if m:
@@ -293,15 +432,13 @@ class GFTreeMixIn(object):
 			idPath.append(id)
 			#rint 'appended', id
 			try:
-				row = self._idRow[id]
+				id = self.__getParentId(id)
 			except KeyError:
 				#rint "stop via KeyError"
 				break
-			else:
-				if row == -1:
-					id = NotImplemented
-				else:
-					id = self._rs[row][self._fldParent]
+			if id in idPath:
+				debug.error("! Cyclic tree node reference", id)
+				break
 		idPath.reverse()
 		#rint "getIdPath:", idPath
 		return idPath
@@ -310,14 +447,10 @@ class GFTreeMixIn(object):
 		return self.__nodeStyles
 
 	def getNodeStyleKey(self, id):
-		if self._fldStyle:
-			row = self._idRow[id]
-			if row >=0:
-				return self._rs[row][self._fldStyle]
-			else:
-				# virtual root has default style
-				return 'default'
+		if self._fldStyle and (id != self._rootId or self.rootname is None):
+			return self._getNodeValue(id, self._fldStyle)
 		else:
+			# virtual root has default style
 			return 'default'
 
 	def getNodeStyle(self, id):
@@ -362,6 +495,10 @@ class GFTreeMixIn(object):
 		if nameChanged or styleChanged:
 			id = event.record[self._fldId]
 			if id is not None:
+				values = self.__nodeValues.get(id)
+				if values is not None:
+					for field in values:
+						values[field] = event.record[field]
 				self.uiWidget._ui_revalidate_node_(id, nameChanged, styleChanged)
 
 	#####################################################
@@ -371,6 +508,12 @@ class GFTreeMixIn(object):
 		"""
 		node selected with cursor
 		"""
+		if self.lazy and id != self._rootId:
+			# node may be not fetched by block yet
+			if not self._block.find_record({self.fld_id: id}):
+				debug.error('No row for id: %s' % id)
+			return
+
 		try:
 			row = self._idRow[id]
 		except KeyError:
@@ -416,12 +559,14 @@ class GFTreeMixIn(object):
 		self._rs[row][self._rsField(field)] = value
 
 	def _getFieldFormattedValueAt(self, row, field):
+		return self._formatFieldValue(field, self._getFieldValueAt(row, field))
+
+	def _formatFieldValue(self, field, value):
 
 		# NOTE: tree has no entries so displayparser is not accessible
 		# TODO: extract display parsing and formatting to GFField
 		# unless can't set values to notext fields
 
-		value = self._getFieldValueAt(row, field)
 		if value is None:
 			return ""
 		else:
@@ -455,6 +600,16 @@ class GFTreeMixIn(object):
 	#
 
 	def __trigger_getCheckedNodesData(self, fieldnames, reduceChildren=False, style=NotImplemented):
+		if self.lazy:
+			# checked nodes need not be rows of the block
+			ids = [
+				id
+				for id in self.uiWidget._ui_get_checked_nodes_(reduceChildren)
+				if id is not NotImplemented and id != self._rootId and (style is NotImplemented or style == self.getNodeStyle(id).name)
+			]
+			data = self.__queryNodesData(ids, fieldnames)
+			return [data[id] for id in ids if id in data]
+
 		data = self._block.get_data(fieldnames)
 		return [
 			data[self._idRow[id]] 
@@ -474,6 +629,13 @@ class GFTreeMixIn(object):
 		self.uiWidget._ui_check_all_nodes_(checked)
 	
 	def __trigger_getChildNodesData(self, fieldnames, id=None, includeSelf=False):
+		if self.lazy:
+			if id is None:
+				id = self._rs.current[self._fldId]
+			ids = list(self.iterChildIdsRecursive(id, includeSelf=False))
+			data = self.__queryNodesData(ids, fieldnames)
+			return [data[i] for i in ids if i in data]
+
 		data = self._block.get_data(fieldnames)
 		return [data[i] for i in self._iterRowsRecursive(
 			self._idRow[id] if id is not None else self._rs.getRecordNumber(),
@@ -486,6 +648,10 @@ class GFTreeMixIn(object):
 		@param id: parent id, focused node if None
 		@param includeSelf: set parent node data
 		"""
+		if self.lazy:
+			# child nodes are not rows of the block
+			raise LazyTreeError(self, 'setChildNodesData')
+
 		data = data.items()
 		for row in self._iterRowsRecursive(
 			self._idRow[id] if id is not None else self._rs.getRecordNumber(),
@@ -501,23 +667,23 @@ class GFTreeMixIn(object):
 
 	def __trigger_getParentId(self, id):
 		try:
-			row = self._idRow[id]
+			parentId = self.__getParentId(id)
 		except KeyError:
 			pass
 		else:
-			if row >= 0:
-				return self._rs[row][self._fldParent]
+			if parentId is not NotImplemented:
+				return parentId
 
 	def __trigger_getValue(self, id, fieldName):
-		return self._rs[self._idRow[id]][self._rsField(fieldName)]
+		return self._getNodeValue(id, self._rsField(fieldName))
 
 	def __trigger_setValue(self, id, fieldName, value):
-		self._rs[self._idRow[id]][self._rsField(fieldName)] = value
+		self._rs[self._getRow(id)][self._rsField(fieldName)] = value
 
 	def __trigger_isLeaf(self, nodeId=None):
 		if nodeId is None:
 			nodeId = self._rs.current[self._fldId]
-		return len(self.__childIds.get(nodeId, ())) == 0
+		return self.getChildCount(nodeId) == 0
 
 
 #
@@ -644,6 +810,9 @@ class GFTree(GFTreeMixIn, GFTabStop):
 		"""
 		set targetId node parent field to sourceId
 		"""
+		if self.lazy:
+			raise LazyTreeError(self, 'moving nodes')
+
 		self._rs[self._idRow[sourceId]][self._fldParent] = targetId
 		self._revalidate()
 		self._block.goto_record(self._idRow[sourceId])
@@ -652,6 +821,9 @@ class GFTree(GFTreeMixIn, GFTabStop):
 	def _event_copy_node(self, targetId, sourceId):
 		#rint '_event_copy_node', targetId, sourceId
 
+		if self.lazy:
+			raise LazyTreeError(self, 'copying nodes')
+
 		# this done to avoid tree focus
 		self.__freeze = True
 
@@ -723,9 +895,10 @@ class GFTree(GFTreeMixIn, GFTabStop):
 		uiDriverCanModify = self._form.get_uidriver_name() != 'java'
 
 		# TODO: when access will work ok with trees can set this from block.getAccess()
-		canInsert = True and uiDriverCanModify
-		canUpdate = True and uiDriverCanModify
-		canDelete = True and uiDriverCanModify
+		# lazy tree does not know rows of nodes so can't modify structure
+		canInsert = uiDriverCanModify and not self.lazy
+		canUpdate = uiDriverCanModify and not self.lazy
+		canDelete = uiDriverCanModify and not self.lazy
 
 		nodeInClipboard = self.getCuttedNodeId() is not None or self.getCopiedNodeId() is not None
 
@@ -814,6 +987,9 @@ class GFTree(GFTreeMixIn, GFTabStop):
 		        or previous sibling row
 		        or KeyError
 		"""
+		if self.lazy:
+			raise LazyTreeError(self, 'finding the nearest node')
+
 		parentId = self._rs[currentRow][self._fldParent]
 		try:
 			return self._idRow[parentId]
@@ -852,3 +1028,21 @@ class GFTree(GFTreeMixIn, GFTabStop):
 						pass
 		else:
 			self._form.show_message(u_(u"Nothing to delete"), 'Error')
+
+
+# =============================================================================
+# Exceptions
+# =============================================================================
+
+class LazyTreeError(errors.ApplicationError):
+	"""
+	The operation needs the rows of all nodes, a lazy tree knows only the row
+	of the current record.
+	"""
+	def __init__(self, tree, operation):
+		errors.ApplicationError.__init__(self, u_(
+				"Tree '%(name)s' loads nodes lazily and does not support "
+				"%(operation)s"
+			) % {
+				'name': tree.name,
+				'operation': operation})
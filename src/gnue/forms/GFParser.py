@@ -1209,9 +1209,15 @@ def getXMLelements():
 							'min'  : { 'Label': _('Minimum') },
 							'max'  : { 'Label': _('Maximum') },
 							'count': { 'Label': _('Count') },
+							'avg'  : { 'Label': _('Average') },
 						},
 						'Default': "sum",
 					},
+					'pushdown' : {
+						'Typecast' : GTypecast.boolean,
+						'Default' : 'N',
+						'Description' : 'Calculate the total of records not fetched '
+						'yet in the database'},
 					'language': {
 						'Label'      : _("Language"),
 						'Description': _("Programming language the code is written in"),
@@ -1346,6 +1352,11 @@ def getXMLelements():
 						'Typecast' : GTypecast.boolean,
 						'Default' : 'Y',
 						'Description' : 'Auto check parent, auto check child'},
+					'lazy' : {
+						'Typecast' : GTypecast.boolean,
+						'Default' : 'N',
+						'Description' : 'Load tree nodes level by level when they are '
+						'expanded instead of loading the whole block'},
 					'labelEdit' : {
 						'Typecast' : GTypecast.boolean,
 						'Default' : 'Y',
@@ -0,0 +1,243 @@
+# GNU Enterprise Forms - Parsed form template cache
+#
+# This file is part of GNU Enterprise
+#
+# GNU Enterprise is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public
+# License as published by the Free Software Foundation; either
+# version 2, or (at your option) any later version.
+#
+# GNU Enterprise is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied
+# warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR
+# PURPOSE. See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public
+# License along with program; see the file COPYING. If not,
+# write to the Free Software Foundation, Inc., 59 Temple Place
+# - Suite 330, Boston, MA 02111-1307, USA.
+
+"""
+Process-wide cache of parsed, validated and translated form trees.
+
+A form is parsed once per (url, language) and fingerprint. The fingerprint
+tells whether the cached tree is still valid: for files it is built from
+modification times and sizes, for http urls it is the ETag returned by the
+server, which also covers the access rights applied by the server. Every
+L{GFInstance} gets its own deep copy of the template before phaseInit.
+"""
+
+import copy
+import sys
+import threading
+import types
+
+from collections import OrderedDict
+
+__all__ = ['TemplateCache', 'templatecache']
+
+
+# =============================================================================
+# Placeholders for instance specific objects inside of a template
+# =============================================================================
+
+class _Placeholder:
+	def __init__(self, name):
+		self.__name = name
+
+	def __repr__(self):
+		return '<template %s>' % self.__name
+
+_INSTANCE = _Placeholder('instance')
+_CONNECTIONS = _Placeholder('connections')
+
+
+# =============================================================================
+# Template cache
+# =============================================================================
+
+class TemplateCache:
+	"""
+	Least recently used cache of form templates.
+	"""
+
+	# -------------------------------------------------------------------------
+	# Constructor
+	# -------------------------------------------------------------------------
+
+	def __init__(self, max_size=200):
+
+		self.max_size = max_size
+		self.__templates = OrderedDict()	# (key, fingerprint) -> form
+		self.__lock = threading.Lock()
+		self.__hits = 0
+		self.__misses = 0
+
+
+	# -------------------------------------------------------------------------
+	# Known fingerprints of a key
+	# -------------------------------------------------------------------------
+
+	def fingerprints(self, key):
+		"""
+		Return fingerprints of all templates cached for the key, most recently
+		used first. Used to send If-None-Match with all known ETags.
+		"""
+
+		self.__lock.acquire()
+		try:
+			result = [f for (k, f) in self.__templates.keys() if k == key]
+		finally:
+			self.__lock.release()
+
+		result.reverse()
+		return result
+
+
+	# -------------------------------------------------------------------------
+	# Create a form from a cached template
+	# -------------------------------------------------------------------------
+
+	def instantiate(self, key, fingerprint, instance):
+		"""
+		Return a copy of the template bound to the instance, or None if there
+		is no template for key and fingerprint.
+		"""
+
+		self.__lock.acquire()
+		try:
+			template = self.__templates.pop((key, fingerprint), None)
+			if template is None:
+				self.__misses += 1
+				return None
+			self.__templates[(key, fingerprint)] = template
+			self.__hits += 1
+		finally:
+			self.__lock.release()
+
+		return self.__clone(template, _INSTANCE, _CONNECTIONS, instance,
+			instance.connections)
+
+
+	# -------------------------------------------------------------------------
+	# Store a template
+	# -------------------------------------------------------------------------
+
+	def store(self, key, fingerprint, form, instance, replace=False):
+		"""
+		Store a detached copy of a freshly loaded form. The form itself is left
+		untouched and can be used by the instance that loaded it.
+
+		@param replace: remove templates with other fingerprints of the key,
+		    i.e. the older versions of a file
+		"""
+
+		template = self.__clone(form, instance, instance.connections,
+			_INSTANCE, _CONNECTIONS)
+
+		self.__lock.acquire()
+		try:
+			if replace:
+				for item in self.__templates.keys():
+					if item[0] == key:
+						del self.__templates[item]
+			self.__templates.pop((key, fingerprint), None)
+			self.__templates[(key, fingerprint)] = template
+			while len(self.__templates) > self.max_size:
+				self.__templates.popitem(last=False)
+		finally:
+			self.__lock.release()
+
+
+	# -------------------------------------------------------------------------
+	# Statistics
+	# -------------------------------------------------------------------------
+
+	def statistics(self):
+		"""
+		Return dictionary with hits, misses and the current size.
+		"""
+
+		self.__lock.acquire()
+		try:
+			return {
+				'hits'   : self.__hits,
+				'misses' : self.__misses,
+				'size'   : len(self.__templates),
+			}
+		finally:
+			self.__lock.release()
+
+	# -------------------------------------------------------------------------
+
+	def clear(self):
+
+		self.__lock.acquire()
+		try:
+			self.__templates.clear()
+		finally:
+			self.__lock.release()
+
+
+	# -------------------------------------------------------------------------
+	# Copy an object tree replacing instance and connections
+	# -------------------------------------------------------------------------
+
+	def __clone(self, form, instance, connections, new_instance,
+		new_connections):
+
+		# Parsed trees refer to parser modules (_xmlParser), those are shared
+		memo = dict([(id(module), module) for module in sys.modules.values()
+			if isinstance(module, types.ModuleType)])
+
+		memo[id(instance)] = new_instance
+		if connections is not None:
+			memo[id(connections)] = new_connections
+		return copy.deepcopy(form, memo)
+
+
+#: The cache used by all form instances of the process
+templatecache = TemplateCache()
+
+
+# =============================================================================
+# Self test code
+# =============================================================================
+
+if __name__ == '__main__':
+
+	from gnue.common.definitions.GParserHelpers import ParserObj
+
+	class Instance:
+		connections = None
+
+	instance = Instance()
+
+	form = ParserObj(None, 'form')
+	form._xmlParser = types
+	form._instance = instance
+	block = ParserObj(form, 'block')
+	field = ParserObj(block, 'field')
+
+	cache = TemplateCache()
+	cache.store('form', 'v1', form, instance)
+
+	other = Instance()
+	clone = cache.instantiate('form', 'v1', other)
+	clone_block = clone._children[0]
+	clone_field = clone_block._children[0]
+
+	assert clone is not form and clone_field is not field
+	assert clone._xmlParser is types
+	assert clone._instance is other
+
+	# parents are the cloned objects, not copies of them
+	assert clone_block.getParent()._children[0] is clone_block
+	assert clone_field.getParent()._children[0] is clone_field
+	assert clone_field.getParent().getParent()._children[0] is clone_block
+	clone.marker = 1
+	assert clone_block.getParent().marker == 1
+	assert block.getParent()._children[0] is block
+	assert not hasattr(form, 'marker')
+
+	print "Thank you for playing."
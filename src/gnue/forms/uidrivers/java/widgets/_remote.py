@@ -256,6 +256,9 @@ class Label(Widget):
 	pass
 
 class Table(Widget, Stated):
+	def onRequestRows(self, generation, firstRow, count):
+		self._uiWidget.onRequestRows(generation, firstRow, count)
+
 	def onSelectionChange(self, row, col, rows):
 		self._uiWidget.onSelectionChange(row, col, rows)
 
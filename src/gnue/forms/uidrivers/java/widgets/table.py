@@ -18,11 +18,19 @@ SORT_ORDER = {
 
 class UITable(UIWidget):
 
+	# rows sent with the row count and with every row range requested by client
+	WINDOW_SIZE = 100
+
 	def __init__(self, event):
 		UIWidget.__init__(self, event)
 		self.__selectedRows = ()
 		self.__selectedCol  = None
 		self.__findForm = None
+		self.__focusedRow = 0
+
+		# formatted rows of the current resultset generation, row -> row data
+		self.__generation = 0
+		self.__rowCache = {}
 
 	def _create_widget_ (self, event):
 		self.widget = Table(self, self._gfObject.label or "", self._gfObject.selectionMode)
@@ -60,8 +68,21 @@ class UITable(UIWidget):
 	# Events from GFTable (to update ui)
 	#
 	def _ui_revalidate_(self):
-		self.widget.uiSetData(
-			[self.__getRowData(row) for row in xrange(self._gfObject.getRecordCount())],
+		"""
+		Send the row count and the window around the focused row, the client
+		requests other rows with onRequestRows when they become visible
+		"""
+		self.__generation += 1
+		self.__rowCache.clear()
+
+		rowCount = self._gfObject.getRecordCount()
+		firstRow = max(0, min(self.__focusedRow - self.WINDOW_SIZE // 2, rowCount - self.WINDOW_SIZE))
+
+		self.widget.uiSetDataWindow(
+			self.__generation,
+			rowCount,
+			firstRow,
+			self.__getRows(firstRow, self.WINDOW_SIZE),
 			[{} for flag in self.__flags] + [
 				{
 					'order'    : SORT_ORDER[entry._field.getSortOrder()],
@@ -71,9 +92,23 @@ class UITable(UIWidget):
 		)
 
 	def _ui_revalidate_row_(self, row):
+		self.__rowCache.pop(row, None)
 		self.widget.uiSetRowData(row, self.__getRowData(row))
 
+	def __getRows(self, firstRow, count):
+		return [
+			self.__getRowData(row)
+			for row in xrange(firstRow, min(firstRow + count, self._gfObject.getRecordCount()))
+		]
+
 	def __getRowData(self, row):
+		try:
+			return self.__rowCache[row]
+		except KeyError:
+			data = self.__rowCache[row] = self.__formatRow(row)
+			return data
+
+	def __formatRow(self, row):
 		return [
 			self._gfObject.getFlagValue(row, flag)
 			for flag  in self.__flags
@@ -83,9 +118,11 @@ class UITable(UIWidget):
 		]
 
 	def _ui_set_focused_row_(self, row):
+		self.__focusedRow = row
 		self.widget.uiSetFocusedRow(row)
 
 	def _ui_set_focused_cell_(self, row, col):
+		self.__focusedRow = row
 		self.widget.uiSetFocusedCell(row, col)
 
 	################################################################
@@ -98,6 +135,11 @@ class UITable(UIWidget):
 	# Events from ui (ui updated by user)
 	#
 
+	def onRequestRows(self, generation, firstRow, count):
+		# rows requested for an outdated resultset, client gets new window anyway
+		if generation == self.__generation:
+			self.widget.uiSetRows(generation, firstRow, self.__getRows(firstRow, count))
+
 	def onSelectionChange(self, row, col, rows):
 		self.__selectedRows = rows
 		self._gfObject._event_cell_focused(row, col)
@@ -91,6 +91,8 @@ class Tree(ExpansionState, XCustomTreeColumnsTips, XCustomTreeColumns, CustomTre
 			self.AddColumn(self._gfObject.label or '')
 		self.AddRoot('HIDDEN ROOT')
 		self.GetMainWindow().Bind(wx.EVT_KEY_DOWN, self.__on_key_down)
+		if self._gfObject.lazy:
+			self.GetMainWindow().Bind(wx.EVT_TREE_ITEM_EXPANDING, self.__on_item_expanding)
 
 
 	##########################################
@@ -105,6 +107,10 @@ class Tree(ExpansionState, XCustomTreeColumnsTips, XCustomTreeColumns, CustomTre
 				self.CheckItem(item, not self.IsItemChecked(item))
 			return
 		event.Skip()
+
+	def __on_item_expanding(self, event):
+		self._loadItems(event.GetItem())
+		event.Skip()
 	
 	def OnMouse(self, event):
 		"""
@@ -134,6 +140,9 @@ class Tree(ExpansionState, XCustomTreeColumnsTips, XCustomTreeColumns, CustomTre
 		if not idPath:
 			return parentItem
 
+		if self._gfObject.lazy:
+			self._loadItems(parentItem)
+
 		item = self._findItem(parentItem, idPath[0])
 		if item:
 			if parentItem != self.GetRootItem():
@@ -217,7 +226,28 @@ class Tree(ExpansionState, XCustomTreeColumnsTips, XCustomTreeColumns, CustomTre
 				# expand this
 				item.Expand()
 
-			self._appendItems(item, id)
+			if not self._gfObject.lazy or item.IsExpanded():
+				self._appendItems(item, id)
+			elif self._gfObject.getChildCount(id):
+				# lazy tree appends children when item expanded
+				self.SetItemHasChildren(item, True)
+
+	def _loadItems(self, item):
+		"""
+		appends children of lazy tree item if not appended yet
+		"""
+		if item != self.GetRootItem() and not self.GetChildrenCount(item, False):
+			id = item.GetData()
+			if self._gfObject.getChildCount(id):
+				self._appendItems(item, id)
+
+	def _loadExpandedItems(self, parentItem):
+		item, cookie = self.GetFirstChild(parentItem)
+		while item:
+			if item.IsExpanded():
+				self._loadItems(item)
+				self._loadExpandedItems(item)
+			item = self.GetNextSibling(item)
 
 
 	def iterCheckedItems(self, reduceChildren=False):
@@ -269,6 +299,9 @@ class Tree(ExpansionState, XCustomTreeColumnsTips, XCustomTreeColumns, CustomTre
 			self.Expand(item)
 			item = self.GetNextSibling(item)
 
+		if self._gfObject.lazy:
+			self._loadExpandedItems(self.GetRootItem())
+
 		#if idPath:
 		#	self.selectIdPath(idPath)
 
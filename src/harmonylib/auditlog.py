@@ -0,0 +1,419 @@
+"""
+Background writer for audit log events
+
+Events are queued in memory and written by a daemon thread in batches, when
+batch_size events are queued or flush_interval seconds passed. Batches that
+can't be written because the database is not available are appended to a
+spool file and written again before the next batch. In blocking mode events
+are written by the calling thread as before.
+"""
+
+import os
+import sys
+import errno
+import time
+import atexit
+import threading
+import cPickle
+from collections import deque
+
+try:
+	import fcntl
+except ImportError:
+	# no locking of spool file between processes
+	fcntl = None
+
+
+# servers.conf [auditlog] option -> AuditLog keyword, ConfigParser getter
+OPTIONS = (
+	('blocking',       'blocking',       'getboolean'),
+	('queue_size',     'queue_size',     'getint'),
+	('batch_size',     'batch_size',     'getint'),
+	('flush_interval', 'flush_interval', 'getfloat'),
+	('spool_file',     'spool_file',     'get'),
+)
+
+
+def getOptions(parser, section='auditlog'):
+	"""
+	returns AuditLog keywords from ConfigParser section
+	"""
+	options = {}
+	if parser.has_section(section):
+		for option, name, getter in OPTIONS:
+			if parser.has_option(section, option):
+				options[name] = getattr(parser, getter)(section, option)
+	return options
+
+
+class PartialWriteError(Exception):
+	"""
+	raised by write function if only first events were written
+	events - events not written, they are spooled
+	"""
+
+	def __init__(self, message, events):
+		Exception.__init__(self, message)
+		self.events = events
+
+
+class AuditLog(object):
+	"""
+	Thread-safe batched writer of one event log
+
+	write(events)  - writes list of events in one transaction, raises if failed,
+	                 PartialWriteError if events were committed in parts
+	queue_size     - events kept in memory, more are spooled or dropped
+	batch_size     - events written at once
+	flush_interval - seconds event waits in queue at most
+	spool_file     - file to keep events while database is unavailable
+	blocking       - write each event in the calling thread
+	"""
+
+	def __init__(self, write, queue_size=10000, batch_size=100, flush_interval=1.0, spool_file=None, blocking=False):
+		self.__write = write
+		self.queue_size = max(queue_size, 1)
+		self.batch_size = max(batch_size, 1)
+		self.flush_interval = flush_interval
+		self.spool_file = spool_file
+		self.blocking = blocking
+
+		self.__condition = threading.Condition(threading.Lock())
+		self.__queue = deque()
+		self.__thread = None
+		self.__pid = None
+		self.__closed = False
+
+		# serializes writing and replaying, spool file is locked by itself
+		self.__flushLock = threading.RLock()
+		self.__spoolPending = bool(spool_file and os.path.exists(spool_file))
+
+		self.__stats = {
+			'queued'   : 0,	# events accepted by log
+			'flushed'  : 0,	# events written to database
+			'spooled'  : 0,	# events written to spool file
+			'replayed' : 0,	# events written to database from spool file
+			'dropped'  : 0,	# events lost
+			'failures' : 0,	# failed database writes
+		}
+
+	def log(self, event):
+		"""
+		queues event, in blocking mode writes it
+		"""
+		if self.blocking:
+			self.__count('queued', 1)
+			self.__flushLock.acquire()
+			try:
+				self.__replay()
+				self.__writeBatch([event])
+			finally:
+				self.__flushLock.release()
+			return
+
+		self.__condition.acquire()
+		try:
+			full = len(self.__queue) >= self.queue_size
+			if not full:
+				self.__queue.append(event)
+				self.__stats['queued'] += 1
+				if len(self.__queue) >= self.batch_size:
+					self.__condition.notify()
+		finally:
+			self.__condition.release()
+
+		if full:
+			self.__count('queued', 1)
+			self.__spool([event])
+		else:
+			self.__startThread()
+
+	def flush(self):
+		"""
+		writes all queued events in the calling thread
+		"""
+		self.__flushLock.acquire()
+		try:
+			self.__replay()
+			while True:
+				self.__condition.acquire()
+				try:
+					batch = [self.__queue.popleft() for i in xrange(min(self.batch_size, len(self.__queue)))]
+				finally:
+					self.__condition.release()
+				if not batch:
+					break
+				self.__writeBatch(batch)
+		finally:
+			self.__flushLock.release()
+
+	def close(self):
+		"""
+		stops background thread and writes queued events
+		"""
+		self.__condition.acquire()
+		try:
+			self.__closed = True
+			thread = self.__thread
+			self.__condition.notify()
+		finally:
+			self.__condition.release()
+
+		if thread is not None and thread is not threading.currentThread() and self.__pid == os.getpid():
+			thread.join()
+		self.flush()
+
+	def statistics(self):
+		self.__condition.acquire()
+		try:
+			stats = dict(self.__stats)
+			stats['queue'] = len(self.__queue)
+		finally:
+			self.__condition.release()
+		return stats
+
+	############################################################################
+	# background thread
+
+	def __startThread(self):
+		if self.__thread is not None and self.__pid == os.getpid():
+			return
+		self.__condition.acquire()
+		try:
+			# thread does not survive fork
+			if (self.__thread is None or self.__pid != os.getpid()) and not self.__closed:
+				self.__pid = os.getpid()
+				self.__thread = threading.Thread(target=self.__run, name='AuditLog')
+				self.__thread.setDaemon(True)
+				self.__thread.start()
+				atexit.register(self.close)
+		finally:
+			self.__condition.release()
+
+	def __run(self):
+		while True:
+			self.__condition.acquire()
+			try:
+				deadline = time.time() + self.flush_interval
+				while not self.__closed and len(self.__queue) < self.batch_size:
+					remaining = deadline - time.time()
+					if remaining <= 0:
+						break
+					self.__condition.wait(remaining)
+				closed = self.__closed
+			finally:
+				self.__condition.release()
+
+			try:
+				self.flush()
+			except Exception, e:
+				print "* audit log flush failed: %s: %s" % (e.__class__.__name__, e)
+
+			if closed:
+				break
+
+	############################################################################
+	# writing
+
+	def __count(self, key, n):
+		self.__condition.acquire()
+		try:
+			self.__stats[key] += n
+		finally:
+			self.__condition.release()
+
+	def __writeBatch(self, batch):
+		"""
+		called with flush lock held
+		"""
+		if self.__spoolPending:
+			# database was unavailable at last replay, keep order of events
+			self.__spool(batch)
+			return
+		try:
+			self.__write(batch)
+		except Exception, e:
+			print "* audit log write failed: %s: %s" % (e.__class__.__name__, e)
+			self.__count('failures', 1)
+			unwritten = self.__unwritten(batch, e)
+			self.__count('flushed', len(batch) - len(unwritten))
+			self.__spool(unwritten)
+		else:
+			self.__count('flushed', len(batch))
+
+	def __unwritten(self, batch, error):
+		if isinstance(error, PartialWriteError):
+			return error.events
+		return batch
+
+	def __spool(self, events):
+		if not self.spool_file:
+			self.__count('dropped', len(events))
+			return
+
+		# no flush lock, overflow of queue is spooled by the logging thread
+		try:
+			f = self.__openSpool('ab')
+			try:
+				cPickle.dump(events, f, 2)
+				f.flush()
+				os.fsync(f.fileno())
+				self.__spoolPending = True
+			finally:
+				f.close()
+		except Exception, e:
+			print "* audit log spool failed: %s: %s" % (e.__class__.__name__, e)
+			self.__count('dropped', len(events))
+		else:
+			self.__count('spooled', len(events))
+
+	def __replay(self):
+		"""
+		writes spooled events, called with flush lock held
+		"""
+		if not self.spool_file or not os.path.exists(self.spool_file):
+			self.__spoolPending = False
+			return
+
+		try:
+			f = self.__openSpool('r+b')
+		except IOError, e:
+			if e.errno != errno.ENOENT:
+				raise
+			# replayed by other process meanwhile
+			self.__spoolPending = False
+			return
+
+		try:
+			events = []
+			while True:
+				try:
+					events.extend(cPickle.load(f))
+				except EOFError:
+					break
+				except Exception, e:
+					# last write was interrupted
+					print "* audit log spool is truncated: %s: %s" % (e.__class__.__name__, e)
+					break
+
+			written = 0
+			try:
+				for start in xrange(0, len(events), self.batch_size):
+					batch = events[start:start + self.batch_size]
+					self.__write(batch)
+					written += len(batch)
+			except Exception, e:
+				print "* audit log replay failed: %s: %s" % (e.__class__.__name__, e)
+				self.__count('failures', 1)
+				written += len(batch) - len(self.__unwritten(batch, e))
+
+			# keep events not written, remove file before lock is released
+			if written < len(events):
+				f.seek(0)
+				f.truncate()
+				cPickle.dump(events[written:], f, 2)
+				f.flush()
+				os.fsync(f.fileno())
+			else:
+				os.remove(self.spool_file)
+			self.__spoolPending = written < len(events)
+			self.__count('replayed', written)
+		finally:
+			f.close()
+
+	def __openSpool(self, mode):
+		"""
+		returns spool file opened and locked
+		file removed by replay while waiting for lock is opened again
+		"""
+		while True:
+			f = open(self.spool_file, mode)
+			if fcntl is None:
+				return f
+			try:
+				fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+				try:
+					linked = os.stat(self.spool_file).st_ino == os.fstat(f.fileno()).st_ino
+				except OSError:
+					linked = False
+			except:
+				f.close()
+				raise
+			if linked:
+				return f
+			f.close()
+
+
+if __name__ == '__main__':
+
+	written = []
+	available = [True]
+
+	def write(events):
+		if not available[0]:
+			raise IOError, 'database is not available'
+		time.sleep(0.005)	# one round trip
+		written.extend(events)
+
+	spool = os.path.join(os.environ.get('TMP', '/tmp'), 'auditlog-%s.spool' % os.getpid())
+
+	log = AuditLog(write, batch_size=100, flush_interval=0.1, spool_file=spool)
+	start = time.time()
+	for i in xrange(5000):
+		log.log(i)
+	print "logged 5000 events in %.3fs" % (time.time() - start)
+
+	available[0] = False
+	for i in xrange(5000, 5500):
+		log.log(i)
+	log.flush()
+	print "database down:", log.statistics()
+
+	available[0] = True
+	log.close()
+	print "closed:", log.statistics()
+	assert sorted(written) == range(5500), len(written)
+	assert not os.path.exists(spool)
+
+	# only events not committed are written again
+	del written[:]
+	available[0] = False
+	def partial(events):
+		if available[0]:
+			written.extend(events)
+			return
+		available[0] = True
+		written.extend(events[:3])
+		raise PartialWriteError('database is not available', events[3:])
+	log = AuditLog(partial, batch_size=10, flush_interval=0.01, spool_file=spool)
+	for i in xrange(10):
+		log.log(i)
+	log.flush()
+	assert written == range(3) and log.statistics()['spooled'] == 7, written
+	log.close()
+	print "partial:", log.statistics()
+	assert sorted(written) == range(10), written
+	assert not os.path.exists(spool)
+
+	# overflow is spooled while writer is blocked in database
+	del written[:]
+	release = threading.Event()
+	def slow(events):
+		release.wait()
+		written.extend(events)
+	log = AuditLog(slow, queue_size=10, batch_size=10, flush_interval=0.01, spool_file=spool)
+	for i in xrange(10):
+		log.log(i)
+	time.sleep(0.1)
+	for i in xrange(10, 20):
+		log.log(i)
+	start = time.time()
+	for i in xrange(20, 30):
+		log.log(i)
+	assert time.time() - start < 1.0
+	assert log.statistics()['spooled'] == 10
+	release.set()
+	log.close()
+	print "overflow:", log.statistics()
+	assert sorted(written) == range(30), written
+	assert not os.path.exists(spool)
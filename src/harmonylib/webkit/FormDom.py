@@ -1,5 +1,10 @@
+import os
 import re
 import codecs
+import threading
+from cStringIO import StringIO
+from collections import OrderedDict
+from hashlib import md5
 from xml.dom import Node
 import xml.dom.minidom
 
@@ -62,7 +67,9 @@ class Dom(object):
 	CONTENT_NODES = set((Node.TEXT_NODE, Node.CDATA_SECTION_NODE))
 		
 	def __init__(self, fname, get_form_path=lambda x: x):
-		f = open(get_form_path(fname), 'rt')
+		# files this dom is built from
+		self.files = [get_form_path(fname)]
+		f = open(self.files[0], 'rt')
 		try:
 			self.dom = xml.dom.minidom.parse(f)
 		finally:
@@ -107,9 +114,14 @@ class FormDom(Dom):
 		for importNode in tuple(self.iterNodesRecursive(Node.ELEMENT_NODE, nodeNameStartsWith='import-')):
 			#rint "import", importNode.nodeName, importNode.getAttribute('name'), importNode.parentNode.nodeName, importNode.parentNode.getAttribute('name')
 
-			newNode = LibraryDom.getLibrary(importNode.getAttribute('library'), get_form_path=get_form_path).createNode(importNode)
+			library = LibraryDom.getLibrary(importNode.getAttribute('library'), get_form_path=get_form_path)
+			newNode = library.createNode(importNode)
 			importNode.parentNode.replaceChild(newNode, importNode)
 
+			for i in library.files:
+				if i not in self.files:
+					self.files.append(i)
+
 		# remove all whitespace text nodes
 		for node in tuple(self.iterNodesRecursiveFiltered(lambda node: node.nodeType in self.CONTENT_NODES)):
 			if not node.data.lstrip():
@@ -267,6 +279,75 @@ def EncodeWriter(unicodeOutputStream, encoding, errors='replace'):
 	return codecs.lookup(encoding)[3](unicodeOutputStream, errors)
 
 
+def fileStamp(path):
+	mode, ino, dev, nlink, uid, gid, size, atime, mtime, ctime = os.stat(path)
+	return path, size, mtime
+
+
+class RenderedForms(object):
+	"""
+	Cache of serialized forms with access applied
+
+	key is (form path, access, function access), function access is None for superuser
+	entry is valid while form file and imported libraries do not change
+	"""
+
+	MAX_SIZE = 500
+
+	__cache = OrderedDict()
+	__lock = threading.Lock()
+
+	@classmethod
+	def render(cls, fname, access, functionAccess=None, get_form_path=lambda x: x, encoding='Cp1251'):
+		"""
+		returns (xml data, etag)
+		"""
+		key = (
+			get_form_path(fname),
+			access,
+			tuple(sorted(functionAccess.items())) if functionAccess is not None else None,
+			encoding,
+		)
+
+		cls.__lock.acquire()
+		try:
+			entry = cls.__cache.pop(key, None)
+			if entry is not None:
+				cls.__cache[key] = entry
+		finally:
+			cls.__lock.release()
+
+		if entry is not None:
+			stamps, data, etag = entry
+			try:
+				if all(fileStamp(i[0]) == i for i in stamps):
+					return data, etag
+			except OSError:
+				pass
+
+		dom = FormDom(fname, get_form_path=get_form_path)
+		dom.applyAccess(access)
+		if functionAccess is not None:
+			dom.applyFunctionAccess(functionAccess)
+
+		out = StringIO()
+		dom.writexml(out, encoding)
+		data = out.getvalue()
+		etag = '"%s"' % md5(data).hexdigest()
+
+		stamps = tuple(fileStamp(i) for i in dom.files)
+
+		cls.__lock.acquire()
+		try:
+			cls.__cache[key] = stamps, data, etag
+			while len(cls.__cache) > cls.MAX_SIZE:
+				cls.__cache.popitem(last=False)
+		finally:
+			cls.__lock.release()
+
+		return data, etag
+
+
 if __name__ == '__main__':
 
 	import os
@@ -1,24 +1,227 @@
 import os
 import sys
+import time
 import traceback
 import datetime
 from ConfigParser import ConfigParser
 import threading
 from weakref import WeakKeyDictionary
+from itertools import groupby
+from operator import itemgetter
 
 from gnue.common.datasources.GConnections import GConnections
-from gnue.common.datasources.GConditions import buildConditionFromDict
+from gnue.common.datasources.GConditions import buildCondition
+from gnue.common.datasources.Exceptions import ConnectionError
+from gnue.common.datasources.access import ACCESS
 from src.harmonylib.webkit import AccessObject
+from src.harmonylib import auditlog
 
 
 _gConnections_by_thread = WeakKeyDictionary()
 
+_auditLogs = {}
+_auditLogsLock = threading.Lock()
+
+
+# seconds connection may be idle before it is checked, servers.conf [auth] check_interval
+CHECK_INTERVAL = 30
+
+_connectionStats = {
+	'pings'         : 0,	# idle connection checked before use
+	'ping_failures' : 0,	# check found connection broken
+	'reconnects'    : 0,	# connection opened to replace broken one
+	'retries'       : 0,	# reads repeated on new connection
+}
+_connectionStatsLock = threading.Lock()
+
+
+def _count(key):
+	_connectionStatsLock.acquire()
+	try:
+		_connectionStats[key] += 1
+	finally:
+		_connectionStatsLock.release()
+
+
+def getConnectionStatistics():
+	_connectionStatsLock.acquire()
+	try:
+		return dict(_connectionStats)
+	finally:
+		_connectionStatsLock.release()
+
+
+class _ThreadConnection(object):
+	"""
+	Cached connection of thread and its bookkeeping
+	"""
+
+	def __init__(self, connection):
+		self.connection = connection
+		self.lastUsed = time.time()
+
+
+def _isUsable(gConnection, rollback=False):
+	"""
+	test if connection is usable, rollback is needed after failed statement
+	"""
+	try:
+		if rollback:
+			gConnection.rollback()
+		c = gConnection._getNativeConnection()['connection'].cursor()
+		c.execute('SELECT NULL')
+		c.close()
+	except:
+		print '* connection from cache is unusable. Problem was:'
+		print ''.join(traceback.format_exception(*sys.exc_info()))
+		return False
+	else:
+		return True
+
+
+# native errors of lost connection
+_CONNECTION_ERRORS = ('OperationalError', 'InterfaceError')
+
+def _isConnectionError(gConnection, error):
+	"""
+	test if failed statement may be caused by broken connection
+	DBSIG2 wraps native errors into ConnectionError with native class name in message
+	"""
+	if isinstance(error, ConnectionError):
+		return unicode(error.message).split(':', 1)[0] in _CONNECTION_ERRORS
+	driver = gConnection._getNativeConnection()['driver']
+	return isinstance(error, tuple([getattr(driver, name) for name in _CONNECTION_ERRORS if hasattr(driver, name)]))
+
+
+def _getThreadConnection(filePath, connName, checkInterval=CHECK_INTERVAL):
+	"""
+	returns connection of current thread, opens new one if cached is unusable
+	cached connection is checked only if idle for checkInterval seconds
+	"""
+	connections = _gConnections_by_thread.setdefault(threading.currentThread(), {})
+
+	key = (filePath, connName)
+
+	entry = connections.get(key)
+	now = time.time()
+
+	if entry is not None and now - entry.lastUsed >= checkInterval:
+		_count('pings')
+		if not _isUsable(entry.connection):
+			_count('ping_failures')
+			entry = None
+
+	if entry is None:
+		if key in connections:
+			_count('reconnects')
+		connections[key] = entry = _ThreadConnection(GConnections(filePath).getConnection(connName, login=True))
+
+	entry.lastUsed = now
+	return entry.connection
+
+
+def _dropThreadConnection(filePath, connName):
+	"""
+	forgets broken connection of current thread, next call opens new one
+	"""
+	connections = _gConnections_by_thread.get(threading.currentThread(), {})
+	key = (filePath, connName)
+	if connections.get(key) is not None:
+		connections[key] = None
+
+
+def _getAuditLog(filePath, connName, options):
+	"""
+	returns process-wide event log writer of connection
+	"""
+	key = (filePath, connName)
+	log = _auditLogs.get(key)
+	if log is None:
+		_auditLogsLock.acquire()
+		try:
+			log = _auditLogs.get(key)
+			if log is None:
+
+				def write(events):
+					gConnection = _getThreadConnection(filePath, connName)
+					try:
+						for sessionKey, group in groupby(events, itemgetter(0)):
+							gConnection.manager.setSessionKey(sessionKey)
+							# insert of driver writes through _event_log procedure
+							for k, row in group:
+								gConnection.insert('_event_log', row)
+						gConnection.commit()
+					except:
+						if not _isUsable(gConnection, rollback=True):
+							_dropThreadConnection(filePath, connName)
+						raise
+
+				log = _auditLogs[key] = auditlog.AuditLog(write, **options)
+		finally:
+			_auditLogsLock.release()
+	return log
+
+
+class _AclCache(object):
+	"""
+	Access data of one user, trusted for ttl seconds
+
+	After ttl expired the version stamp returned by probe() is compared with
+	the previous one and the data is dropped if it differs. Without probe
+	the data is dropped every ttl seconds.
+	"""
+
+	def __init__(self, ttl, probe=None):
+		self.ttl = ttl
+		self.__probe = probe
+		self.__data = {}
+		self.__version = None
+		self.__expires = 0
+
+	def get(self, key, load):
+		"""
+		returns cached value, calls load() if not cached
+		"""
+		self.__validate()
+		try:
+			return self.__data[key]
+		except KeyError:
+			value = self.__data[key] = load()
+			return value
+
+	def missing(self, keys):
+		self.__validate()
+		return [key for key in keys if key not in self.__data]
+
+	def update(self, data):
+		self.__data.update(data)
+
+	def __validate(self):
+		now = time.time()
+		if now < self.__expires:
+			return
+		if self.__probe is None:
+			self.__data.clear()
+		else:
+			version = self.__probe()
+			if version != self.__version or version is None:
+				self.__data.clear()
+			self.__version = version
+		self.__expires = now + self.ttl
+
 
 class UserContext(object):
 	"""
 	Persistent core
 	"""
 
+	# servers.conf [auth] options
+	#   acl_ttl     - seconds access data is cached, 0 disables cache
+	#   acl_version - table returning acl_version column changed with access rights
+	#   acl_access  - table returning objectaccess_* columns of all objects of user,
+	#                 used to load access of many objects with one query
+	ACL_TTL = 60
+
 	def __init__(self, sid):
 		self.sid = sid
 		self.application = 'default'
@@ -29,6 +232,7 @@ class UserContext(object):
 
 		self.__configs = {}
 		self.__transactionInfo = None
+		self.__acl = None
 
 
 	def getTransactionInfo(self):
@@ -43,6 +247,7 @@ class UserContext(object):
 		dict['_UserContext__gConnection'] = None
 		dict['_UserContext__configs'] = {}
 		dict['_UserContext__transactionInfo'] = None
+		dict['_UserContext__acl'] = None
 		return dict
 
 	def filePath(self, path, file, exact=False):
@@ -96,7 +301,7 @@ class UserContext(object):
 		self.userId = None
 		self.sessionId = None
 		self.__sessionKey = None
-		self.__userGroups = None
+		self.__acl = None
 
 		if self.hasConnection():
 
@@ -114,7 +319,7 @@ class UserContext(object):
 					'client_ip'     : self.getTransactionInfo().getRemoteAddress(),
 					'webkit_sid'    : self.sid,
 				},
-			
+				idempotent = False,
 			))
 			if res:
 				self.userId       = res[0]['_user_id']
@@ -137,9 +342,11 @@ class UserContext(object):
 		return self.userId is not None
 			
 	def logEvent(self, name, access_object_id=None, access=None, note=None):
+		"""
+		queues event to be written by background writer, see [auditlog] in servers.conf
+		"""
 		if self.hasConnection():
-			c = self.getConnection()
-			c.insert('_event_log', {
+			self.getAuditLog().log((self.__sessionKey, {
 				'event_name' : name,
 				'event_time' : datetime.datetime.now(),
 				#'sid'        : self.sid,
@@ -150,31 +357,69 @@ class UserContext(object):
 				'access'           : access,
 				'event_note'       : note,
 				'session_id'       : self.sessionId,
-			})
-			c.commit()
+			}))
+
+	def getAuditLog(self):
+		config = self.getConfig('servers.conf')
+		return _getAuditLog(
+			self.filePath('etc', 'connections.conf', exact=True),
+			config.get('auth', 'connection'),
+			auditlog.getOptions(config),
+		)
+
+	def __getAuthOption(self, option, default=None):
+		config = self.getConfig('servers.conf')
+		if config.has_option('auth', option):
+			return config.get('auth', option)
+		return default
+
+	def __getAclCache(self):
+		if self.__acl is None:
+			version = self.__getAuthOption('acl_version')
+			if version:
+				probe = lambda: tuple(self.query(version, ['acl_version'], parameters={'user_id' : self.userId}))
+			else:
+				probe = None
+			self.__acl = _AclCache(float(self.__getAuthOption('acl_ttl', self.ACL_TTL)), probe)
+		return self.__acl
 
 	def getUserGroups(self):
 		if self.isLoggedIn() and self.hasConnection():
-			return tuple((row['group_sysname'] for row in self.query('_group_actual', ['group_sysname'])))
+			return self.__getAclCache().get('groups', lambda:
+				tuple((row['group_sysname'] for row in self.query('_group_actual', ['group_sysname'])))
+			)
 		else:
 			return ()
 
 	def isSuperuser(self):
 		return 'ADMINISTRATOR' in self.getUserGroups()
 
+	__OBJECT_FIELDS = [
+		'object_id',
+		#'object_parent_id',
+		'object_type_id',
+		'object_name',
+		'object_url',
+		#'object_params',
+	]
+
+	__ACCESS_FIELDS = [
+		'objectaccess_is_view', 
+		'objectaccess_is_edit',
+		'objectaccess_is_ins',
+		'objectaccess_is_del',
+		'objectaccess_is_print',
+	]
+
 	def getAccessObject(self, accessObjectId):
 		assert accessObjectId is not None
 
+		return self.__getAclCache().get(('object', accessObjectId), lambda: self.__loadAccessObject(accessObjectId))
+
+	def __loadAccessObject(self, accessObjectId):
 		try:
 			ao = self.query('_spr_object',
-					[
-						'object_id',
-						#'object_parent_id',
-						'object_type_id',
-						'object_name',
-						'object_url',
-						#'object_params',
-					],
+					self.__OBJECT_FIELDS,
 					{
 						'object_id' : accessObjectId,
 					},
@@ -189,13 +434,7 @@ class UserContext(object):
 				ao,
 				self.query(
 					'get_objectaccess', 
-					[	
-						'objectaccess_is_view', 
-						'objectaccess_is_edit',
-						'objectaccess_is_ins',
-						'objectaccess_is_del',
-						'objectaccess_is_print',
-					],
+					self.__ACCESS_FIELDS,
 					parameters = { 
 						'object_id' : accessObjectId,
 						'user_id' : self.userId,
@@ -203,23 +442,61 @@ class UserContext(object):
 				)
 			)
 
+	def getAccessObjects(self, accessObjectIds):
+		"""
+		returns { accessObjectId : AccessObject or None }
+		objects not cached yet are loaded with one query,
+		access too if acl_access is configured
+		"""
+		cache = self.__getAclCache()
+		missing = [key[1] for key in cache.missing([('object', i) for i in set(accessObjectIds)])]
+
+		if missing:
+			condition = ['or'] + [['eq', ['field', 'object_id'], ['const', i]] for i in missing]
+			parameters = { 'user_id' : self.userId }
+
+			objects = dict(((ao['object_id'], ao) for ao in self.query('_spr_object', self.__OBJECT_FIELDS, condition, parameters=parameters)))
+
+			source = self.__getAuthOption('acl_access')
+			if source:
+				accesses = {}
+				for row in self.query(source, ['object_id'] + self.__ACCESS_FIELDS, condition, parameters=parameters):
+					accesses.setdefault(row['object_id'], []).append(row)
+				loadAccess = lambda i: accesses.get(i, ())
+			else:
+				loadAccess = lambda i: self.query('get_objectaccess', self.__ACCESS_FIELDS, parameters={
+					'object_id' : i,
+					'user_id'   : self.userId,
+				})
+
+			cache.update(((
+				('object', i),
+				AccessObject(objects[i], loadAccess(i)) if i in objects else None
+			) for i in missing))
+
+		return dict(((i, self.getAccessObject(i)) for i in accessObjectIds))
 
 	def getFunctionAccess(self, object_id):
-		d = {}
 		if self.isLoggedIn() and self.hasConnection():
-			for row in self.query(
-				'session_func', 
-				[
-					'func_key',
-					'is_ins',
-					'is_upd',
-					'is_del',
-				],
-				parameters = {
-					'object_id' : object_id,
-				}
-			):
-				d[row['func_key']] = (row['is_ins'], row['is_upd'], row['is_del'])
+			return dict(self.__getAclCache().get(('function', object_id), lambda: self.__loadFunctionAccess(object_id)))
+		else:
+			return {}
+
+	def __loadFunctionAccess(self, object_id):
+		d = {}
+		for row in self.query(
+			'session_func', 
+			[
+				'func_key',
+				'is_ins',
+				'is_upd',
+				'is_del',
+			],
+			parameters = {
+				'object_id' : object_id,
+			}
+		):
+			d[row['func_key']] = (row['is_ins'], row['is_upd'], row['is_del'])
 		return d
 		
 
@@ -230,25 +507,9 @@ class UserContext(object):
 	def getConnection(self):
 		filePath = self.filePath('etc', 'connections.conf', exact=True)
 		connName = self.getConfig('servers.conf').get('auth', 'connection')
-		thread = threading.currentThread()
-
-		key = (filePath, connName)
 
-		gConnection = _gConnections_by_thread.get(thread, {}).get(key)
-
-		if gConnection is not None:
-			# test if usable
-			try:
-				c = gConnection._getNativeConnection()['connection'].cursor()
-				c.execute('SELECT NULL')
-				c.close()
-			except:
-				print '* connection from cache is unusable. Problem was:'
-				print ''.join(traceback.format_exception(*sys.exc_info()))
-				gConnection = None
-		
-		if gConnection is None:
-			_gConnections_by_thread.setdefault(thread, {})[key] = gConnection = GConnections(filePath).getConnection(connName, login=True)
+		gConnection = _getThreadConnection(filePath, connName,
+			float(self.__getAuthOption('check_interval', CHECK_INTERVAL)))
 	
 		# TODO: maybe set session key to connection, not to manager every time
 		gConnection.manager.setSessionKey(self.__sessionKey)
@@ -256,10 +517,47 @@ class UserContext(object):
 		return gConnection
 
 	
-	def query(self, table, fieldnames, condition=None, sortorder=None, distinct=False, parameters=None):
+	def query(self, table, fieldnames, condition=None, sortorder=None, distinct=False, parameters=None, idempotent=True):
 		"""
 		TODO: his method must be reduced into GConnection
+
+		if the query fails because connection is broken, idempotent query
+		is repeated on new connection
 		"""
+		try:
+			return self.__query(table, fieldnames, condition, sortorder, distinct, parameters)
+		except:
+			exc = sys.exc_info()
+			filePath = self.filePath('etc', 'connections.conf', exact=True)
+			connName = self.getConfig('servers.conf').get('auth', 'connection')
+			try:
+				gConnection = self.getConnection()
+				if _isConnectionError(gConnection, exc[1]):
+					broken = not _isUsable(gConnection, rollback=True)
+				else:
+					# aborted transaction must not fail next queries of thread
+					gConnection.rollback()
+					broken = False
+			except:
+				traceback.print_exc()
+				_dropThreadConnection(filePath, connName)
+				raise exc[0], exc[1], exc[2]
+			if not broken:
+				raise exc[0], exc[1], exc[2]
+			_dropThreadConnection(filePath, connName)
+			if not idempotent:
+				raise exc[0], exc[1], exc[2]
+			try:
+				self.getConnection()
+			except:
+				print '* query %s failed on broken connection, reconnect failed:' % table
+				traceback.print_exc()
+				raise exc[0], exc[1], exc[2]
+			print '* query %s failed on broken connection, retrying' % table
+			_count('retries')
+			return self.__query(table, fieldnames, condition, sortorder, distinct, parameters)
+
+	def __query(self, table, fieldnames, condition, sortorder, distinct, parameters):
 		c = self.getConnection()
 		rs = c._resultSetClass_(
 			defaultData      = {},
@@ -277,7 +575,7 @@ class UserContext(object):
 		rs._query_object_(c, 
 			table, 
 			fieldnames, 
-			buildConditionFromDict(condition or {}), 
+			buildCondition(condition or {}), 
 			sortorder or [], 
 			distinct, 
 			parameters or {}
@@ -1,11 +1,73 @@
 import os
 import datetime
+import threading
+from itertools import groupby
+from operator import itemgetter
 from ConfigParser import ConfigParser
 
 from src.harmonyserv.dbi.driver import DbiDriver
+from src.harmonylib.auditlog import AuditLog, PartialWriteError
 import config
 
 
+_auditLogs = {}
+_auditLogsLock = threading.Lock()
+
+
+def getAuditLog(application):
+	"""
+	returns process-wide event log writer of application
+	options are taken from config.AUDIT_LOG dictionary, see harmonylib.auditlog.AuditLog
+	events are queued as ((session_key, org_staff_contact_id), params)
+	"""
+	log = _auditLogs.get(application)
+	if log is None:
+		_auditLogsLock.acquire()
+		try:
+			log = _auditLogs.get(application)
+			if log is None:
+
+				def write(events):
+					# pooled connection must have position of user logging events,
+					# so events of each user are committed by themselves
+					done = 0
+					for context, group in groupby(events, itemgetter(0)):
+						group = list(group)
+						session_key, org_staff_contact_id = context
+
+						def set_session_context(driver):
+							if org_staff_contact_id is None:
+								# nothing applied, driver must not reuse position of other user
+								return False
+							driver.execute('set_user_position', {
+								'session_key'          : session_key,
+								'org_staff_contact_id' : org_staff_contact_id,
+							}, rowType=dict)
+							driver.commit()
+
+						driver = DbiDriver.getInstance(application, 'admin',
+							set_session_context=set_session_context,
+							session_context=lambda: context,
+						)
+						try:
+							for item in group:
+								driver.execute_safe('_event_log_ins', item[1])
+							driver.commit()
+						except Exception, e:
+							if not done:
+								raise
+							# committed groups must not be written again
+							raise PartialWriteError('%s: %s' % (e.__class__.__name__, e), events[done:])
+						finally:
+							driver.closeConnection()
+						done += len(group)
+
+				log = _auditLogs[application] = AuditLog(write, **getattr(config, 'AUDIT_LOG', {}))
+		finally:
+			_auditLogsLock.release()
+	return log
+
+
 class UserSession(object):
 	"""
 	Persistent core
@@ -47,7 +109,7 @@ class UserSession(object):
 
 		if driver is None:
 			
-			def after_create_connection(driver):
+			def set_session_context(driver):
 				if self.org_staff_contact_id is not None:
 					driver.execute('set_user_position', {
 						'session_key' : self.session_key,
@@ -57,11 +119,17 @@ class UserSession(object):
 				else:
 					if not ignore_user_position_not_set:
 						raise RuntimeError, "POSITION NOT SET, session_id=%s" % self.session_id
+					# nothing applied, driver must not reuse position of other user
+					return False
+
+			def session_context():
+				return (self.session_key, self.org_staff_contact_id)
 
 			self._drivers[key] = driver = DbiDriver.getInstance(
 				self.application, 
 				connection_name, 
-				after_create_connection=after_create_connection if connection_name in ('admin', 'db') else None		# TODO: remove hardcode 'db'
+				set_session_context=set_session_context if connection_name in ('admin', 'db') else None,		# TODO: remove hardcode 'db'
+				session_context=session_context,
 			)
 
 		return driver
@@ -133,8 +201,10 @@ class UserSession(object):
 			
 	
 	def logEvent(self, name, access_object_id=None, access=None, note=None):
-		driver = self.getDriver(ignore_user_position_not_set=True)
-		driver.execute('_event_log_ins', {
+		"""
+		queues event to be written by background writer
+		"""
+		getAuditLog(self.application).log(((self.session_key, self.org_staff_contact_id), {
 			'event_name' : name,
 			'event_time' : datetime.datetime.now(),
 			#'sid'        : self.sid,
@@ -145,8 +215,7 @@ class UserSession(object):
 			'access'           : access,
 			'event_note'       : note,
 			'session_id'       : self.session_id,
-		})
-		driver.commit()
+		}))
 
 
 	def call(self, application, connection_name, function, parameters, rowType=tuple):
@@ -173,6 +242,7 @@ class UserSession(object):
 
 			finally:
 				# this is not needed since view calls UserSession.close
+				# gives pooled connection back
 				driver.closeConnection()
 		else:
 			return None	# Permission denied error
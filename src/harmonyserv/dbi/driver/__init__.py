@@ -4,53 +4,363 @@ from weakref import WeakKeyDictionary
 from ConfigParser import ConfigParser, NoOptionError
 import os
 import threading
+import time
+from hashlib import md5
 
 
+# connections.conf option -> ConnectionPool keyword, type
+POOL_OPTIONS = (
+	('pool_min_size',       'min_size',       int),
+	('pool_max_size',       'max_size',       int),
+	('pool_idle_timeout',   'idle_timeout',   float),
+	('pool_check_interval', 'check_interval', float),
+	('pool_wait_timeout',   'wait_timeout',   float),
+)
+
+
+class PoolTimeoutError(RuntimeError):
+	pass
+
+
+class PooledConnection(object):
+	"""
+	Pool entry, keeps native connection and its bookkeeping
+	"""
+
+	# session context is not applied yet
+	NO_CONTEXT = object()
+
+	def __init__(self, connection, pool):
+		self.connection = connection
+		self.pool = pool
+		self.context = self.NO_CONTEXT
+		self.lastUsed = self.lastChecked = time.time()
+
+
+class ConnectionPool(object):
+	"""
+	Thread-safe pool of open connections of one (application, connection)
+
+	min_size       - number of connections kept open even if idle
+	max_size       - maximum number of open connections, checkout waits if reached
+	idle_timeout   - seconds idle connection lives above min_size
+	check_interval - seconds idle before connection is pinged on checkout
+	wait_timeout   - seconds checkout waits for free connection
+	"""
+
+	def __init__(self, factory, min_size=0, max_size=10, idle_timeout=300, check_interval=30, wait_timeout=30):
+		self.__factory = factory
+		self.min_size = min_size
+		self.max_size = max(max_size, 1)
+		self.idle_timeout = idle_timeout
+		self.check_interval = check_interval
+		self.wait_timeout = wait_timeout
+
+		self.__condition = threading.Condition(threading.Lock())
+		self.__idle = []	# most recently used last
+		self.__size = 0		# idle and checked out connections
+		self.closed = False
+
+		self.__stats = {
+			'hits'           : 0,	# checkout served from idle connection
+			'misses'         : 0,	# checkout created new connection
+			'waits'          : 0,	# checkout had to wait for free connection
+			'wait_time'      : 0.0,	# total seconds waited
+			'timeouts'       : 0,	# checkout gave up waiting
+			'check_failures' : 0,	# idle connection failed health check
+			'discarded'      : 0,	# connection closed as broken
+			'expired'        : 0,	# connection closed as idle too long
+		}
+
+	def checkout(self):
+		"""
+		returns PooledConnection, must be given back with checkin
+		"""
+		start = time.time()
+		waited = False
+		expired = []
+		self.__condition.acquire()
+		try:
+			expired = self.__expire(start)
+			while True:
+				if self.__idle:
+					entry = self.__idle.pop()
+					self.__stats['hits'] += 1
+					break
+				if self.__size < self.max_size:
+					self.__size += 1
+					entry = None
+					self.__stats['misses'] += 1
+					break
+				remaining = start + self.wait_timeout - time.time()
+				if remaining <= 0:
+					self.__stats['timeouts'] += 1
+					raise PoolTimeoutError, "no free connection in %s seconds, pool size is %s" % (self.wait_timeout, self.max_size)
+				waited = True
+				self.__condition.wait(remaining)
+		finally:
+			if waited:
+				self.__stats['waits'] += 1
+				self.__stats['wait_time'] += time.time() - start
+			self.__condition.release()
+			for i in expired:
+				self.__close(i)
+
+		if entry is not None and not self.__check(entry):
+			self.__close(entry)
+			entry = None
+
+		if entry is None:
+			try:
+				entry = PooledConnection(self.__factory(), self)
+			except:
+				self.__release_slot()
+				raise
+
+		return entry
+
+	def replace(self, entry):
+		"""
+		closes checked out connection and returns new one in its place
+		"""
+		self.__close(entry)
+		try:
+			return PooledConnection(self.__factory(), self)
+		except:
+			self.__release_slot(discarded=True)
+			raise
+
+	def checkin(self, entry, discard=False):
+		"""
+		gives connection back to pool, open transaction is rolled back
+		discard closes connection instead, e.g. if it may be broken
+		"""
+		if self.closed:
+			discard = True
+
+		if not discard:
+			try:
+				entry.connection.rollback()
+			except Exception, e:
+				print "* pooled connection rollback failed: %s: %s" % (e.__class__.__name__, e)
+				discard = True
+
+		if discard:
+			self.__close(entry)
+			self.__release_slot(discarded=True)
+		else:
+			entry.lastUsed = time.time()
+			self.__condition.acquire()
+			try:
+				self.__idle.append(entry)
+				self.__condition.notify()
+			finally:
+				self.__condition.release()
+
+	def clear(self):
+		"""
+		closes all idle connections
+		"""
+		self.__condition.acquire()
+		try:
+			idle = self.__idle
+			self.__idle = []
+			self.__size -= len(idle)
+			self.__condition.notifyAll()
+		finally:
+			self.__condition.release()
+		for entry in idle:
+			self.__close(entry)
+
+	def close(self):
+		"""
+		closes idle connections, checked out ones are closed on checkin
+		"""
+		self.closed = True
+		self.clear()
+
+	def statistics(self):
+		self.__condition.acquire()
+		try:
+			stats = dict(self.__stats)
+			stats['size'] = self.__size
+			stats['idle'] = len(self.__idle)
+			stats['in_use'] = self.__size - len(self.__idle)
+		finally:
+			self.__condition.release()
+		return stats
+
+	def __expire(self, now):
+		"""
+		called with lock held, removes and returns idle connections to be closed
+		"""
+		expired = []
+		# oldest are first
+		while self.__idle and self.__size > self.min_size and now - self.__idle[0].lastUsed > self.idle_timeout:
+			expired.append(self.__idle.pop(0))
+			self.__size -= 1
+			self.__stats['expired'] += 1
+		return expired
+
+	def __check(self, entry):
+		now = time.time()
+		if now - max(entry.lastUsed, entry.lastChecked) < self.check_interval:
+			return True
+		try:
+			entry.connection.execute('SELECT 1', ())
+			entry.connection.rollback()
+		except Exception, e:
+			print "* pooled connection is unusable: %s: %s" % (e.__class__.__name__, e)
+			self.__condition.acquire()
+			try:
+				self.__stats['check_failures'] += 1
+			finally:
+				self.__condition.release()
+			return False
+		else:
+			entry.lastChecked = now
+			return True
+
+	def __close(self, entry):
+		try:
+			entry.connection.close()
+		except Exception, e:
+			print "* failed to close connection: %s: %s" % (e.__class__.__name__, e)
+
+	def __release_slot(self, discarded=False):
+		self.__condition.acquire()
+		try:
+			self.__size -= 1
+			if discarded:
+				self.__stats['discarded'] += 1
+			self.__condition.notify()
+		finally:
+			self.__condition.release()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def getPool(key, factory, **options):
+	"""
+	returns process-wide pool for key, creates it with options on first call
+	"""
+	pool = _pools.get(key)
+	if pool is None:
+		_pools_lock.acquire()
+		try:
+			pool = _pools.get(key)
+			if pool is None:
+				pool = _pools[key] = ConnectionPool(factory, **options)
+		finally:
+			_pools_lock.release()
+	return pool
+
+
+def closePools(application):
+	"""
+	closes and forgets pools of application, e.g. after connections.conf is changed
+	"""
+	_pools_lock.acquire()
+	try:
+		keys = [key for key in _pools if key[0] == application]
+		pools = [_pools.pop(key) for key in keys]
+	finally:
+		_pools_lock.release()
+	for pool in pools:
+		pool.close()
+
+
+def getPoolStatistics():
+	"""
+	returns { (application, section, parameters hash) : statistics dict }
+	"""
+	return dict(((key, pool.statistics()) for key, pool in _pools.items()))
 
 
 class DbiDriver(object):
 
 
-	def __init__(self, app_name, connection_data, after_create_connection=None):
+	def __init__(self, app_name, connection_data, set_session_context=None, session_context=None, connection_config=None):
+		"""
+		set_session_context(driver) is called on checkout of pooled connection
+		if session_context() result differs from last one applied to this connection
+		if session_context is None, it is called once per connection
+		set_session_context returns False if it applied nothing, then connection
+		carrying context of other session is replaced by new one
+		"""
 		self._app_name = app_name
-		self.__connect_parameters = self.getConnectionParameters(connection_data)
+		self.__connection_data = connection_data
 		self.__connections = WeakKeyDictionary()
-		self.__after_create_connection = after_create_connection
+		self.__set_session_context = set_session_context
+		self.__session_context = session_context
+		self.__config = connection_config
+		self.__pool = None
 
-
-	def getConnectionParameters(self, connection_data):
+	@classmethod
+	def getConnectionParameters(cls, connection_data):
 		return [], connection_data
-	
+
+	@classmethod
+	def connect(cls, connection_data):
+		args, kwargs = cls.getConnectionParameters(connection_data)
+		return Connection(cls.package, *args, **kwargs)
 
 	def createConnection(self):
-		args, kwargs = self.__connect_parameters
-		return Connection(self.package, *args, **kwargs)
+		return self.connect(self.__connection_data)
+
+
+	def getPool(self):
+		if self.__config is not None:
+			return self.__config.getPool(self._app_name)
+		# not created from connections.conf, pool of own
+		if self.__pool is None:
+			self.__pool = ConnectionPool(self.createConnection)
+		return self.__pool
 
 
 	def _getConnection(self):
 		thread = threading.currentThread()
-		return self.__connections.get(thread)
+		entry = self.__connections.get(thread)
+		if entry is not None:
+			return entry.connection
 
 	
 	def getConnection(self):
 		thread = threading.currentThread()
-		connection = self.__connections.get(thread)
-		if connection is None:
-			connection = self.__connections[thread] = self.createConnection()
-			if self.__after_create_connection:
-				self.__after_create_connection(self)
-		return connection
+		entry = self.__connections.get(thread)
+		if entry is None:
+			entry = self.__connections[thread] = self.getPool().checkout()
+			if self.__set_session_context:
+				context = self.__session_context() if self.__session_context else None
+				if entry.context is PooledConnection.NO_CONTEXT or entry.context != context:
+					try:
+						applied = self.__set_session_context(self)
+					except:
+						# context may be applied partially
+						self.closeConnection(discard=True)
+						raise
+					if applied is False:
+						if entry.context is not PooledConnection.NO_CONTEXT:
+							# committed context of other session must not leak into this one
+							del self.__connections[thread]
+							entry = self.__connections[thread] = entry.pool.replace(entry)
+					else:
+						entry.context = context
+		return entry.connection
 
 	
-	def closeConnection(self):
+	def closeConnection(self, discard=False):
+		"""
+		gives connection of current thread back to pool
+		discard closes it instead
+		"""
 		thread = threading.currentThread()
-		connection = self.__connections.get(thread)
-		if connection is not None:
+		entry = self.__connections.get(thread)
+		if entry is not None:
 			del self.__connections[thread]
-			try:
-				connection.close()
-			except Exception, e:
-				print "* failed to close connection: %s: %s" % (e.__class__.__name__, e)
+			entry.pool.checkin(entry, discard)
 
 	def commit(self):
 		connection = self._getConnection()
@@ -78,7 +388,7 @@ class DbiDriver(object):
 				print "* failed to rollback connection: %s: %s" % (e.__class__.__name__, e)
 			
 			# close because connection may be broken after rollback
-			self.closeConnection()
+			self.closeConnection(discard=True)
 			raise
 		else:
 			return rs
@@ -108,26 +418,24 @@ class DbiDriver(object):
 		return self.getApplicationConfig(self._app_name, config)
 	
 	@classmethod
-	def getInstance(cls, application, connection, *args, **kwargs):
+	def getConnectionConfig(cls, application, connection):
+		return ConnectionRegistry.getInstance(application, cls.getApplicationConfig(application, 'connections.conf'))[connection]
 
-		parser = ConfigParser()
-		parser.read(cls.getApplicationConfig(application, 'connections.conf'))
+	@classmethod
+	def getInstance(cls, application, connection, *args, **kwargs):
+		return cls.getConnectionConfig(application, connection).createDriver(application, *args, **kwargs)
 
-		# if alias, resolve alias
-		if connection not in parser.sections():
-			for section in parser.sections():
-				try:
-					if connection in (i.strip() for i in parser.get(section, 'aliases').split(',')):
-						connection = section
-						break
-				except NoOptionError:
-					pass
 
-		provider = parser.get(connection, 'provider')
+class ConnectionConfig(object):
+	"""
+	Resolved connections.conf section, driver factory
+	"""
 
-		driver = lang.import_module_relative(provider, __name__, 'driver').DbiDriver
+	def __init__(self, parser, connection):
+		self.name = connection
+		self.provider = parser.get(connection, 'provider')
 
-		data = {
+		self.data = {
 			'host'       : parser.get(connection, 'host'    ),
 			'database'   : parser.get(connection, 'dbname'  ),
 			'user'       : parser.get(connection, 'username'),
@@ -135,8 +443,123 @@ class DbiDriver(object):
 			'_encoding_' : parser.get(connection, 'encoding'),
 		}
 		try:
-			data['port'] = parser.get(connection, 'port')
+			self.data['port'] = parser.get(connection, 'port')
 		except:
 			pass
 
-		return driver(application, data, *args, **kwargs)
+		self.pool_options = {}
+		for option, name, type in POOL_OPTIONS:
+			if parser.has_option(connection, option):
+				self.pool_options[name] = type(parser.get(connection, option))
+
+		# pools of changed connection are not shared with old ones
+		self.key = md5(repr((self.provider, sorted(self.data.items()), sorted(self.pool_options.items())))).hexdigest()
+
+		self.__driverClass = None
+
+	def getDriverClass(self):
+		if self.__driverClass is None:
+			self.__driverClass = lang.import_module_relative(self.provider, __name__, 'driver').DbiDriver
+		return self.__driverClass
+
+	def createConnection(self):
+		return self.getDriverClass().connect(dict(self.data))
+
+	def getPool(self, application):
+		"""
+		pool does not keep drivers, only this config
+		"""
+		return getPool((application, self.name, self.key), self.createConnection, **self.pool_options)
+
+	def createDriver(self, application, *args, **kwargs):
+		kwargs.setdefault('connection_config', self)
+		return self.getDriverClass()(application, dict(self.data), *args, **kwargs)
+
+
+class ConnectionRegistry(object):
+	"""
+	Parsed connections.conf of application
+	Reloaded if file modification time changes, checked not often than CHECK_INTERVAL seconds
+	"""
+
+	CHECK_INTERVAL = 2.0
+
+	_instances = {}
+	_lock = threading.Lock()
+
+	def __init__(self, path):
+		self.path = path
+		self.mtime = self.getMTime(path)
+		self.lastChecked = time.time()
+
+		self.__parser = ConfigParser()
+		self.__parser.read(path)
+
+		self.__aliases = {}
+		for section in self.__parser.sections():
+			try:
+				aliases = self.__parser.get(section, 'aliases')
+			except NoOptionError:
+				pass
+			else:
+				for alias in aliases.split(','):
+					self.__aliases.setdefault(alias.strip(), section)
+
+		self.__configs = {}
+
+	@staticmethod
+	def getMTime(path):
+		try:
+			return os.stat(path).st_mtime
+		except OSError:
+			return None
+
+	def isStale(self):
+		now = time.time()
+		if now - self.lastChecked < self.CHECK_INTERVAL:
+			return False
+		self.lastChecked = now
+		return self.getMTime(self.path) != self.mtime
+
+	def __getitem__(self, connection):
+		config = self.__configs.get(connection)
+		if config is None:
+			# if alias, resolve alias
+			if not self.__parser.has_section(connection):
+				section = self.__aliases.get(connection, connection)
+			else:
+				section = connection
+			self._lock.acquire()
+			try:
+				# aliases share config and pool of section
+				config = self.__configs.get(section)
+				if config is None:
+					config = self.__configs[section] = ConnectionConfig(self.__parser, section)
+				self.__configs[connection] = config
+			finally:
+				self._lock.release()
+		return config
+
+	@classmethod
+	def getInstance(cls, application, path):
+		registry = cls._instances.get(application)
+		if registry is None or registry.isStale():
+			cls._lock.acquire()
+			try:
+				registry = cls._instances.get(application)
+				if registry is None or registry.path != path or registry.mtime != cls.getMTime(path):
+					if registry is not None:
+						# connect parameters may be changed
+						closePools(application)
+					registry = cls._instances[application] = cls(path)
+			finally:
+				cls._lock.release()
+		return registry
+
+	@classmethod
+	def clear(cls):
+		cls._lock.acquire()
+		try:
+			cls._instances.clear()
+		finally:
+			cls._lock.release()
@@ -16,7 +16,8 @@ class DbiDriver(base.DbiDriver):
 		assert self._encoding
 	
 	
-	def getConnectionParameters(self, connection_data):
+	@classmethod
+	def getConnectionParameters(cls, connection_data):
 		kwargs = {}
 		if '_encoding_' in connection_data:
 			kwargs['_encoding_'] = connection_data['_encoding_']
@@ -0,0 +1,33 @@
+"""
+DbiDriver.getInstance throughput
+
+uncached - connections.conf parsed and provider resolved on every call, as before registry
+cached   - resolved from ConnectionRegistry
+"""
+import sys
+import time
+
+from src.harmonyserv.dbi.driver import DbiDriver, ConnectionRegistry
+
+
+def bench(application, connection, count, cached):
+	ConnectionRegistry.clear()
+	start = time.time()
+	for i in xrange(count):
+		if not cached:
+			ConnectionRegistry.clear()
+		DbiDriver.getInstance(application, connection)
+	return count / (time.time() - start)
+
+
+def test(application='test', connection='db', count=10000):
+	uncached = bench(application, connection, count, False)
+	cached   = bench(application, connection, count, True)
+	print "getInstance('%s', '%s') x %s" % (application, connection, count)
+	print "uncached: %10.0f calls/s" % uncached
+	print "cached:   %10.0f calls/s" % cached
+	print "speedup:  %10.1fx" % (cached / uncached)
+
+
+if __name__ == '__main__':
+	test(*sys.argv[1:3])
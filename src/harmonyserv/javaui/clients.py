@@ -0,0 +1,220 @@
+"""
+GFClient instances of java ui sessions
+
+Last access of every session is kept in memory with an expiry heap, so
+finding expired clients does not scan the session table. Clients are
+evicted every JAVAUI_EVICT_EVERY requests, by optional timer thread and
+when django deletes the session (logout, clearsessions).
+"""
+import datetime
+import heapq
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.sessions.models import Session
+
+from gnue.forms.uidrivers.java.GFClient import GFClient
+from gnue.forms.uidrivers._base.rpc.outconv import outconv
+from gnue.forms.uidrivers.java.config import DEBUG
+from src.harmonyserv.javaui.models import UserContext
+from harmonyserv.clientproperty.models import Storage
+
+
+class ClientRegistry(object):
+	"""
+	Thread-safe { session key : GFClient } with expiry
+
+	expiry      - seconds client lives after last request
+	evict_every - requests between evictions, 0 disables
+	"""
+
+	def __init__(self, expiry, evict_every=100):
+		self.expiry = expiry
+		self.evict_every = evict_every
+
+		self.__lock = threading.Lock()
+		self.__clients = {}
+		self.__expires = {}	# session key -> time
+		self.__heap = []	# (time, session key), may contain outdated entries
+		self.__requests = 0
+		self.__timer = None
+
+		self.__stats = {
+			'created'  : 0,
+			'evicted'  : 0,	# session expired
+			'released' : 0,	# session deleted
+			'revived'  : 0,	# expired in memory but session still alive
+		}
+
+	def get(self, sid, factory, capacity=None):
+		"""
+		returns client of session, creates it with factory() if needed
+		returns None if capacity clients exist already
+		"""
+		now = time.time()
+		self.__lock.acquire()
+		try:
+			client = self.__clients.get(sid)
+			if client is None:
+				if capacity is not None and len(self.__clients) >= capacity:
+					return None
+				client = self.__clients[sid] = factory()
+				self.__stats['created'] += 1
+			self.__touch(sid, now + self.expiry)
+			self.__requests += 1
+			evict = self.evict_every and self.__requests % self.evict_every == 0
+		finally:
+			self.__lock.release()
+
+		if evict:
+			self.evict(now)
+
+		return client
+
+	def release(self, sid):
+		"""
+		closes client of session
+		"""
+		self.__lock.acquire()
+		try:
+			client = self.__clients.pop(sid, None)
+			self.__expires.pop(sid, None)
+			if client is not None:
+				self.__stats['released'] += 1
+		finally:
+			self.__lock.release()
+
+		if client is not None:
+			# TODO: maybe try to close forms?
+			client.closeAllConnections()
+
+	def evict(self, now=None):
+		"""
+		closes clients of expired sessions
+		"""
+		if now is None:
+			now = time.time()
+
+		expired = []
+		self.__lock.acquire()
+		try:
+			while self.__heap and self.__heap[0][0] <= now:
+				expires, sid = heapq.heappop(self.__heap)
+				if self.__expires.get(sid) == expires:
+					expired.append(sid)
+		finally:
+			self.__lock.release()
+
+		if not expired:
+			return
+
+		# session could be kept alive by other views
+		alive = dict(Session.objects.filter(
+			session_key__in = expired,
+			expire_date__gte = datetime.datetime.now(),
+		).values_list('session_key', 'expire_date'))
+
+		closed = []
+		self.__lock.acquire()
+		try:
+			for sid in expired:
+				if self.__expires.get(sid, now + 1) > now:
+					# touched meanwhile
+					continue
+				if sid in alive:
+					self.__touch(sid, time.mktime(alive[sid].timetuple()))
+					self.__stats['revived'] += 1
+				else:
+					closed.append(self.__clients.pop(sid))
+					del self.__expires[sid]
+					self.__stats['evicted'] += 1
+		finally:
+			self.__lock.release()
+
+		for client in closed:
+			# TODO: maybe try to close forms?
+			client.closeAllConnections()
+
+	def startTimer(self, interval):
+		"""
+		evicts expired clients every interval seconds in daemon thread
+		"""
+		def run():
+			while True:
+				time.sleep(interval)
+				try:
+					self.evict()
+				except Exception, e:
+					print "* javaui client eviction failed: %s: %s" % (e.__class__.__name__, e)
+
+		self.__timer = threading.Thread(target=run, name='ClientRegistry')
+		self.__timer.setDaemon(True)
+		self.__timer.start()
+
+	def statistics(self):
+		self.__lock.acquire()
+		try:
+			stats = dict(self.__stats)
+			stats['clients'] = len(self.__clients)
+		finally:
+			self.__lock.release()
+		return stats
+
+	def __touch(self, sid, expires):
+		"""
+		called with lock held
+		"""
+		self.__expires[sid] = expires
+		heapq.heappush(self.__heap, (expires, sid))
+
+		# drop outdated entries when heap grows too large
+		if len(self.__heap) > 2 * len(self.__expires) + 64:
+			self.__heap = [(t, k) for (k, t) in self.__expires.iteritems()]
+			heapq.heapify(self.__heap)
+
+
+clients = ClientRegistry(
+	settings.SESSION_EXPIRY,
+	getattr(settings, 'JAVAUI_EVICT_EVERY', 100),
+)
+
+if getattr(settings, 'JAVAUI_EVICT_INTERVAL', None):
+	clients.startTimer(settings.JAVAUI_EVICT_INTERVAL)
+
+
+def newClient():
+	return GFClient(
+		settings.GNUE_SERVER_URL,
+		debug = bool(DEBUG),
+	)
+
+
+def processCalls(client, hiveId, calls, request, response):
+	"""
+	returns json result of calls
+	request and response are used to get clientproperty storage
+	"""
+	# used by uidriver to get user context to store gui state
+	# TODO
+	client.setGetUserContextBySid(lambda sid, user_id: UserContext(user_id))
+	client.set_get_clientproperty_storage(lambda: Storage.objects.get_storage(request, response))
+
+	try:
+		return outconv(client.processCalls(hiveId, calls))
+	finally:
+		# to free request, response reference
+		client.set_get_clientproperty_storage(None)
+
+
+class LocalStore(object):
+	"""
+	keeps clients of all sessions in this process
+	"""
+
+	def process(self, request, response, hiveId, calls):
+		client = clients.get(request.session.session_key, newClient)
+		return processCalls(client, hiveId, calls, request, response)
+
+	def release(self, session):
+		clients.release(session.session_key)
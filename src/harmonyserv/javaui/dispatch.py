@@ -0,0 +1,432 @@
+"""
+Routing of java ui calls to GFClient instances
+
+Without settings.JAVAUI_WORKERS clients live in the django process
+(LocalStore). Otherwise clients live in worker processes listening on unix
+sockets (WorkerStore). The worker owning the clients of a session is kept in
+the session, so all calls of a browser go to the same worker. New sessions
+are placed on the least loaded worker below its capacity.
+
+Run worker:
+	python dispatch.py worker SOCKET [CAPACITY]
+
+Load test with N local workers:
+	python dispatch.py loadtest [N] [SESSIONS] [CALLS]
+"""
+import os
+import sys
+
+if __name__ == '__main__':
+	# same environment as wsgi_handler
+	sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))))
+	sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+	os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings')
+
+import time
+import random
+import socket
+import struct
+import cPickle
+import traceback
+import SocketServer
+
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.db.models.signals import post_delete
+
+from gnue.forms.uidrivers.java.GFClient import InstanceNotFoundError
+from src.harmonyserv.javaui.clients import ClientRegistry, LocalStore, clients, newClient, processCalls
+
+
+# session key of worker socket
+SESSION_WORKER = 'javaui_worker'
+
+
+class WorkersBusyError(Exception):
+	pass
+
+
+############################################################################
+# protocol: 4 byte length and pickled message
+
+def _send(sock, message):
+	data = cPickle.dumps(message, 2)
+	sock.sendall(struct.pack('!I', len(data)) + data)
+
+def _recv(sock):
+	size, = struct.unpack('!I', _recvall(sock, 4))
+	return cPickle.loads(_recvall(sock, size))
+
+def _recvall(sock, size):
+	chunks = []
+	while size:
+		chunk = sock.recv(min(size, 0x10000))
+		if not chunk:
+			raise EOFError, 'connection closed'
+		chunks.append(chunk)
+		size -= len(chunk)
+	return ''.join(chunks)
+
+def _picklable(e):
+	try:
+		cPickle.dumps(e, 2)
+	except Exception:
+		return RuntimeError('%s: %s' % (e.__class__.__name__, e))
+	return e
+
+
+############################################################################
+# worker
+
+class _Cookies(object):
+	"""
+	request and response for clientproperty storage in worker
+	"""
+
+	def __init__(self, cookies):
+		self.COOKIES = cookies
+		self.cookies = []
+
+	def set_cookie(self, *args, **kwargs):
+		self.cookies.append((args, kwargs))
+
+
+class _WorkerHandler(SocketServer.BaseRequestHandler):
+
+	def handle(self):
+		while True:
+			try:
+				message = _recv(self.request)
+			except EOFError:
+				break
+			_send(self.request, self.server.dispatch(message))
+
+
+class WorkerServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+	"""
+	keeps clients of sessions placed on this worker
+
+	path     - unix socket
+	capacity - sessions served at most
+	"""
+
+	daemon_threads = True
+
+	def __init__(self, path, capacity, registry=clients, factory=newClient):
+		if os.path.exists(path):
+			os.remove(path)
+
+		# messages are pickled, allow only own user to connect
+		umask = os.umask(0077)
+		try:
+			SocketServer.UnixStreamServer.__init__(self, path, _WorkerHandler)
+		finally:
+			os.umask(umask)
+
+		self.capacity = capacity
+		self.registry = registry
+		self.factory = factory
+
+	def server_close(self):
+		SocketServer.UnixStreamServer.server_close(self)
+		try:
+			os.remove(self.server_address)
+		except OSError:
+			pass
+
+	def dispatch(self, message):
+		op = message[0]
+
+		if op == 'process':
+			sid, hiveId, calls, cookies = message[1:]
+			client = self.registry.get(sid, self.factory, self.capacity)
+			if client is None:
+				return ('full',)
+
+			http = _Cookies(cookies)
+			try:
+				rc = processCalls(client, hiveId, calls, http, http)
+			except InstanceNotFoundError:
+				return ('notfound',)
+			except Exception, e:
+				traceback.print_exc()
+				return ('error', _picklable(e))
+			return ('ok', rc, http.cookies)
+
+		elif op == 'release':
+			self.registry.release(message[1])
+			return ('ok',)
+
+		elif op == 'load':
+			return ('ok', self.registry.statistics()['clients'], self.capacity)
+
+		else:
+			return ('error', ValueError('unknown operation: %r' % (op,)))
+
+
+############################################################################
+# dispatcher
+
+class WorkerStore(object):
+	"""
+	sends calls to worker owning clients of session
+
+	paths   - unix sockets of workers
+	timeout - seconds to wait for worker, None waits forever
+	"""
+
+	def __init__(self, paths, timeout=None):
+		self.paths = list(paths)
+		self.timeout = timeout
+
+	def process(self, request, response, hiveId, calls):
+		session = request.session
+		message = ('process', session.session_key, hiveId, calls, dict(request.COOKIES))
+
+		path = session.get(SESSION_WORKER)
+		reply = None
+
+		if path in self.paths:
+			try:
+				reply = self.__call(path, message)
+			except (socket.error, EOFError), e:
+				print "* javaui worker %s failed: %s: %s" % (path, e.__class__.__name__, e)
+
+			if reply is None or reply[0] == 'full':
+				# worker was restarted
+				del session[SESSION_WORKER]
+				reply = None
+
+		if reply is None:
+			if calls:
+				# instance can be only on worker of session
+				raise InstanceNotFoundError
+			path, reply = self.__place(message)
+			session[SESSION_WORKER] = path
+
+		if reply[0] == 'ok':
+			rc, cookies = reply[1:]
+			for args, kwargs in cookies:
+				response.set_cookie(*args, **kwargs)
+			return rc
+		elif reply[0] == 'notfound':
+			raise InstanceNotFoundError
+		else:
+			raise reply[1]
+
+	def release(self, session):
+		try:
+			path = session.get_decoded().get(SESSION_WORKER)
+		except Exception:
+			return
+		if path in self.paths:
+			try:
+				self.__call(path, ('release', session.session_key))
+			except (socket.error, EOFError), e:
+				print "* javaui worker %s failed: %s: %s" % (path, e.__class__.__name__, e)
+
+	def loads(self):
+		"""
+		returns { path : (sessions, capacity) } of running workers
+		"""
+		loads = {}
+		for path in self.paths:
+			try:
+				loads[path] = self.__call(path, ('load',))[1:]
+			except (socket.error, EOFError), e:
+				print "* javaui worker %s failed: %s: %s" % (path, e.__class__.__name__, e)
+		return loads
+
+	def __place(self, message):
+		"""
+		returns path and reply of least loaded worker accepting session
+		"""
+		# random spreads sessions placed at the same time over equal workers
+		order = [
+			(float(count) / max(capacity, 1), random.random(), path)
+			for path, (count, capacity) in self.loads().iteritems()
+			if count < capacity
+		]
+		order.sort()
+
+		# load may change meanwhile, worker answers 'full' then
+		for load, r, path in order:
+			try:
+				reply = self.__call(path, message)
+			except (socket.error, EOFError), e:
+				print "* javaui worker %s failed: %s: %s" % (path, e.__class__.__name__, e)
+				continue
+			if reply[0] != 'full':
+				return path, reply
+
+		raise WorkersBusyError
+
+	def __call(self, path, message):
+		sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		try:
+			sock.settimeout(self.timeout)
+			sock.connect(path)
+			_send(sock, message)
+			return _recv(sock)
+		finally:
+			sock.close()
+
+
+if getattr(settings, 'JAVAUI_WORKERS', None):
+	store = WorkerStore(settings.JAVAUI_WORKERS, getattr(settings, 'JAVAUI_WORKER_TIMEOUT', None))
+else:
+	store = LocalStore()
+
+
+def _on_session_deleted(sender, instance, **kwargs):
+	store.release(instance)
+
+post_delete.connect(_on_session_deleted, sender=Session, dispatch_uid='javaui.dispatch')
+
+
+if __name__ == '__main__':
+
+	import signal
+	import shutil
+	import tempfile
+	import threading
+
+	class _LoadClient(object):
+		"""
+		spends some cpu per call instead of running forms
+		"""
+		def __init__(self):
+			self.hives = {}
+
+		def setGetUserContextBySid(self, getUserContextBySid):
+			pass
+
+		def set_get_clientproperty_storage(self, get_storage):
+			pass
+
+		def processCalls(self, hiveId, calls):
+			if not calls:
+				self.hives[hiveId] = 0
+			elif hiveId not in self.hives:
+				raise InstanceNotFoundError
+			n = 0
+			for i in xrange(50000):
+				n += i
+			self.hives[hiveId] += len(calls)
+			return [self.hives[hiveId], os.getpid()]
+
+		def closeAllConnections(self):
+			pass
+
+	class _Session(dict):
+		def __init__(self, session_key):
+			self.session_key = session_key
+
+		def get_decoded(self):
+			return self
+
+	class _Request(object):
+		def __init__(self, session_key):
+			self.session = _Session(session_key)
+			self.COOKIES = {}
+
+	class _Response(object):
+		def set_cookie(self, *args, **kwargs):
+			pass
+
+	def startWorkers(n, capacity):
+		directory = tempfile.mkdtemp()
+		paths = [os.path.join(directory, 'worker-%s.sock' % i) for i in xrange(n)]
+		pids = []
+		for path in paths:
+			pid = os.fork()
+			if pid == 0:
+				try:
+					WorkerServer(path, capacity, ClientRegistry(3600, 0), _LoadClient).serve_forever()
+				finally:
+					os._exit(0)
+			pids.append(pid)
+		while not all(map(os.path.exists, paths)):
+			time.sleep(0.01)
+		return directory, paths, pids
+
+	def stopWorkers(directory, pids):
+		for pid in pids:
+			os.kill(pid, signal.SIGTERM)
+			os.waitpid(pid, 0)
+		shutil.rmtree(directory)
+
+	def loadtest(n, sessions, calls):
+		directory, paths, pids = startWorkers(n, sessions)
+		try:
+			store = WorkerStore(paths)
+			errors = []
+
+			def run(i):
+				request = _Request('session-%s' % i)
+				try:
+					store.process(request, _Response(), 1, [])
+					for j in xrange(calls):
+						count, pid = store.process(request, _Response(), 1, [['call']])
+					assert count == calls, count
+				except Exception, e:
+					errors.append(e)
+
+			threads = [threading.Thread(target=run, args=(i,)) for i in xrange(sessions)]
+			start = time.time()
+			for thread in threads:
+				thread.start()
+			for thread in threads:
+				thread.join()
+			elapsed = time.time() - start
+
+			assert not errors, errors
+			print "%s worker(s): %s calls in %.2fs, %.0f calls/s, sessions per worker %s" % (
+				n, sessions * (calls + 1), elapsed, sessions * (calls + 1) / elapsed,
+				sorted([count for count, capacity in store.loads().values()]),
+			)
+		finally:
+			stopWorkers(directory, pids)
+
+	def capacitytest(n, capacity):
+		directory, paths, pids = startWorkers(n, capacity)
+		try:
+			store = WorkerStore(paths)
+			requests = [_Request('session-%s' % i) for i in xrange(n * capacity)]
+			for request in requests:
+				store.process(request, _Response(), 1, [])
+			assert sorted(store.loads().values()) == [(capacity, capacity)] * n
+			try:
+				store.process(_Request('session-new'), _Response(), 1, [])
+			except WorkersBusyError:
+				pass
+			else:
+				raise AssertionError, 'capacity exceeded'
+
+			# released session makes room
+			store.release(requests[0].session)
+			store.process(_Request('session-new'), _Response(), 1, [])
+			print "capacity of %s worker(s) x %s sessions ok" % (n, capacity)
+		finally:
+			stopWorkers(directory, pids)
+
+	if len(sys.argv) > 1 and sys.argv[1] == 'worker':
+		import django
+		if hasattr(django, 'setup'):
+			django.setup()
+		server = WorkerServer(sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else getattr(settings, 'JAVAUI_WORKER_CAPACITY', 100))
+		print "javaui worker %s listening on %s" % (os.getpid(), sys.argv[2])
+		try:
+			server.serve_forever()
+		finally:
+			server.server_close()
+
+	elif len(sys.argv) > 1 and sys.argv[1] == 'loadtest':
+		args = map(int, sys.argv[2:])
+		n, sessions, calls = args + [4, 16, 50][len(args):]
+		capacitytest(n, 3)
+		loadtest(1, sessions, calls)
+		loadtest(n, sessions, calls)
+
+	else:
+		print __doc__
@@ -1,29 +1,26 @@
 # Create your views here.
 from urllib2 import urlopen, Request
-import datetime
 
 from django.http import HttpResponse, Http404, HttpResponseRedirect
 from django.template import RequestContext, loader
 from django.utils.translation import get_language
-from django.contrib.sessions.models import Session
 from django.conf import settings
 from django.utils.translation import ugettext_lazy as _
 
 from toolib.web.djangoutils.jsonrpc import JSONRPCService, jsonremote, RPCServiceError
-from gnue.forms.uidrivers.java.GFClient import GFClient, InstanceNotFoundError
-from gnue.forms.uidrivers._base.rpc.outconv import outconv
+from gnue.forms.uidrivers.java.GFClient import InstanceNotFoundError
 from gnue.forms.uidrivers.java.config import DEBUG
-from src.harmonyserv.javaui.models import UserContext
-from harmonyserv.clientproperty.models import Storage
+from src.harmonyserv.javaui.dispatch import store, WorkersBusyError
 
 
 javaui_service = JSONRPCService()
 
 
-_clients = {}
+class SessionNotFoundError(RPCServiceError):
+	pass
 
 
-class SessionNotFoundError(RPCServiceError):
+class ServerBusyError(RPCServiceError):
 	pass
 
 
@@ -35,34 +32,12 @@ def process(transaction, hiveId, calls):
 
 	request.session.set_expiry(settings.SESSION_EXPIRY)
 
-	alive_session_keys = set((row['session_key'] for row in Session.objects.filter(expire_date__gte=datetime.datetime.now()).values('session_key')))
-
-	for key in _clients.keys():
-		if key not in alive_session_keys:
-			# TODO: maybe try to close forms?
-			_clients[key].closeAllConnections()
-			del _clients[key]
-
 	#rint "PROCESS", calls
 
-	sid = request.session.session_key
-
-	try:
-		client = _clients[sid]
-	except KeyError:
-		#rint ">>> CREATE CLIENT (%s)" % sid
-		client = _clients[sid] = GFClient(
-			settings.GNUE_SERVER_URL,
-			debug = bool(DEBUG),
-		)
-	
-	# used by uidriver to get user context to store gui state
-	# TODO
-	client.setGetUserContextBySid(lambda sid, user_id: UserContext(user_id))
-	client.set_get_clientproperty_storage(lambda: Storage.objects.get_storage(request, response))
-
 	try:
-		rc = client.processCalls(hiveId, calls)
+		return store.process(request, response, hiveId, calls)
+	except WorkersBusyError:
+		raise ServerBusyError, unicode(_("Sorry, server is busy. Please try again later"))
 	except InstanceNotFoundError:
 		raise SessionNotFoundError, unicode(_("""Sorry, Your session has not been found. Possible reasons:
 			- session expired (session inactivity timeout is %.f minutes)
@@ -70,11 +45,6 @@ def process(transaction, hiveId, calls):
 			- server restarted
 		Application will be reset to login""" % (settings.SESSION_EXPIRY / 60.)))
 
-	# to free request, response reference
-	client.set_get_clientproperty_storage(None)
-
-	return outconv(rc)
-
 
 def index(request):
 	return HttpResponse(loader.get_template('javaui/index.html').render(RequestContext(request, {})))
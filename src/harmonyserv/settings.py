@@ -17,6 +17,12 @@ GNUE_SERVER_URL = "http://localhost:82/harmony/wk.cgi/harmony"
 # manually handled in javaui.views.process
 SESSION_EXPIRY = 30 * 60 	# 30 minutes
 
+# unix sockets of javaui worker processes keeping GFClient instances
+# started with: python javaui/dispatch.py worker SOCKET [CAPACITY]
+# empty keeps instances in django process
+JAVAUI_WORKERS = ()
+JAVAUI_WORKER_CAPACITY = 100	# sessions per worker
+
 # allways true for javaui
 # this will not work since session.set_expiry manually
 #SESSION_EXPIRE_AT_BROWSER_CLOSE = True
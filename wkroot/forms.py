@@ -1,7 +1,7 @@
 import os
 import re
 from harmonylib.webkit.BaseServlet  import BaseServlet
-from harmonylib.webkit.FormDom      import FormDom
+from harmonylib.webkit.FormDom      import RenderedForms
 from harmonylib.webkit.AccessObject import AccessObject
 from toolib import debug
 
@@ -53,14 +53,19 @@ class forms(BaseServlet):
 
 			base, fname = os.path.split(self.getContext().filePath('forms', fname, exact=False))
 
-			dom = FormDom(fname, get_form_path=lambda fname: os.path.join(base, fname))
+			if self.getContext().isSuperuser():
+				functionAccess = None
+			else:
+				functionAccess = self.getContext().getFunctionAccess(accessObjectId)
 
-			dom.applyAccess(access)
+			data, etag = RenderedForms.render(fname, access, functionAccess, get_form_path=lambda fname: os.path.join(base, fname))
 
-			if not self.getContext().isSuperuser():
-				dom.applyFunctionAccess(self.getContext().getFunctionAccess(accessObjectId))
+			trans.response().setHeader('ETag', etag)
 
-			dom.writexml(self.response())
+			if etag in [i.strip() for i in (self.request().environ().get('HTTP_IF_NONE_MATCH') or '').split(',')]:
+				trans.response().setHeader('Status', "304 Not Modified")
+			else:
+				trans.response().write(data)
 
 		except IOError, e:
 			debug.error("%s: %s" % (e.__class__.__name__, e))
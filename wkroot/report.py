@@ -27,14 +27,12 @@ class report(HttpProxyServlet):
 		
 		query = simplejson.loads(jq)
 
-		for rep in query['reports']:
-			aoid = rep.get('aoid')
-			if aoid is not None:
-				ao = self.getContext().getAccessObject(aoid)
-				if ao is None or not bool(ao.access & ao.ACCESS_PRINT):
-					#trans.response().setHeader('Status', "403 %s" % _('You have no permission to generate this report'))	# at list one of reports
-					trans.response().setHeader('Status', "403 Access Denied")	# at list one of reports
-					return
+		aoids = [rep['aoid'] for rep in query['reports'] if rep.get('aoid') is not None]
+		for ao in self.getContext().getAccessObjects(aoids).itervalues():
+			if ao is None or not bool(ao.access & ao.ACCESS_PRINT):
+				#trans.response().setHeader('Status', "403 %s" % _('You have no permission to generate this report'))	# at list one of reports
+				trans.response().setHeader('Status', "403 Access Denied")	# at list one of reports
+				return
 
 		super(report, self).respondToAny(trans)
 